@@ -0,0 +1,312 @@
+"""
+Benchmarks for the datasette-media hot paths.
+
+    python benchmarks/bench.py -o results.json
+    python benchmarks/bench.py --quick --compare results.json
+
+Covers transform_image() across formats and sizes, encoding for each
+output format, and end-to-end serve_media requests through Datasette's
+ASGI client for filepath, BLOB and content_url media - the latter served
+by a local HTTP server. Results are written as JSON so they can be
+compared across commits with --compare.
+"""
+
+from datasette.app import Datasette
+from datasette_media import utils
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from PIL import Image
+from sqlite_utils import Database
+import argparse
+import asyncio
+import functools
+import io
+import json
+import os
+import pathlib
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    import pyheif
+except ImportError:
+    pyheif = None
+
+SOURCE_SIZES = ((1000, 750), (4000, 3000))
+TARGET_WIDTHS = (200, 800)
+ENCODE_FORMATS = ("JPEG", "PNG", "GIF", "WEBP", "AVIF")
+
+
+def make_image(size):
+    # Deterministic image with both smooth areas and fine detail, so the
+    # results do not depend on how well random noise compresses
+    detail = Image.effect_mandelbrot(size, (-2.0, -1.2, 1.0, 1.2), 100)
+    horizontal = Image.linear_gradient("L").resize(size)
+    radial = Image.radial_gradient("L").resize(size)
+    return Image.merge("RGB", (detail, horizontal, radial))
+
+
+def encoded(image, format):
+    output = io.BytesIO()
+    if format == "GIF":
+        image = image.convert("P")
+    image.save(output, format)
+    return output.getvalue()
+
+
+def measure(fn, min_time, max_iterations):
+    # Runs fn repeatedly for at least min_time seconds, after one warmup
+    fn()
+    timings = []
+    start = time.perf_counter()
+    while len(timings) < max_iterations and (
+        len(timings) < 3 or time.perf_counter() - start < min_time
+    ):
+        began = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - began)
+    return summarize(timings)
+
+
+def summarize(timings):
+    return {
+        "iterations": len(timings),
+        "min": min(timings),
+        "median": statistics.median(timings),
+        "mean": statistics.mean(timings),
+        "stdev": statistics.stdev(timings) if len(timings) > 1 else 0.0,
+    }
+
+
+def transform_benchmarks(args):
+    source_sizes = SOURCE_SIZES[:1] if args.quick else SOURCE_SIZES
+    for size in source_sizes:
+        image = make_image(size)
+        for format in ("JPEG", "PNG", "GIF"):
+            image_bytes = encoded(image, format)
+            for width in TARGET_WIDTHS:
+                yield "transform_image", {
+                    "format": format,
+                    "source": "{}x{}".format(*size),
+                    "width": width,
+                }, functools.partial(utils.transform_image, image_bytes, width=width)
+    if args.heic:
+        if pyheif is None:
+            print("Skipping HEIC: pyheif is not installed", file=sys.stderr)
+            return
+        heic_bytes = pathlib.Path(args.heic).read_bytes()
+        for width in TARGET_WIDTHS:
+            yield "transform_image", {
+                "format": "HEIC",
+                "source": pathlib.Path(args.heic).name,
+                "width": width,
+            }, functools.partial(utils.transform_image, heic_bytes, width=width)
+
+
+def encode_benchmarks(args):
+    image = make_image((800, 600))
+    for format in ENCODE_FORMATS:
+        if not utils.can_save(format):
+            print(
+                "Skipping {}: not supported by Pillow".format(format), file=sys.stderr
+            )
+            continue
+        yield "encode_image", {"format": format, "source": "800x600"}, (
+            functools.partial(utils.encode_image, image, format)
+        )
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def serve_directory(directory):
+    # Local upstream for content_url, so no external network is involved
+    server = ThreadingHTTPServer(
+        ("127.0.0.1", 0), functools.partial(QuietHandler, directory=directory)
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+async def serve_media_benchmarks(args, directory):
+    jpeg = make_image((1000, 750))
+    jpeg_path = os.path.join(directory, "photo.jpg")
+    jpeg.save(jpeg_path, "JPEG")
+    jpeg_bytes = pathlib.Path(jpeg_path).read_bytes()
+    db_path = os.path.join(directory, "media.db")
+    Database(db_path)["media"].insert(
+        {"id": 1, "content": jpeg_bytes, "large": os.urandom(5 * 1024 * 1024)},
+        pk="id",
+    )
+    server = serve_directory(directory)
+    url = "http://127.0.0.1:{}/photo.jpg".format(server.server_address[1])
+    # :key is selected so each request in a batch is a distinct transform,
+    # rather than being coalesced with the others
+    media_types = {
+        "filepath": "select '{}' as filepath, :key as k".format(jpeg_path),
+        "blob": "select content from media where id = 1 and :key is not null",
+        "blob_stream": (
+            "select 'media' as content_table, 'large' as content_column, "
+            "1 as content_rowid, :key as k"
+        ),
+        "content_url": "select '{}' as content_url, :key as k".format(url),
+    }
+    ds = Datasette(
+        [db_path],
+        metadata={
+            "plugins": {
+                "datasette-media": {
+                    name: {"sql": sql, "database": "media", "enable_transform": True}
+                    for name, sql in media_types.items()
+                }
+            }
+        },
+    )
+    await ds.invoke_startup()
+    cases = [
+        ("filepath", ""),
+        ("filepath", "?w=200"),
+        ("blob", ""),
+        ("blob", "?w=200"),
+        ("blob_stream", ""),
+        ("content_url", ""),
+        ("content_url", "?w=200"),
+    ]
+    try:
+        for media_type, query in cases:
+            result = await throughput(
+                ds, media_type, query, args.concurrency, args.min_time
+            )
+            yield "serve_media", {
+                "media_type": media_type,
+                "query": query,
+                "concurrency": args.concurrency,
+            }, result
+    finally:
+        server.shutdown()
+
+
+async def throughput(ds, media_type, query, concurrency, min_time):
+    counter = iter(range(sys.maxsize))
+
+    async def one():
+        path = "/-/media/{}/{}{}".format(media_type, next(counter), query)
+        began = time.perf_counter()
+        response = await ds.client.get(path)
+        assert response.status_code == 200, (path, response.status_code)
+        return time.perf_counter() - began
+
+    await one()
+    timings = []
+    start = time.perf_counter()
+    while len(timings) < 3 * concurrency or time.perf_counter() - start < min_time:
+        timings.extend(await asyncio.gather(*[one() for _ in range(concurrency)]))
+    result = summarize(timings)
+    result["requests_per_second"] = len(timings) / (time.perf_counter() - start)
+    return result
+
+
+def metadata():
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        "commit": commit or None,
+        "python": platform.python_version(),
+        "pillow": Image.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "timestamp": time.time(),
+    }
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as fp:
+        baseline = {
+            (result["name"], json.dumps(result["params"], sort_keys=True)): result
+            for result in json.load(fp)["results"]
+        }
+    for result in results:
+        previous = baseline.get(
+            (result["name"], json.dumps(result["params"], sort_keys=True))
+        )
+        if previous is None:
+            continue
+        ratio = result["median"] / previous["median"]
+        print(
+            "{:<14} {:<60} {:>6.2f}x {}".format(
+                result["name"],
+                json.dumps(result["params"], sort_keys=True),
+                ratio,
+                "slower" if ratio > 1 else "faster",
+            )
+        )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("-o", "--output", help="Write results as JSON to this file")
+    parser.add_argument("--compare", help="Compare with results from an earlier run")
+    parser.add_argument("--quick", action="store_true", help="Fewer, smaller cases")
+    parser.add_argument("--heic", help="HEIC file to benchmark - needs pyheif")
+    parser.add_argument("--min-time", type=float, default=1.0)
+    parser.add_argument("--max-iterations", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument(
+        "-k", dest="only", help="Only run benchmarks whose name contains this"
+    )
+    args = parser.parse_args(argv)
+    if args.quick:
+        args.min_time = min(args.min_time, 0.2)
+
+    results = []
+
+    def record(name, params, result):
+        if args.only and args.only not in name:
+            return
+        results.append(dict({"name": name, "params": params}, **result))
+        print(
+            "{:<14} {:<60} median {:.2f}ms".format(
+                name, json.dumps(params, sort_keys=True), result["median"] * 1000
+            ),
+            file=sys.stderr,
+        )
+
+    for benchmarks in (transform_benchmarks(args), encode_benchmarks(args)):
+        for name, params, fn in benchmarks:
+            if args.only and args.only not in name:
+                continue
+            record(name, params, measure(fn, args.min_time, args.max_iterations))
+
+    async def run_serve_media():
+        with tempfile.TemporaryDirectory() as directory:
+            async for name, params, result in serve_media_benchmarks(args, directory):
+                record(name, params, result)
+
+    if not args.only or args.only in "serve_media":
+        asyncio.run(run_serve_media())
+
+    output = {"metadata": metadata(), "results": results}
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(output, fp, indent=2)
+    else:
+        print(json.dumps(output, indent=2))
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,70 @@
 import asyncio
+import click
 from datasette import hookimpl
-from datasette.utils.asgi import Response, asgi_send_file
+from datasette.utils.asgi import Forbidden, Request, Response, asgi_send_file
 from concurrent import futures
-import httpx
+from concurrent.futures.process import BrokenProcessPool
+from html import escape
 from mimetypes import guess_type
+from urllib.parse import parse_qsl, quote, urlencode
 from PIL import Image
+import functools
 import io
-from . import utils
+import json
+import os
+import time
+from . import responsive, utils
+from .admission import AdmissionController, Overloaded
+from .archive import ZipStream, archive_name
+from .blob import (
+    BLOB_CHUNK_SIZE,
+    blob_fingerprint,
+    blob_size,
+    read_blob,
+    row_blob,
+)
+from .cache import DiskCache, MemoryCache, RowCache, UpstreamCache, cache_key
+from .http_client import MediaHttpClient
+from .metrics import Metrics
+from .single_flight import SingleFlight
+from .transform_pool import PendingTasks, ProcessTransformPool
+from .warm import fetch_keys, warm_transform_cache
+import uuid
+import weakref
 
 transform_executor = None
-RESERVED_MEDIA_TYPES = ("transform_threads", "enable_transform")
+transform_process_pool = None
+# Tasks submitted to transform_executor, for the queue depth in /-/media-stats
+transform_executor_tasks = PendingTasks()
+transform_caches = {}
+upstream_caches = {}
+memory_caches = weakref.WeakKeyDictionary()
+row_caches = weakref.WeakKeyDictionary()
+media_metrics = weakref.WeakKeyDictionary()
+http_clients = weakref.WeakKeyDictionary()
+single_flights = weakref.WeakKeyDictionary()
+admission_controllers = weakref.WeakKeyDictionary()
+RESERVED_MEDIA_TYPES = (
+    "transform_threads",
+    "transform_processes",
+    "transform_process_max_tasks",
+    "enable_transform",
+    "transform_cache_dir",
+    "transform_cache_max_size",
+    "memory_cache_max_size",
+    "memory_cache_max_item_size",
+    "memory_cache_ttl",
+    "row_cache_size",
+    "row_cache_ttl",
+    "upstream_cache_dir",
+    "upstream_cache_max_size",
+    "http_client",
+)
+DEFAULT_MAX_BATCH_SIZE = 100
+# For URLs that include the ?v= version of their source
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+DEFAULT_BATCH_CONCURRENCY = 8
+CONDITIONAL_HEADERS = ("if-none-match", "if-modified-since", "range", "if-range")
 
 PNG_1x1 = b"\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00\x00\x01\x08\x00\x00\x00\x00:~\x9bU\x00\x00\x00\nIDATx\x9cc\xfa\x0f\x00\x01\x05\x01\x02\xcf\xa0.\xcd\x00\x00\x00\x00IEND\xaeB`\x82"
 
@@ -18,10 +73,1077 @@ PNG_1x1 = b"\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00\x00\x01\
 def register_routes():
     return [
         (r"/-/media/(?P<media_type>[^/]+)/(?P<key>.+)", serve_media),
+        (r"^/-/media-stats$", media_stats),
+        (r"^/-/media-batch/(?P<media_type>[^/]+)$", serve_media_batch),
+        (r"^/-/media-zip/(?P<media_type>[^/]+)$", serve_media_zip),
     ]
 
 
+@hookimpl
+def register_commands(cli):
+    @cli.command(name="media-warm")
+    @click.argument("files", type=click.Path(exists=True), nargs=-1)
+    @click.option(
+        "-m",
+        "--metadata",
+        type=click.File(),
+        help="Path to JSON/YAML file containing the plugin configuration",
+    )
+    @click.option("--media-type", required=True, help="Media type to warm")
+    @click.option("--keys-sql", help="SQL query returning the keys to warm")
+    @click.option(
+        "-w", "--width", "widths", type=int, multiple=True, help="Width to render"
+    )
+    @click.option(
+        "-f", "--format", "formats", multiple=True, help="Output format to render"
+    )
+    @click.option(
+        "-r", "--rendition", "renditions", multiple=True, help="Rendition to render"
+    )
+    @click.option(
+        "--cache-dir",
+        help="Directory to write to, defaults to the transform_cache_dir setting",
+    )
+    @click.option(
+        "--processes", type=int, help="Number of worker processes, defaults to CPUs"
+    )
+    def media_warm(
+        files,
+        metadata,
+        media_type,
+        keys_sql,
+        widths,
+        formats,
+        renditions,
+        cache_dir,
+        processes,
+    ):
+        "Pre-generate transformed images for a media type in the transform cache"
+        from datasette.app import Datasette
+        from datasette.utils import parse_metadata
+
+        datasette = Datasette(
+            files, metadata=parse_metadata(metadata.read()) if metadata else None
+        )
+        plugin_config = datasette.plugin_config("datasette-media") or {}
+        if media_type in RESERVED_MEDIA_TYPES or media_type not in plugin_config:
+            raise click.ClickException("Invalid media type: {}".format(media_type))
+        cache_dir = cache_dir or plugin_config.get("transform_cache_dir")
+        if not cache_dir:
+            raise click.ClickException(
+                "--cache-dir or the transform_cache_dir setting is required"
+            )
+        transform_cache = get_transform_cache(
+            dict(plugin_config, transform_cache_dir=cache_dir)
+        )
+
+        async def run():
+            try:
+                keys = await fetch_keys(datasette, media_type, keys_sql)
+            except ValueError as ex:
+                raise click.ClickException(str(ex))
+            with click.progressbar(length=len(keys), label="Warming") as bar:
+                return await warm_transform_cache(
+                    datasette,
+                    media_type,
+                    keys,
+                    transform_cache,
+                    widths=widths,
+                    formats=formats,
+                    renditions=renditions,
+                    processes=processes,
+                    progress=bar.update,
+                )
+
+        counts = asyncio.run(run())
+        click.echo(
+            "Rendered {rendered}, skipped {skipped} already cached, "
+            "{failed} failed".format(**counts)
+        )
+
+
+@hookimpl
+def extra_template_vars(datasette):
+    return {
+        "media_img": functools.partial(responsive.media_img, datasette),
+        "media_picture": functools.partial(responsive.media_picture, datasette),
+    }
+
+
+@hookimpl
+def render_cell(value, column, table, database, datasette):
+    # Media types can set render_cell to show a column of keys as images
+    if value is None:
+        return None
+    plugin_config = datasette.plugin_config("datasette-media") or {}
+    for media_type, config in plugin_config.items():
+        if media_type in RESERVED_MEDIA_TYPES or not isinstance(config, dict):
+            continue
+        render = config.get("render_cell")
+        if (
+            render
+            and render.get("table") == table
+            and render.get("column") == column
+            and (render.get("database") or config.get("database")) in (None, database)
+        ):
+            return responsive.media_img(
+                datasette, media_type, value, loading="lazy", alt=""
+            )
+    return None
+
+
+@hookimpl
+def startup(datasette):
+    def inner():
+        get_http_client(datasette)
+
+    return inner
+
+
+@hookimpl
+def asgi_wrapper(datasette):
+    # Close the shared HTTP client when the server shuts down
+    def wrap_with_shutdown(app):
+        async def wrapped(scope, receive, send):
+            if scope["type"] != "lifespan":
+                await app(scope, receive, send)
+                return
+
+            async def receive_with_shutdown():
+                message = await receive()
+                if message["type"] == "lifespan.shutdown":
+                    await close_http_client(datasette)
+                return message
+
+            await app(scope, receive_with_shutdown, send)
+
+        return wrapped
+
+    return wrap_with_shutdown
+
+
+def get_http_client(datasette):
+    if datasette not in http_clients:
+        plugin_config = datasette.plugin_config("datasette-media") or {}
+        http_clients[datasette] = MediaHttpClient(plugin_config.get("http_client"))
+    return http_clients[datasette]
+
+
+async def close_http_client(datasette):
+    client = http_clients.pop(datasette, None)
+    if client is not None:
+        await client.aclose()
+
+
+def get_single_flight(datasette):
+    if datasette not in single_flights:
+        single_flights[datasette] = SingleFlight()
+    return single_flights[datasette]
+
+
+def get_metrics(datasette):
+    if datasette not in media_metrics:
+        media_metrics[datasette] = Metrics()
+    return media_metrics[datasette]
+
+
+def get_admission_controller(datasette, media_type, config):
+    controllers = admission_controllers.setdefault(datasette, {})
+    if media_type not in controllers:
+        controllers[media_type] = AdmissionController(
+            max_in_flight=config.get("max_transforms_in_flight"),
+            max_queued=config.get("max_transforms_queued"),
+            max_pixels=config.get("max_transform_pixels"),
+        )
+    return controllers[media_type]
+
+
+def get_transform_cache(plugin_config):
+    directory = plugin_config.get("transform_cache_dir")
+    if not directory:
+        return None
+    if directory not in transform_caches:
+        transform_caches[directory] = DiskCache(
+            directory, max_size=plugin_config.get("transform_cache_max_size")
+        )
+    return transform_caches[directory]
+
+
+def get_upstream_cache(plugin_config):
+    directory = plugin_config.get("upstream_cache_dir")
+    if not directory:
+        return None
+    if directory not in upstream_caches:
+        upstream_caches[directory] = UpstreamCache(
+            directory, max_size=plugin_config.get("upstream_cache_max_size")
+        )
+    return upstream_caches[directory]
+
+
+def get_memory_cache(datasette, plugin_config):
+    max_size = plugin_config.get("memory_cache_max_size")
+    if not max_size:
+        return None
+    if datasette not in memory_caches:
+        memory_caches[datasette] = MemoryCache(
+            max_size,
+            ttl=plugin_config.get("memory_cache_ttl"),
+            max_item_size=plugin_config.get("memory_cache_max_item_size"),
+        )
+    return memory_caches[datasette]
+
+
+def get_row_cache(datasette, plugin_config):
+    size = plugin_config.get("row_cache_size")
+    if not size:
+        return None
+    if datasette not in row_caches:
+        row_caches[datasette] = RowCache(size, ttl=plugin_config.get("row_cache_ttl"))
+    return row_caches[datasette]
+
+
+def cache_response(memory_cache, memory_key, response):
+    if memory_cache is None or response.status != 200:
+        return
+    body = response.body
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    memory_cache.set(
+        memory_key, (response.content_type, dict(response.headers), body), len(body)
+    )
+
+
+def validator_headers(etag=None, last_modified=None, cache_control=None, vary=None):
+    headers = {}
+    if etag:
+        headers["etag"] = etag
+    if last_modified is not None:
+        headers["last-modified"] = utils.http_date(last_modified)
+    if cache_control:
+        headers["cache-control"] = cache_control
+    if vary:
+        headers["vary"] = vary
+    return headers
+
+
+def versioned_cache_control(request, version, fingerprint, cache_control):
+    # URLs from media_img() carry a ?v= version of their source, so
+    # responses for the current version can be cached forever. version is
+    # the row's version column, used if the SQL returns one.
+    if version is None and fingerprint:
+        version = utils.source_version(fingerprint)
+    if version is not None and request.args.get("v") == version:
+        return IMMUTABLE_CACHE_CONTROL
+    return cache_control
+
+
+def not_modified_response(headers):
+    return Response("", status=304, headers=headers)
+
+
+async def run_transform(plugin_config, fn, *args, **kwargs):
+    # Runs fn in the transform process pool if one is configured, otherwise
+    # in the transform thread pool
+    global transform_process_pool
+    processes = plugin_config.get("transform_processes")
+    if processes:
+        if transform_process_pool is None:
+            transform_process_pool = ProcessTransformPool(
+                processes, max_tasks=plugin_config.get("transform_process_max_tasks")
+            )
+        try:
+            return await transform_process_pool.run(fn, *args, **kwargs)
+        except BrokenProcessPool:
+            # A worker crashed, perhaps running some other task, so this is
+            # retried once in a fresh pool. It is never run in this process
+            # instead, where an image that crashed a worker could crash the
+            # server.
+            return await transform_process_pool.run(fn, *args, **kwargs)
+    return await transform_executor_tasks.run(transform_executor, fn, *args, **kwargs)
+
+
+async def transform_response(
+    plugin_config,
+    image_bytes,
+    filepath,
+    transform,
+    format_options=None,
+    timings=None,
+    limits=None,
+):
+    # timings, if provided, is a dict that gets the seconds spent in each
+    # stage of the work done by the worker. limits are the keyword arguments
+    # from utils.source_limits()
+    if timings is None:
+        timings = {}
+    # Encoding happens in the worker too, so the decoded image is released
+    # before the response is sent and the event loop never runs the encoder
+    body, content_type, worker_timings = await run_transform(
+        plugin_config,
+        utils.timed_render_image,
+        image_bytes,
+        filepath,
+        format_options,
+        **dict(limits or {}, **transform)
+    )
+    timings.update(worker_timings)
+    return Response(body, content_type=content_type)
+
+
+def rendition_transforms(row, config, request):
+    # The transforms for every named rendition, as should_transform() would
+    # return them for this request
+    transforms = []
+    for name in config.get("renditions") or {}:
+        rendition_request = Request.fake("/?" + urlencode({"rendition": name}))
+        rendition_request.scope["headers"] = request.scope.get("headers", [])
+        transforms.append(utils.should_transform(row, config, rendition_request))
+    return transforms
+
+
+async def send_blob(
+    send,
+    request,
+    database,
+    row,
+    blob,
+    size,
+    fingerprint,
+    content_filename,
+    cache_control,
+):
+    # Streams a BLOB from SQLite in chunks, so it is never held in memory
+    etag = utils.etag_for(fingerprint) if fingerprint else None
+    headers = validator_headers(etag, None, cache_control)
+    if utils.is_not_modified(request.headers, etag):
+        await not_modified_response(headers).asgi_send(send)
+        return
+    content_type = row["content_type"] if "content_type" in row.keys() else None
+    content_type = content_type or "application/octet-stream"
+    if content_filename:
+        headers["content-disposition"] = 'attachment; filename="{}"'.format(
+            content_filename
+        )
+    headers["accept-ranges"] = "bytes"
+
+    async def read(offset, length):
+        return await database.execute_fn(
+            lambda conn: read_blob(conn, *blob, offset, length)
+        )
+
+    ranges = utils.requested_ranges(request.headers, size, etag)
+    if ranges is not None:
+        await utils.send_ranges(send, read, ranges, size, content_type, headers)
+        return
+    await utils.send_stream(
+        send, read, size, content_type, headers, chunk_size=BLOB_CHUNK_SIZE
+    )
+
+
+async def relay_upstream(
+    send,
+    request,
+    response,
+    cache_control,
+    content_filename,
+    memory_cache=None,
+    memory_key=None,
+    writer=None,
+):
+    # Streams a content_url response from upstream to the client - and to
+    # writer, if it is being stored in the upstream cache
+    passthrough_headers = {
+        name: response.headers[name]
+        for name in (
+            "etag",
+            "last-modified",
+            "cache-control",
+            "accept-ranges",
+            "content-range",
+        )
+        if name in response.headers
+    }
+    if cache_control:
+        passthrough_headers["cache-control"] = cache_control
+    if response.status_code == 304:
+        await not_modified_response(passthrough_headers).asgi_send(send)
+        return
+    # Partial content and unsatisfiable range responses are relayed
+    status = response.status_code if response.status_code in (206, 416) else 200
+    content_type = response.headers.get("content-type", "application/octet-stream")
+    content_length = response.headers.get("content-length")
+    headers = [(b"content-type", content_type.encode("utf-8"))]
+    headers.extend(
+        (name.encode("utf-8"), value.encode("utf-8"))
+        for name, value in passthrough_headers.items()
+    )
+    if content_length:
+        headers.append((b"content-length", str(content_length).encode("utf-8")))
+    if content_filename:
+        headers.append(
+            (
+                b"content-disposition",
+                'attachment; filename="{}"'.format(content_filename).encode("utf-8"),
+            )
+        )
+
+    if status == 200 and utils.is_not_modified(
+        request.headers,
+        response.headers.get("etag"),
+        utils.parse_http_date(response.headers.get("last-modified")),
+    ):
+        # The client has this version already, but it may still be stored
+        await not_modified_response(passthrough_headers).asgi_send(send)
+        if writer is None:
+            return
+        send = None
+    else:
+        await send(
+            {
+                "type": "http.response.start",
+                "status": status,
+                "headers": headers,
+            }
+        )
+    # Small bodies are collected as they stream for the memory cache - only
+    # if upstream succeeded, since other statuses are relayed as 200
+    chunks = None
+    if (
+        memory_cache is not None
+        and send is not None
+        and response.status_code == 200
+        and content_length
+        and int(content_length) <= memory_cache.max_item_size
+    ):
+        chunks = []
+    loop = asyncio.get_event_loop()
+    try:
+        async for chunk in response.aiter_bytes():
+            if writer is not None and not await loop.run_in_executor(
+                None, writer.write, chunk
+            ):
+                # Too large for the cache
+                writer = None
+                if send is None:
+                    return
+            if chunks is not None:
+                chunks.append(chunk)
+            if send is not None:
+                await send(
+                    {
+                        "type": "http.response.body",
+                        "body": chunk,
+                        "more_body": True,
+                    }
+                )
+        if writer is not None:
+            await loop.run_in_executor(None, writer.commit)
+    except BaseException:
+        if writer is not None:
+            writer.abort()
+        raise
+    if send is None:
+        return
+    await send({"type": "http.response.body", "body": b""})
+    if chunks is not None:
+        cache_response(
+            memory_cache,
+            memory_key,
+            Response(
+                b"".join(chunks),
+                content_type=content_type,
+                headers={k.decode("utf-8"): v.decode("utf-8") for k, v in headers[1:]},
+            ),
+        )
+
+
+async def send_upstream_cached(
+    send,
+    request,
+    datasette,
+    upstream_cache,
+    content_url,
+    content_filename,
+    cache_control,
+    metrics,
+    media_type,
+    memory_cache=None,
+    memory_key=None,
+    cache_url=None,
+):
+    """
+    Serves content_url through the upstream cache, revalidating a stale copy
+    or storing the body as it streams to the client. Returns False if the
+    request should be forwarded to upstream instead. cache_url is the key
+    of the cached copy, if that is not just content_url.
+    """
+    cache_url = cache_url or content_url
+    entry = upstream_cache.get(cache_url)
+    if upstream_cache.is_fresh(entry):
+        metrics.incr(media_type, "upstream_cache_hits")
+    else:
+        if "range" in request.headers:
+            # Partial responses are not stored, so are fetched from upstream
+            return False
+        fetch_start = time.perf_counter()
+        async with get_http_client(datasette).stream(
+            "GET",
+            content_url,
+            headers=upstream_cache.revalidation_headers(entry),
+        ) as response:
+            metrics.observe(media_type, "fetch", time.perf_counter() - fetch_start)
+            if response.status_code == 304 and entry is not None:
+                metrics.incr(media_type, "upstream_cache_revalidations")
+                entry = await asyncio.get_event_loop().run_in_executor(
+                    None, upstream_cache.refresh, cache_url, entry, response.headers
+                )
+            else:
+                metrics.incr(media_type, "upstream_cache_misses")
+                writer = None
+                if response.status_code == 200:
+                    writer = upstream_cache.writer(cache_url, response.headers)
+                await relay_upstream(
+                    send,
+                    request,
+                    response,
+                    cache_control,
+                    content_filename,
+                    memory_cache,
+                    memory_key,
+                    writer,
+                )
+                return True
+    stored = entry["headers"]
+    etag = stored.get("etag")
+    last_modified = utils.parse_http_date(stored.get("last-modified"))
+    headers = {
+        name: stored[name]
+        for name in ("etag", "last-modified", "cache-control")
+        if name in stored
+    }
+    if cache_control:
+        headers["cache-control"] = cache_control
+    if utils.is_not_modified(request.headers, etag, last_modified):
+        await not_modified_response(headers).asgi_send(send)
+        return True
+    headers["accept-ranges"] = "bytes"
+    content_type = stored.get("content-type", "application/octet-stream")
+    ranges = utils.requested_ranges(request.headers, entry["size"], etag, last_modified)
+    if ranges is not None:
+        if content_filename:
+            headers["content-disposition"] = 'attachment; filename="{}"'.format(
+                content_filename
+            )
+        await utils.send_file_ranges(
+            send, entry["filepath"], ranges, entry["size"], content_type, headers
+        )
+        return True
+    await asgi_send_file(
+        send,
+        entry["filepath"],
+        filename=content_filename,
+        content_type=content_type,
+        headers=headers,
+    )
+    return True
+
+
+def upstream_cache_url(content_url, version):
+    # Each version of a row's content_url is cached separately, so a new
+    # version is never served from the copy of an older one
+    if version is None:
+        return content_url
+    return "{} {}".format(content_url, version)
+
+
+async def validate_upstream(
+    datasette, plugin_config, content_url, metrics, media_type, cache_url=None
+):
+    # The headers of a content_url to be transformed, and its body unless
+    # a fresh copy in the upstream cache has validators to identify it by
+    upstream_cache = get_upstream_cache(plugin_config)
+    if upstream_cache is not None:
+        entry = upstream_cache.get(cache_url or content_url)
+        if upstream_cache.is_fresh(entry) and (
+            "etag" in entry["headers"] or "last-modified" in entry["headers"]
+        ):
+            return entry["headers"], None
+    return await fetch_upstream(
+        datasette, plugin_config, content_url, metrics, media_type, cache_url
+    )
+
+
+async def fetch_upstream(
+    datasette, plugin_config, content_url, metrics, media_type, cache_url=None
+):
+    # Fetches a content_url body to be transformed, as (headers, body) - from
+    # the upstream cache if one is configured and its copy is still valid
+    cache_url = cache_url or content_url
+    client = get_http_client(datasette)
+    upstream_cache = get_upstream_cache(plugin_config)
+    if upstream_cache is None:
+        response = await client.get(content_url)
+        return response.headers, response.content
+    loop = asyncio.get_event_loop()
+    entry = upstream_cache.get(cache_url)
+    if upstream_cache.is_fresh(entry):
+        metrics.incr(media_type, "upstream_cache_hits")
+    else:
+        response = await client.get(
+            content_url, headers=upstream_cache.revalidation_headers(entry)
+        )
+        if response.status_code != 304 or entry is None:
+            metrics.incr(media_type, "upstream_cache_misses")
+            if response.status_code == 200:
+                await loop.run_in_executor(
+                    None,
+                    upstream_cache.set,
+                    cache_url,
+                    response.headers,
+                    response.content,
+                )
+            return response.headers, response.content
+        metrics.incr(media_type, "upstream_cache_revalidations")
+        entry = await loop.run_in_executor(
+            None, upstream_cache.refresh, cache_url, entry, response.headers
+        )
+
+    def read():
+        with open(entry["filepath"], "rb") as fp:
+            return fp.read()
+
+    try:
+        return entry["headers"], await loop.run_in_executor(None, read)
+    except FileNotFoundError:
+        # Evicted since it was looked up
+        response = await client.get(content_url)
+        return response.headers, response.content
+
+
+async def fetch_rows(database, config, keys):
+    # Rows for many keys at once, as a dictionary - using batch_sql if it is
+    # configured, otherwise running sql for each key in a single database call
+    batch_sql = config.get("batch_sql")
+    if batch_sql:
+        results = await database.execute(batch_sql, {"keys": json.dumps(keys)})
+        return {str(row["key"]): row for row in results.rows}
+
+    def fetch(conn):
+        rows = {}
+        for key in keys:
+            row = conn.execute(config["sql"], {"key": key}).fetchone()
+            if row is not None:
+                rows[key] = row
+        return rows
+
+    return await database.execute_fn(fetch)
+
+
+def batch_item_request(request, media_type, key, query_string):
+    # The request for a single item of a batch. Conditional and range
+    # headers apply to the batch response, so they are not passed on.
+    path = "/-/media/{}/{}".format(media_type, key)
+    scope = dict(
+        request.scope,
+        path=path,
+        raw_path=quote(path).encode("utf-8"),
+        query_string=query_string.encode("utf-8"),
+        url_route={"kwargs": {"media_type": media_type, "key": key}},
+        headers=[
+            (name, value)
+            for name, value in request.scope.get("headers") or []
+            if name.decode("latin-1").lower() not in CONDITIONAL_HEADERS
+        ],
+    )
+    return Request(scope, request.receive)
+
+
+async def serve_media_batch(datasette, request, send):
+    # Serves many keys of a media type as one multipart/mixed response, with
+    # a part for each key in the order they are ready
+    plugin_config = datasette.plugin_config("datasette-media") or {}
+    media_type = request.url_vars["media_type"]
+    config = plugin_config.get(media_type)
+    if media_type in RESERVED_MEDIA_TYPES or config is None:
+        return Response.html("<h1>Invalid media type</h1>", status=404)
+    if config.get("sql") is None:
+        return Response.html("<h1>Missing SQL from configuration</h1>", status=404)
+    keys = list(dict.fromkeys(request.args.getlist("key")))
+    max_batch_size = config.get("max_batch_size") or DEFAULT_MAX_BATCH_SIZE
+    if not keys:
+        return Response.html("<h1>400 - ?key= is required</h1>", status=400)
+    if len(keys) > max_batch_size:
+        return Response.html(
+            "<h1>400 - at most {} keys can be requested at once</h1>".format(
+                max_batch_size
+            ),
+            status=400,
+        )
+    database = datasette.get_database(config.get("database"))
+    rows = await fetch_rows(database, config, keys)
+    query_string = urlencode(
+        [
+            (name, value)
+            for name, value in parse_qsl(request.query_string, keep_blank_values=True)
+            if name != "key"
+        ]
+    )
+    semaphore = asyncio.Semaphore(
+        config.get("batch_concurrency") or DEFAULT_BATCH_CONCURRENCY
+    )
+
+    async def render(key):
+        item_request = batch_item_request(request, media_type, key, query_string)
+        if key not in rows:
+            return key, item_request, 404, {"content-type": "text/plain"}, b""
+        status = None
+        headers = {}
+        chunks = []
+
+        async def capture(event):
+            nonlocal status
+            if event["type"] == "http.response.start":
+                status = event["status"]
+                headers.update(response_headers(event))
+            elif event["type"] == "http.response.body":
+                chunks.append(event.get("body") or b"")
+
+        async with semaphore:
+            try:
+                await handle_media_request(datasette, item_request, capture, rows[key])
+            except Exception:
+                # One broken item should not end the whole response
+                return key, item_request, 500, {"content-type": "text/plain"}, b""
+        return key, item_request, status, headers, b"".join(chunks)
+
+    boundary = uuid.uuid4().hex
+    await send(
+        {
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [
+                (
+                    b"content-type",
+                    "multipart/mixed; boundary={}".format(boundary).encode("utf-8"),
+                )
+            ],
+        }
+    )
+    tasks = [asyncio.ensure_future(render(key)) for key in keys]
+    try:
+        for task in asyncio.as_completed(tasks):
+            key, item_request, status, headers, body = await task
+            part_headers = [
+                (
+                    "Content-Type",
+                    headers.get("content-type", "application/octet-stream"),
+                ),
+                ("Content-Location", item_request.full_path),
+                ("Content-Length", str(len(body))),
+                ("X-Media-Status", str(status)),
+            ]
+            part_headers.extend(
+                (name, headers[name.lower()])
+                for name in ("ETag", "Last-Modified")
+                if name.lower() in headers
+            )
+            part = "--{}\r\n{}\r\n\r\n".format(
+                boundary,
+                "\r\n".join(
+                    "{}: {}".format(name, value) for name, value in part_headers
+                ),
+            ).encode("utf-8")
+            await send(
+                {
+                    "type": "http.response.body",
+                    "body": part + body + b"\r\n",
+                    "more_body": True,
+                }
+            )
+    finally:
+        for task in tasks:
+            task.cancel()
+    await send(
+        {
+            "type": "http.response.body",
+            "body": "--{}--\r\n".format(boundary).encode("utf-8"),
+        }
+    )
+
+
+async def serve_media_zip(datasette, request, send):
+    # Streams every item selected by the media type's zip keys_sql - or the
+    # ?key= parameters - as a ZIP archive that is built as it is sent
+    plugin_config = datasette.plugin_config("datasette-media") or {}
+    media_type = request.url_vars["media_type"]
+    config = plugin_config.get(media_type)
+    if media_type in RESERVED_MEDIA_TYPES or config is None:
+        return Response.html("<h1>Invalid media type</h1>", status=404)
+    if config.get("sql") is None:
+        return Response.html("<h1>Missing SQL from configuration</h1>", status=404)
+    keys = list(dict.fromkeys(request.args.getlist("key")))
+    if not keys:
+        keys_sql = (config.get("zip") or {}).get("keys_sql")
+        if not keys_sql:
+            return Response.html(
+                "<h1>400 - ?key= is required if there is no zip keys_sql</h1>",
+                status=400,
+            )
+        # Named parameters in keys_sql come from the query string
+        params = {name: request.args.get(name) for name in request.args.keys()}
+        try:
+            keys = await fetch_keys(datasette, media_type, keys_sql, params)
+        except Exception as ex:
+            return Response.html(
+                "<h1>400 - {}</h1>".format(escape(str(ex))), status=400
+            )
+    database = datasette.get_database(config.get("database"))
+    query_string = urlencode(
+        [
+            (name, value)
+            for name, value in parse_qsl(request.query_string, keep_blank_values=True)
+            if name != "key"
+        ]
+    )
+    lookahead = config.get("batch_concurrency") or DEFAULT_BATCH_CONCURRENCY
+    archive = ZipStream()
+    used_names = set()
+    failures = []
+
+    async def flush():
+        data = archive.drain()
+        if data:
+            await send({"type": "http.response.body", "body": data, "more_body": True})
+
+    async def capture(item_request, row):
+        # Transformed images are rendered ahead of being written, so that
+        # several are in the executor at once
+        response = {"status": None, "headers": {}, "chunks": []}
+
+        async def capture_send(event):
+            if event["type"] == "http.response.start":
+                response["status"] = event["status"]
+                response["headers"] = response_headers(event)
+            elif event["type"] == "http.response.body":
+                response["chunks"].append(event.get("body") or b"")
+
+        await handle_media_request(datasette, item_request, capture_send, row)
+        return response
+
+    async def write_item(key, item_request, row, rendered):
+        filename = row["content_filename"] if "content_filename" in row.keys() else None
+        if rendered is not None:
+            try:
+                response = await rendered
+            except Exception:
+                failures.append((key, 500))
+                return
+            if response["status"] != 200:
+                failures.append((key, response["status"]))
+                return
+            archive.writestr(
+                archive_name(
+                    key, response["headers"].get("content-type"), filename, used_names
+                ),
+                b"".join(response["chunks"]),
+            )
+            await flush()
+            return
+        # Everything else is copied into the archive chunk by chunk
+        entry = None
+        status = None
+
+        async def write_send(event):
+            nonlocal entry, status
+            if event["type"] == "http.response.start":
+                status = event["status"]
+                if status == 200:
+                    headers = response_headers(event)
+                    size = headers.get("content-length")
+                    entry = archive.open(
+                        archive_name(
+                            key, headers.get("content-type"), filename, used_names
+                        ),
+                        int(size) if size else None,
+                    )
+            elif event["type"] == "http.response.body" and entry is not None:
+                entry.write(event.get("body") or b"")
+                await flush()
+
+        try:
+            await handle_media_request(datasette, item_request, write_send, row)
+        except Exception:
+            if entry is not None:
+                # Part of the item has been sent - the archive cannot be fixed
+                raise
+            status = 500
+        if entry is not None:
+            entry.close()
+            await flush()
+        else:
+            failures.append((key, status))
+
+    await send(
+        {
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [
+                (b"content-type", b"application/zip"),
+                (
+                    b"content-disposition",
+                    'attachment; filename="{}.zip"'.format(media_type).encode("utf-8"),
+                ),
+            ],
+        }
+    )
+    pending = []
+    try:
+        for offset in range(0, len(keys), DEFAULT_MAX_BATCH_SIZE):
+            batch_keys = keys[offset : offset + DEFAULT_MAX_BATCH_SIZE]
+            rows = await fetch_rows(database, config, batch_keys)
+            for key in batch_keys:
+                if key not in rows:
+                    failures.append((key, 404))
+                    continue
+                item_request = batch_item_request(
+                    request, media_type, key, query_string
+                )
+                rendered = None
+                try:
+                    if utils.should_transform(rows[key], config, item_request):
+                        rendered = asyncio.ensure_future(
+                            capture(item_request, rows[key])
+                        )
+                except ValueError:
+                    pass
+                pending.append((key, item_request, rows[key], rendered))
+                while len(pending) > lookahead or (pending and pending[0][3] is None):
+                    await write_item(*pending.pop(0))
+        while pending:
+            await write_item(*pending.pop(0))
+        if failures:
+            archive.writestr(
+                archive_name("errors", filename="errors.txt", used=used_names),
+                "".join(
+                    "{}\t{}\n".format(key, status) for key, status in failures
+                ).encode("utf-8"),
+            )
+        archive.close()
+    finally:
+        for _, _, _, rendered in pending:
+            if rendered is not None:
+                rendered.cancel()
+    await send({"type": "http.response.body", "body": archive.drain()})
+
+
+def response_headers(event):
+    return {
+        name.decode("latin-1").lower(): value.decode("latin-1")
+        for name, value in event.get("headers") or []
+    }
+
+
+async def media_stats(datasette, request):
+    if not await datasette.permission_allowed(
+        request.actor, "view-instance", default=True
+    ):
+        raise Forbidden("view-instance")
+    plugin_config = datasette.plugin_config("datasette-media") or {}
+    metrics = get_metrics(datasette)
+    memory_cache = get_memory_cache(datasette, plugin_config)
+    transforms = {
+        media_type: {
+            "in_flight": controller.in_flight,
+            "queued": controller.queued,
+            "pixels": controller.pixels,
+            "rejected": controller.rejected,
+        }
+        for media_type, controller in sorted(
+            admission_controllers.get(datasette, {}).items()
+        )
+    }
+    # Every media type shares the transform threads and processes
+    executor = {
+        "queued": transform_executor_tasks.queued,
+        "running": transform_executor_tasks.running,
+    }
+    if transform_process_pool is not None:
+        executor["queued"] += transform_process_pool.pending.queued
+        executor["running"] += transform_process_pool.pending.running
+    if request.args.get("format") == "prometheus":
+        gauges = [
+            ("transform_executor_{}".format(name), {}, value)
+            for name, value in executor.items()
+        ]
+        for media_type, values in transforms.items():
+            for name, value in values.items():
+                gauges.append(
+                    ("transforms_{}".format(name), {"media_type": media_type}, value)
+                )
+        if memory_cache is not None:
+            for name, value in memory_cache.stats().items():
+                gauges.append(("memory_cache_{}".format(name), {}, value))
+        return Response(
+            metrics.prometheus(gauges),
+            content_type="text/plain; version=0.0.4; charset=utf-8",
+        )
+    media_types = metrics.as_dict()
+    for media_type, values in transforms.items():
+        media_types.setdefault(media_type, {"counters": {}, "timings": {}})[
+            "transforms"
+        ] = values
+    return Response.json(
+        {
+            "media_types": media_types,
+            "transform_executor": executor,
+            "memory_cache": memory_cache.stats() if memory_cache else None,
+        }
+    )
+
+
 async def serve_media(datasette, request, send):
+    return await handle_media_request(datasette, request, send)
+
+
+async def handle_media_request(datasette, request, send, row=None):
+    # Records the status, size and duration of every response for a
+    # configured media type. row is provided if it has already been fetched.
+    plugin_config = datasette.plugin_config("datasette-media") or {}
+    media_type = request.url_vars["media_type"]
+    if media_type in RESERVED_MEDIA_TYPES or media_type not in plugin_config:
+        return await _serve_media(datasette, request, send, None)
+    metrics = get_metrics(datasette)
+    status = None
+    sent = 0
+
+    async def send_and_count(event):
+        nonlocal status, sent
+        if event["type"] == "http.response.start":
+            status = event["status"]
+        elif event["type"] == "http.response.body":
+            sent += len(event.get("body") or b"")
+        await send(event)
+
+    start = time.perf_counter()
+    try:
+        response = await _serve_media(datasette, request, send_and_count, metrics, row)
+        if response is not None:
+            await response.asgi_send(send_and_count)
+    finally:
+        metrics.observe(media_type, "total", time.perf_counter() - start)
+        metrics.incr(media_type, "requests")
+        metrics.incr(media_type, "bytes_sent", sent)
+        if status is None or status >= 500:
+            metrics.incr(media_type, "server_errors")
+        elif status >= 400:
+            metrics.incr(media_type, "client_errors")
+        elif status == 304:
+            metrics.incr(media_type, "not_modified")
+        elif status == 206:
+            metrics.incr(media_type, "partial_content")
+
+
+async def _serve_media(datasette, request, send, metrics, row=None):
     global transform_executor
     plugin_config = datasette.plugin_config("datasette-media") or {}
     pool_size = plugin_config.get("transform_threads") or 4
@@ -37,121 +1159,481 @@ async def serve_media(datasette, request, send):
     sql = config.get("sql")
     if sql is None:
         return Response.html("<h1>Missing SQL from configuration</h1>", status=404)
+
+    memory_cache = get_memory_cache(datasette, plugin_config)
+    memory_key = None
+    if memory_cache is not None:
+        memory_key = (
+            (media_type, key)
+            + tuple(
+                request.args.get(arg) for arg in ("w", "h", "format", "rendition", "v")
+            )
+            + (utils.negotiate_format(config, request),)
+        )
+        cached = memory_cache.get(memory_key)
+        metrics.incr(
+            media_type, "memory_cache_hits" if cached else "memory_cache_misses"
+        )
+        if cached is not None:
+            cached_content_type, cached_headers, cached_body = cached
+            if utils.is_not_modified(
+                request.headers,
+                cached_headers.get("etag"),
+                utils.parse_http_date(cached_headers.get("last-modified")),
+            ):
+                return not_modified_response(
+                    {
+                        k: v
+                        for k, v in cached_headers.items()
+                        if k in ("etag", "last-modified", "cache-control", "vary")
+                    }
+                )
+            ranges = utils.requested_ranges(
+                request.headers,
+                len(cached_body),
+                cached_headers.get("etag"),
+                utils.parse_http_date(cached_headers.get("last-modified")),
+            )
+            if ranges is not None:
+                return utils.bytes_range_response(
+                    cached_body, ranges, cached_content_type, cached_headers
+                )
+            return Response(
+                cached_body,
+                content_type=cached_content_type,
+                headers=dict(cached_headers, **{"accept-ranges": "bytes"}),
+            )
+
+    # Identical concurrent requests share the query, fetch and transform
+    flights = get_single_flight(datasette)
     database = datasette.get_database(config.get("database"))
-    results = await database.execute(sql, {"key": key})
-    row = results.first()
+    row_cache = get_row_cache(datasette, plugin_config)
+    version = None
+    if row is None and row_cache is not None:
+        if not database.is_mutable:
+            version = "immutable"
+        elif not database.is_memory:
+            # Read before the query, so a write during it leaves a stale entry
+            version = utils.database_version(database.path)
+        if version is not None:
+            row = row_cache.get((media_type, key), version)
+            metrics.incr(media_type, "row_cache_hits" if row else "row_cache_misses")
     if row is None:
-        return Response.html("<h1>404 - no results</h1>", status=404)
+        with metrics.timer(media_type, "sql"):
+            results = await flights.run(
+                ("sql", database.name, sql, key),
+                lambda: database.execute(sql, {"key": key}),
+            )
+        row = results.first()
+        if row is None:
+            return Response.html("<h1>404 - no results</h1>", status=404)
+        # A dict, so each column lookup below is a hash lookup rather than
+        # a search of the row's column names
+        row = dict(row)
+        if version is not None:
+            row_cache.set((media_type, key), version, row)
 
     # We need filepath or content
-    content = None
     content_type = None
-    content_url = None
     content_filename = None
-    filepath = None
 
-    row_keys = row.keys()
-    if (
-        "filepath" not in row_keys
-        and "content" not in row_keys
-        and "content_url" not in row_keys
-    ):
+    shape = utils.shape_of(row)
+    blob = row_blob(row, shape)
+    source = utils.row_source(row, shape)
+    row_version = utils.row_version(row, shape)
+    if source is None and blob is None:
         return Response.html(
             "<h1>404 - SQL must return 'filepath' or 'content' or 'content_url'</h1>",
             status=404,
         )
-    if "content" in row_keys:
-        content = row["content"]
-    elif "content_url" in row_keys:
-        content_url = row["content_url"]
-    else:
-        filepath = row["filepath"]
+    filepath, content, content_url = source or (None, None, None)
 
-    if "content_filename" in row_keys:
+    if "content_filename" in shape.columns:
         content_filename = row["content_filename"]
 
     # Images are special cases, triggered by a few different conditions
-    should_transform = utils.should_transform(row, config, request)
+    try:
+        should_transform = utils.should_transform(row, config, request, shape)
+    except ValueError as ex:
+        return Response.html("<h1>400 - {}</h1>".format(escape(str(ex))), status=400)
+
+    # Validators for files and BLOBs are available before any transform work
+    cache_control = config.get("cache_control")
+    # Transformed images may be negotiated based on the Accept header
+    vary = None
+    if should_transform and config.get("enable_transform"):
+        vary = "Accept" if config.get("negotiate_formats") else None
+    fingerprint = None
+    etag = None
+    last_modified = None
+    if blob is not None:
+        size = await database.execute_fn(lambda conn: blob_size(conn, *blob))
+        if size is None:
+            return Response.html("<h1>404 - no results</h1>", status=404)
+        fingerprint = blob_fingerprint(database.path, *blob, size, row_version)
+        cache_control = versioned_cache_control(
+            request, row_version, fingerprint, cache_control
+        )
+        if should_transform:
+            if fingerprint is None:
+                # In-memory databases have no version, so the content is hashed
+                content = await database.execute_fn(
+                    lambda conn: read_blob(conn, *blob, 0, size)
+                )
+        else:
+            with metrics.timer(media_type, "blob"):
+                await send_blob(
+                    send,
+                    request,
+                    database,
+                    row,
+                    blob,
+                    size,
+                    fingerprint,
+                    content_filename,
+                    cache_control,
+                )
+            return
+    file_stat = None
+    if filepath:
+        # Stat once, for the fingerprint, Last-Modified and Content-Length,
+        # and off the event loop since files may be on a network mount
+        file_stat = await asyncio.get_event_loop().run_in_executor(
+            None, os.stat, filepath
+        )
+    if fingerprint is None and (filepath or content):
+        fingerprint = utils.source_fingerprint(filepath, content, stat=file_stat)
+        if blob is None:
+            cache_control = versioned_cache_control(
+                request, row_version, fingerprint, cache_control
+            )
+    elif content_url:
+        cache_control = versioned_cache_control(
+            request, row_version, None, cache_control
+        )
+        if should_transform:
+            # Identified by its upstream validators, so that the ETag and
+            # transform cache key change when the upstream file does
+            with metrics.timer(media_type, "fetch"):
+                upstream_headers, content = await flights.run(
+                    ("validate", content_url),
+                    lambda: validate_upstream(
+                        datasette,
+                        plugin_config,
+                        content_url,
+                        metrics,
+                        media_type,
+                        upstream_cache_url(content_url, row_version),
+                    ),
+                )
+            fingerprint = utils.url_fingerprint(
+                content_url, upstream_headers, content, row_version
+            )
+            content_type = upstream_headers.get("content-type")
+            last_modified = utils.parse_http_date(upstream_headers.get("last-modified"))
+    if fingerprint is not None:
+        etag = utils.etag_for(fingerprint, should_transform)
+        if filepath:
+            last_modified = file_stat.st_mtime
+        if utils.is_not_modified(request.headers, etag, last_modified):
+            return not_modified_response(
+                validator_headers(etag, last_modified, cache_control, vary)
+            )
+
     if should_transform:
+        transform_cache = get_transform_cache(plugin_config)
+        transform_key = cache_key(media_type, key, fingerprint, should_transform)
+        if transform_cache is not None:
+            # get() touches the file, so that is kept off the event loop too
+            cached = await asyncio.get_event_loop().run_in_executor(
+                None, transform_cache.get, transform_key
+            )
+            metrics.incr(
+                media_type,
+                "transform_cache_hits" if cached else "transform_cache_misses",
+            )
+            if cached is not None:
+                cached_filepath, extension = cached
+                with metrics.timer(media_type, "file"):
+                    await asgi_send_file(
+                        send,
+                        cached_filepath,
+                        filename=content_filename,
+                        content_type="image/{}".format(extension),
+                        headers=validator_headers(
+                            etag, last_modified, cache_control, vary
+                        ),
+                    )
+                return
+        if content is None and blob is not None:
+            # Only read once a transform is known to be needed
+            content = await database.execute_fn(
+                lambda conn: read_blob(conn, *blob, 0, size)
+            )
         if content is None and content_url:
-            async with httpx.AsyncClient() as client:
-                response = await client.get(row["content_url"])
-                content = response.content
-                content_type = response.headers["content-type"]
-        image_bytes = content or open(filepath, "rb").read()
-        image = await asyncio.get_event_loop().run_in_executor(
-            transform_executor,
-            lambda: utils.transform_image(image_bytes, **should_transform),
-        )
-        response = utils.ImageResponse(image, format=should_transform.get("format"))
+            # A fresh copy in the upstream cache, only read now that it needs
+            # transforming
+            with metrics.timer(media_type, "fetch"):
+                _, content = await flights.run(
+                    ("fetch", content_url),
+                    lambda: fetch_upstream(
+                        datasette,
+                        plugin_config,
+                        content_url,
+                        metrics,
+                        media_type,
+                        upstream_cache_url(content_url, row_version),
+                    ),
+                )
+
+        admission = get_admission_controller(datasette, media_type, config)
+
+        async def render():
+            pixels = 0
+            if admission.max_pixels:
+                size = await asyncio.get_event_loop().run_in_executor(
+                    None, lambda: utils.image_size(content or None, filepath)
+                )
+                if size:
+                    pixels = size[0] * size[1]
+            start = time.perf_counter()
+            timings = {}
+            # Other renditions of this source that are missing from the cache
+            batch = {}
+            outputs = []
+            if transform_cache is not None and config.get("batch_renditions"):
+                for transform in rendition_transforms(row, config, request):
+                    batch_key = cache_key(media_type, key, fingerprint, transform)
+                    if batch_key != transform_key:
+                        batch[batch_key] = transform
+                cached_keys = await asyncio.get_event_loop().run_in_executor(
+                    None,
+                    lambda: [
+                        batch_key
+                        for batch_key in batch
+                        if transform_cache.get(batch_key) is not None
+                    ],
+                )
+                for batch_key in cached_keys:
+                    del batch[batch_key]
+            async with admission.admit(pixels):
+                admitted = time.perf_counter()
+                if batch:
+                    outputs, worker_timings = await run_transform(
+                        plugin_config,
+                        utils.render_images,
+                        content or None,
+                        filepath,
+                        config.get("format_options"),
+                        [should_transform] + list(batch.values()),
+                        **utils.source_limits(config)
+                    )
+                    timings.update(worker_timings)
+                    rendered = Response(outputs[0][0], content_type=outputs[0][1])
+                else:
+                    rendered = await transform_response(
+                        plugin_config,
+                        content or None,
+                        filepath,
+                        should_transform,
+                        config.get("format_options"),
+                        timings,
+                        utils.source_limits(config),
+                    )
+                finished = time.perf_counter()
+            metrics.observe(media_type, "admission", admitted - start)
+            # Waiting for a worker, plus moving data to and from processes
+            metrics.observe(
+                media_type,
+                "queue",
+                max(finished - admitted - sum(timings.values()), 0),
+            )
+            for stage, seconds in timings.items():
+                metrics.observe(media_type, stage, seconds)
+            metrics.incr(media_type, "transforms")
+            if transform_cache is not None:
+                with metrics.timer(media_type, "cache_write"):
+                    await transform_executor_tasks.run(
+                        transform_executor,
+                        transform_cache.set,
+                        transform_key,
+                        rendered.body,
+                        rendered.content_type.split("/")[-1],
+                    )
+                    for batch_key, (body, content_type) in zip(batch, outputs[1:]):
+                        await transform_executor_tasks.run(
+                            transform_executor,
+                            transform_cache.set,
+                            batch_key,
+                            body,
+                            content_type.split("/")[-1],
+                        )
+            return rendered
+
+        try:
+            rendered = await flights.run(("transform", transform_key), render)
+        except BrokenProcessPool:
+            metrics.incr(media_type, "transform_crashes")
+            return Response.html(
+                "<h1>500 - the transform worker process crashed</h1>", status=500
+            )
+        except utils.SourceTooLarge as ex:
+            metrics.incr(media_type, "source_too_large")
+            return Response.html(
+                "<h1>422 - {}</h1>".format(escape(str(ex))), status=422
+            )
+        except Overloaded:
+            if config.get("overload") != "original":
+                return Response.html(
+                    "<h1>503 - too many images are being transformed</h1>",
+                    status=503,
+                    headers={"retry-after": str(config.get("retry_after", 1))},
+                )
+            # Serve the untransformed original, which must not be cached
+            # under this URL
+            headers = {"cache-control": "no-store"}
+            if content_filename:
+                headers["content-disposition"] = 'attachment; filename="{}"'.format(
+                    content_filename
+                )
+            if filepath:
+                await asgi_send_file(
+                    send,
+                    filepath,
+                    content_type=guess_type(filepath)[0],
+                    headers=headers,
+                )
+                return
+            if content_type is None and "content_type" in shape.columns:
+                content_type = row["content_type"]
+            if content_type is None:
+                image_type = utils.image_type_for_bytes(content)
+                content_type = "image/{}".format(image_type) if image_type else None
+            return Response(
+                content,
+                content_type=content_type or "application/octet-stream",
+                headers=headers,
+            )
+        # Each request gets its own copy, since headers are added below
+        response = Response(
+            rendered.body,
+            content_type=rendered.content_type,
+            headers=dict(rendered.headers),
+        )
+        response.headers.update(
+            validator_headers(etag, last_modified, cache_control, vary)
+        )
         if content_filename:
-            response.headers[
-                "content-disposition"
-            ] = 'attachment; filename="{}"'.format(content_filename)
+            response.headers["content-disposition"] = (
+                'attachment; filename="{}"'.format(content_filename)
+            )
+        cache_response(memory_cache, memory_key, response)
         return response
     else:
         # content_url is proxied as a special case
         if content_url:
-            client = httpx.AsyncClient()
-            async with client.stream("GET", content_url) as response:
-                content_type = response.headers["content-type"]
-                content_length = response.headers.get("content-length")
-                headers = [(b"content-type", content_type.encode("utf-8"))]
-                if content_length:
-                    headers.append(
-                        (b"content-length", str(content_length).encode("utf-8"))
-                    )
-                if content_filename:
-                    headers.append(
-                        (
-                            b"content-disposition",
-                            'attachment; filename="{}"'.format(content_filename).encode(
-                                "utf-8"
-                            ),
-                        )
-                    )
-
-                await send(
-                    {"type": "http.response.start", "status": 200, "headers": headers}
-                )
-                async for chunk in response.aiter_bytes():
-                    await send(
-                        {
-                            "type": "http.response.body",
-                            "body": chunk,
-                            "more_body": True,
-                        }
-                    )
-                await send({"type": "http.response.body", "body": b""})
+            upstream_cache = get_upstream_cache(plugin_config)
+            if upstream_cache is not None and await send_upstream_cached(
+                send,
+                request,
+                datasette,
+                upstream_cache,
+                content_url,
+                content_filename,
+                cache_control,
+                metrics,
+                media_type,
+                memory_cache,
+                memory_key,
+                upstream_cache_url(content_url, row_version),
+            ):
                 return
+            client = get_http_client(datasette)
+            # Conditional and range requests are forwarded to upstream
+            upstream_headers = {
+                name: request.headers[name]
+                for name in CONDITIONAL_HEADERS
+                if name in request.headers
+            }
+            fetch_start = time.perf_counter()
+            async with client.stream(
+                "GET", content_url, headers=upstream_headers
+            ) as response:
+                metrics.observe(media_type, "fetch", time.perf_counter() - fetch_start)
+                await relay_upstream(
+                    send,
+                    request,
+                    response,
+                    cache_control,
+                    content_filename,
+                    memory_cache,
+                    memory_key,
+                )
+            return
 
-        if "content_type" in row_keys:
+        if "content_type" in shape.columns:
             content_type = row["content_type"]
 
         # Non-image files are returned directly
         if filepath:
-            await asgi_send_file(
-                send,
-                filepath,
-                filename=content_filename,
-                content_type=content_type or guess_type(filepath)[0],
-            )
+            content_type = content_type or guess_type(filepath)[0]
+            headers = validator_headers(etag, last_modified, cache_control)
+            headers["accept-ranges"] = "bytes"
+            size = file_stat.st_size
+            ranges = utils.requested_ranges(request.headers, size, etag, last_modified)
+            if ranges is not None:
+                if content_filename:
+                    headers["content-disposition"] = 'attachment; filename="{}"'.format(
+                        content_filename
+                    )
+                with metrics.timer(media_type, "file"):
+                    await utils.send_file_ranges(
+                        send,
+                        filepath,
+                        ranges,
+                        size,
+                        content_type or "application/octet-stream",
+                        headers,
+                    )
+                return
+            with metrics.timer(media_type, "file"):
+                await asgi_send_file(
+                    send,
+                    filepath,
+                    filename=content_filename,
+                    content_type=content_type,
+                    headers=headers,
+                )
         else:
             status_code = 200
+            headers = validator_headers(etag, last_modified, cache_control)
             if not content:
                 status_code = 404
                 content = PNG_1x1
                 content_type = "application/png"
                 content_filename = None
-            return Response(
-                content,
-                content_type=content_type or "application/octet-stream",
-                headers={
-                    "content-disposition": 'attachment; filename="{}"'.format(
-                        content_filename
+                headers = {}
+            if content_filename:
+                headers["content-disposition"] = 'attachment; filename="{}"'.format(
+                    content_filename
+                )
+            content_type = content_type or "application/octet-stream"
+            if status_code == 200:
+                if isinstance(content, str):
+                    content = content.encode("utf-8")
+                ranges = utils.requested_ranges(
+                    request.headers, len(content), etag, last_modified
+                )
+                if ranges is not None:
+                    return utils.bytes_range_response(
+                        content, ranges, content_type, headers
                     )
-                }
-                if content_filename
-                else None,
+                headers["accept-ranges"] = "bytes"
+            response = Response(
+                content,
+                content_type=content_type,
+                headers=headers,
                 status=status_code,
             )
+            cache_response(memory_cache, memory_key, response)
+            return response
@@ -0,0 +1,59 @@
+import asyncio
+import contextlib
+
+
+class Overloaded(Exception):
+    pass
+
+
+class AdmissionController:
+    """
+    Bounds the transforms running for a media type, by count and by the total
+    number of decoded pixels, with a bounded queue of waiting requests.
+    """
+
+    def __init__(self, max_in_flight=None, max_queued=None, max_pixels=None):
+        self.max_in_flight = max_in_flight
+        self.max_queued = max_queued
+        self.max_pixels = max_pixels
+        self.in_flight = 0
+        self.queued = 0
+        self.pixels = 0
+        self.rejected = 0
+        self._condition = None
+
+    def _can_run(self, pixels):
+        if self.max_in_flight and self.in_flight >= self.max_in_flight:
+            return False
+        # A single image over the budget can still run on its own
+        if (
+            self.max_pixels
+            and self.in_flight
+            and self.pixels + pixels > self.max_pixels
+        ):
+            return False
+        return True
+
+    @contextlib.asynccontextmanager
+    async def admit(self, pixels=0):
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        async with self._condition:
+            if not self._can_run(pixels):
+                if self.max_queued is not None and self.queued >= self.max_queued:
+                    self.rejected += 1
+                    raise Overloaded()
+                self.queued += 1
+                try:
+                    await self._condition.wait_for(lambda: self._can_run(pixels))
+                finally:
+                    self.queued -= 1
+            self.in_flight += 1
+            self.pixels += pixels
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self.in_flight -= 1
+                self.pixels -= pixels
+                self._condition.notify_all()
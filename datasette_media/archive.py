@@ -0,0 +1,67 @@
+from mimetypes import guess_extension, guess_type
+import os
+import time
+import zipfile
+
+
+class ZipStream:
+    """
+    Builds a ZIP archive incrementally without seeking, so it can be sent
+    while it is being written. drain() returns the bytes written so far.
+    """
+
+    def __init__(self):
+        self._chunks = []
+        # zipfile uses data descriptors for streams that cannot seek or tell
+        self.zipfile = zipfile.ZipFile(self, mode="w", compression=zipfile.ZIP_STORED)
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+    def open(self, name, size=None):
+        "Opens a new entry for writing - size is the expected size, if known"
+        info = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+        info.compress_type = zipfile.ZIP_STORED
+        if size is not None:
+            info.file_size = size
+        return self.zipfile.open(info, mode="w", force_zip64=size is None)
+
+    def writestr(self, name, data):
+        with self.open(name, len(data)) as entry:
+            entry.write(data)
+
+    def close(self):
+        self.zipfile.close()
+
+
+def archive_name(key, content_type=None, filename=None, used=None):
+    # A safe, unique name within the archive for an item
+    content_type = (content_type or "").split(";")[0].strip().lower()
+    extension = guess_extension(content_type) if content_type else None
+    if extension == ".jpe":
+        extension = ".jpg"
+    name = os.path.basename((filename or "").replace("\\", "/"))
+    if not name or name in (".", ".."):
+        name = str(key).replace("/", "_").replace("\\", "_").lstrip(".") or "item"
+        name += extension or ""
+    elif extension and guess_type(name)[0] != content_type:
+        # For example photo.heic served as image/jpeg after a transform
+        name = os.path.splitext(name)[0] + extension
+    if used is not None:
+        base, extension = os.path.splitext(name)
+        candidate, suffix = name, 1
+        while candidate in used:
+            suffix += 1
+            candidate = "{}-{}{}".format(base, suffix, extension)
+        used.add(candidate)
+        name = candidate
+    return name
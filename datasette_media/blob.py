@@ -0,0 +1,66 @@
+from datasette.utils import escape_sqlite
+from .utils import database_version, shape_of
+
+# Size of each read from SQLite when streaming a BLOB
+BLOB_CHUNK_SIZE = 256 * 1024
+
+
+def row_blob(row, shape=None):
+    # Returns (table, column, rowid) if the SQL identified a BLOB to be read
+    # incrementally, rather than returning its content, or None
+    if not (shape or shape_of(row)).blob:
+        return None
+    return row["content_table"], row["content_column"], row["content_rowid"]
+
+
+def blob_size(conn, table, column, rowid):
+    "Length of the BLOB in bytes, or None if there is no such row"
+    blobopen = getattr(conn, "blobopen", None)
+    if blobopen is not None:
+        try:
+            with blobopen(table, column, rowid, readonly=True) as blob:
+                return len(blob)
+        except conn.OperationalError:
+            # No such rowid - or a NULL or non-BLOB value
+            pass
+    row = conn.execute(
+        "select length(cast({} as blob)) from {} where rowid = ?".format(
+            escape_sqlite(column), escape_sqlite(table)
+        ),
+        [rowid],
+    ).fetchone()
+    if row is None or row[0] is None:
+        return None
+    return row[0]
+
+
+def read_blob(conn, table, column, rowid, offset, length):
+    "Reads length bytes of the BLOB starting at offset"
+    blobopen = getattr(conn, "blobopen", None)
+    if blobopen is not None:
+        with blobopen(table, column, rowid, readonly=True) as blob:
+            blob.seek(offset)
+            return blob.read(length)
+    # Python < 3.11 - substr() still only copies the requested bytes
+    row = conn.execute(
+        "select substr(cast({} as blob), ?, ?) from {} where rowid = ?".format(
+            escape_sqlite(column), escape_sqlite(table)
+        ),
+        [offset + 1, length, rowid],
+    ).fetchone()
+    return row[0] if row is not None else b""
+
+
+def blob_fingerprint(path, table, column, rowid, size, version=None):
+    # Identifies the current version of the BLOB without reading it. Unless
+    # the row has its own version, that changes with any write to the
+    # database.
+    if version is not None:
+        return "blob:{}:{}:{}:{}:{}:v:{}".format(
+            path, table, column, rowid, size, version
+        )
+    if path is None:
+        return None
+    return "blob:{}:{}:{}:{}:{}:{}".format(
+        path, database_version(path), table, column, rowid, size
+    )
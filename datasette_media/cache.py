@@ -0,0 +1,430 @@
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from .utils import PILLOW_FORMATS, parse_http_date
+
+DEFAULT_CACHE_MAX_SIZE = 500 * 1024 * 1024
+DEFAULT_MEMORY_CACHE_TTL = 60
+DEFAULT_MEMORY_CACHE_MAX_ITEM_SIZE = 1024 * 1024
+
+# Upstream response headers kept with cached content_url bodies
+UPSTREAM_HEADERS = ("content-type", "etag", "last-modified", "cache-control", "expires")
+
+_extension_re = re.compile(r"^[a-z0-9]+$")
+
+
+def cache_key(media_type, key, fingerprint, transform):
+    # Stable key combining the media type, key, source identity and the
+    # normalized transform options returned by utils.should_transform()
+    return hashlib.sha256(
+        json.dumps(
+            [media_type, key, fingerprint, transform], sort_keys=True, default=str
+        ).encode("utf-8")
+    ).hexdigest()
+
+
+class DiskCache:
+    "Size-limited on-disk cache of rendered media, evicted least-recently-used first"
+
+    def __init__(self, directory, max_size=None):
+        self.directory = str(directory)
+        self.max_size = max_size or DEFAULT_CACHE_MAX_SIZE
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._total_size = 0
+        os.makedirs(self.directory, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        existing = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.startswith(".") and "." in entry.name:
+                stat = entry.stat()
+                existing.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, name, size in sorted(existing):
+            key, extension = name.split(".", 1)
+            self._entries[key] = (extension, size)
+            self._total_size += size
+
+    def _filepath(self, key, extension):
+        return os.path.join(self.directory, "{}.{}".format(key, extension))
+
+    def get(self, key):
+        "Returns (filepath, extension) for a cached entry, or None"
+        with self._lock:
+            if key not in self._entries and not self._adopt(key):
+                return None
+            self._entries.move_to_end(key)
+            extension, _ = self._entries[key]
+        filepath = self._filepath(key, extension)
+        try:
+            # mtime records recency of use, so LRU order survives restarts
+            os.utime(filepath)
+        except FileNotFoundError:
+            with self._lock:
+                if key in self._entries:
+                    self._total_size -= self._entries.pop(key)[1]
+            return None
+        return filepath, extension
+
+    def _adopt(self, key):
+        # Looks on disk for an entry written by another process - such as
+        # datasette media-warm - since this one was loaded
+        for extension in PILLOW_FORMATS:
+            try:
+                size = os.stat(self._filepath(key, extension)).st_size
+            except FileNotFoundError:
+                continue
+            self._entries[key] = (extension, size)
+            self._total_size += size
+            self._evict()
+            return key in self._entries
+        return False
+
+    def set(self, key, body, extension):
+        extension = extension.lower()
+        if not _extension_re.match(extension):
+            raise ValueError("Invalid extension: {}".format(extension))
+        filepath = self._filepath(key, extension)
+        tmp_filepath = os.path.join(
+            self.directory, ".{}.{}.tmp".format(key, uuid.uuid4().hex)
+        )
+        with open(tmp_filepath, "wb") as fp:
+            fp.write(body)
+        os.replace(tmp_filepath, filepath)
+        with self._lock:
+            if key in self._entries:
+                self._total_size -= self._entries.pop(key)[1]
+            self._entries[key] = (extension, len(body))
+            self._total_size += len(body)
+            self._evict()
+        return filepath
+
+    def _evict(self):
+        while self._total_size > self.max_size and len(self._entries) > 1:
+            key, (extension, size) = self._entries.popitem(last=False)
+            self._total_size -= size
+            try:
+                os.remove(self._filepath(key, extension))
+            except FileNotFoundError:
+                pass
+
+
+class MemoryCache:
+    "In-process LRU cache of response bodies, bounded by their total size in bytes"
+
+    def __init__(self, max_size, ttl=None, max_item_size=None):
+        self.max_size = max_size
+        self.ttl = DEFAULT_MEMORY_CACHE_TTL if ttl is None else ttl
+        self.max_item_size = min(
+            max_item_size or DEFAULT_MEMORY_CACHE_MAX_ITEM_SIZE, max_size
+        )
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._total_size = 0
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None and self.ttl and time.monotonic() > entry[0]:
+            self._remove(key)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def set(self, key, value, size):
+        if size > self.max_item_size:
+            return False
+        if key in self._entries:
+            self._remove(key)
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        self._entries[key] = (expires, value, size)
+        self._total_size += size
+        while self._total_size > self.max_size:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+        return True
+
+    def _remove(self, key):
+        _, _, size = self._entries.pop(key)
+        self._total_size -= size
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "items": len(self._entries),
+            "size": self._total_size,
+            "max_size": self.max_size,
+        }
+
+
+class RowCache:
+    "LRU cache of the rows returned by media SQL queries, with a TTL"
+
+    def __init__(self, max_size, ttl=None):
+        self.max_size = max_size
+        self.ttl = DEFAULT_MEMORY_CACHE_TTL if ttl is None else ttl
+        self._entries = OrderedDict()
+
+    def get(self, key, version):
+        # version identifies the state of the database - entries stored
+        # against any other version are stale
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires, entry_version, row = entry
+        if entry_version != version or (
+            expires is not None and time.monotonic() > expires
+        ):
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return row
+
+    def set(self, key, version, row):
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        self._entries[key] = (expires, version, row)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+
+def freshness_lifetime(headers):
+    """
+    Seconds an upstream response can be reused for without revalidating it,
+    from its Cache-Control, Expires and Age headers. None if the response
+    must not be stored at all.
+    """
+    directives = {}
+    for directive in (headers.get("cache-control") or "").split(","):
+        name, _, value = directive.strip().partition("=")
+        directives[name.lower()] = value.strip().strip('"')
+    # Responses are shared between all clients, so private ones are skipped
+    if "no-store" in directives or "private" in directives:
+        return None
+    if "no-cache" in directives:
+        return 0
+    try:
+        age = int(headers.get("age") or 0)
+    except ValueError:
+        age = 0
+    for name in ("s-maxage", "max-age"):
+        if name in directives:
+            try:
+                return max(int(directives[name]) - age, 0)
+            except ValueError:
+                return 0
+    expires = parse_http_date(headers.get("expires"))
+    if expires is None:
+        return 0
+    date = parse_http_date(headers.get("date")) or time.time()
+    return max(expires - date - age, 0)
+
+
+class UpstreamCache:
+    """
+    Size-limited on-disk cache of content_url responses, evicted
+    least-recently-used first. Each entry is a body file plus a JSON file
+    holding the upstream headers and the time the body needs revalidating.
+    """
+
+    def __init__(self, directory, max_size=None):
+        self.directory = str(directory)
+        self.max_size = max_size or DEFAULT_CACHE_MAX_SIZE
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._total_size = 0
+        os.makedirs(self.directory, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        existing = []
+        for entry in os.scandir(self.directory):
+            if entry.name.startswith(".") or not entry.name.endswith(".json"):
+                continue
+            try:
+                with open(entry.path) as fp:
+                    meta = json.load(fp)
+                mtime = os.stat(self._filepath(meta["body"])).st_mtime
+            except (OSError, ValueError, KeyError):
+                continue
+            existing.append((mtime, entry.name[: -len(".json")], meta))
+        for _, key, meta in sorted(existing, key=lambda item: item[0]):
+            self._entries[key] = meta
+            self._total_size += meta["size"]
+
+    def _key(self, url):
+        return hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+    def _filepath(self, name):
+        return os.path.join(self.directory, name)
+
+    def get(self, url):
+        "Returns the entry for url, whether or not it is still fresh, or None"
+        key = self._key(url)
+        with self._lock:
+            meta = self._entries.get(key)
+            if meta is None:
+                return None
+            self._entries.move_to_end(key)
+        filepath = self._filepath(meta["body"])
+        try:
+            # mtime records recency of use, so LRU order survives restarts
+            os.utime(filepath)
+        except FileNotFoundError:
+            with self._lock:
+                if self._entries.get(key) is meta:
+                    self._total_size -= self._entries.pop(key)["size"]
+            return None
+        return dict(meta, filepath=filepath)
+
+    @staticmethod
+    def is_fresh(entry):
+        return entry is not None and time.time() < entry["expires"]
+
+    @staticmethod
+    def revalidation_headers(entry):
+        "Conditional request headers for revalidating entry with upstream"
+        headers = {}
+        if entry is not None:
+            if "etag" in entry["headers"]:
+                headers["if-none-match"] = entry["headers"]["etag"]
+            if "last-modified" in entry["headers"]:
+                headers["if-modified-since"] = entry["headers"]["last-modified"]
+        return headers
+
+    def refresh(self, url, entry, headers):
+        "Updates entry from the headers of a 304 response to revalidation"
+        updated = dict(entry["headers"])
+        updated.update(
+            (name, headers[name]) for name in UPSTREAM_HEADERS if name in headers
+        )
+        lifetime = freshness_lifetime(
+            dict(updated, age=headers.get("age"), date=headers.get("date"))
+        )
+        meta = {key: value for key, value in entry.items() if key != "filepath"}
+        meta["headers"] = updated
+        # A body that may no longer be stored is revalidated every time
+        meta["expires"] = time.time() + (lifetime or 0)
+        key = self._key(url)
+        with self._lock:
+            current = self._entries.get(key)
+            if current is None or current["body"] != meta["body"]:
+                # Evicted or replaced by a newer body in the meantime
+                return entry
+            self._write_meta(key, meta)
+            self._entries[key] = meta
+        return dict(meta, filepath=entry["filepath"])
+
+    def writer(self, url, headers):
+        """
+        Returns an UpstreamWriter for storing the body of a 200 response with
+        these headers, or None if the response should not be stored
+        """
+        lifetime = freshness_lifetime(headers)
+        if lifetime is None:
+            return None
+        stored = {name: headers[name] for name in UPSTREAM_HEADERS if name in headers}
+        if not lifetime and "etag" not in stored and "last-modified" not in stored:
+            # Could never be used without fetching it again in full
+            return None
+        return UpstreamWriter(
+            self,
+            url,
+            {"url": url, "headers": stored, "expires": time.time() + lifetime},
+        )
+
+    def set(self, url, headers, body):
+        writer = self.writer(url, headers)
+        if writer is None or not writer.write(body):
+            return None
+        return writer.commit()
+
+    def _write_meta(self, key, meta):
+        tmp_filepath = self._filepath(".{}.{}.tmp".format(key, uuid.uuid4().hex))
+        with open(tmp_filepath, "w") as fp:
+            json.dump(meta, fp)
+        os.replace(tmp_filepath, self._filepath("{}.json".format(key)))
+
+    def _commit(self, url, tmp_filepath, meta):
+        key = self._key(url)
+        # Each body gets a new name, so readers of the previous one are not
+        # affected and the JSON file never points at a partial body
+        meta["body"] = "{}.{}.body".format(key, uuid.uuid4().hex[:12])
+        os.replace(tmp_filepath, self._filepath(meta["body"]))
+        with self._lock:
+            self._write_meta(key, meta)
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._total_size -= previous["size"]
+                self._remove_file(previous["body"])
+            self._entries[key] = meta
+            self._total_size += meta["size"]
+            self._evict()
+        return dict(meta, filepath=self._filepath(meta["body"]))
+
+    def _evict(self):
+        while self._total_size > self.max_size and len(self._entries) > 1:
+            key, meta = self._entries.popitem(last=False)
+            self._total_size -= meta["size"]
+            self._remove_file("{}.json".format(key))
+            self._remove_file(meta["body"])
+
+    def _remove_file(self, name):
+        try:
+            os.remove(self._filepath(name))
+        except FileNotFoundError:
+            pass
+
+
+class UpstreamWriter:
+    "Writes a body to the upstream cache as it arrives, chunk by chunk"
+
+    def __init__(self, cache, url, meta):
+        self.cache = cache
+        self.url = url
+        self.meta = meta
+        self.size = 0
+        self.tmp_filepath = cache._filepath(".{}.tmp".format(uuid.uuid4().hex))
+        self._fp = None
+
+    def write(self, chunk):
+        "Returns False, discarding the body, once it is too large to cache"
+        self.size += len(chunk)
+        if self.size > self.cache.max_size:
+            self.abort()
+            return False
+        if self._fp is None:
+            self._fp = open(self.tmp_filepath, "wb")
+        self._fp.write(chunk)
+        return True
+
+    def commit(self):
+        if self._fp is None:
+            # An empty body
+            self._fp = open(self.tmp_filepath, "wb")
+        self._fp.close()
+        return self.cache._commit(
+            self.url, self.tmp_filepath, dict(self.meta, size=self.size)
+        )
+
+    def abort(self):
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+        try:
+            os.remove(self.tmp_filepath)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,55 @@
+import asyncio
+import contextlib
+import httpx
+
+DEFAULT_MAX_CONNECTIONS = 100
+DEFAULT_MAX_KEEPALIVE_CONNECTIONS = 20
+
+
+class MediaHttpClient:
+    "Shared connection pool for fetching content_url media"
+
+    def __init__(self, config=None):
+        config = config or {}
+        limits = httpx.Limits(
+            max_connections=config.get("max_connections", DEFAULT_MAX_CONNECTIONS),
+            max_keepalive_connections=config.get(
+                "max_keepalive_connections", DEFAULT_MAX_KEEPALIVE_CONNECTIONS
+            ),
+            keepalive_expiry=config.get("keepalive_expiry", 5.0),
+        )
+        timeout = httpx.Timeout(
+            config.get("timeout", 5.0),
+            connect=config.get("connect_timeout", config.get("timeout", 5.0)),
+        )
+        self.client = httpx.AsyncClient(
+            limits=limits, timeout=timeout, http2=bool(config.get("http2"))
+        )
+        self.max_connections_per_host = config.get("max_connections_per_host")
+        self._host_semaphores = {}
+
+    @contextlib.asynccontextmanager
+    async def _host_slot(self, url):
+        if not self.max_connections_per_host:
+            yield
+            return
+        host = httpx.URL(url).host
+        if host not in self._host_semaphores:
+            self._host_semaphores[host] = asyncio.Semaphore(
+                self.max_connections_per_host
+            )
+        async with self._host_semaphores[host]:
+            yield
+
+    async def get(self, url, **kwargs):
+        async with self._host_slot(url):
+            return await self.client.get(url, **kwargs)
+
+    @contextlib.asynccontextmanager
+    async def stream(self, method, url, **kwargs):
+        async with self._host_slot(url):
+            async with self.client.stream(method, url, **kwargs) as response:
+                yield response
+
+    async def aclose(self):
+        await self.client.aclose()
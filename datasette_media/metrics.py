@@ -0,0 +1,131 @@
+from bisect import bisect_left
+from collections import defaultdict
+import contextlib
+import time
+
+# Upper bounds, in seconds, of the timing histogram buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def cumulative(self):
+        # (upper bound, observations at or below it) pairs, ending with +Inf
+        total = 0
+        for bound, count in zip(BUCKETS + (float("inf"),), self.counts):
+            total += count
+            yield bound, total
+
+
+class Metrics:
+    """
+    Counters and per-stage timing histograms for serve_media, broken down
+    by media type. Recording is a dictionary update, so it is always on.
+    """
+
+    def __init__(self):
+        self.counters = defaultdict(int)
+        self.timings = defaultdict(Histogram)
+
+    def incr(self, media_type, name, value=1):
+        self.counters[(media_type, name)] += value
+
+    def observe(self, media_type, stage, seconds):
+        self.timings[(media_type, stage)].observe(seconds)
+
+    @contextlib.contextmanager
+    def timer(self, media_type, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(media_type, stage, time.perf_counter() - start)
+
+    def as_dict(self):
+        media_types = {}
+        for (media_type, name), value in sorted(self.counters.items()):
+            media_types.setdefault(media_type, {"counters": {}, "timings": {}})[
+                "counters"
+            ][name] = value
+        for (media_type, stage), histogram in sorted(self.timings.items()):
+            media_types.setdefault(media_type, {"counters": {}, "timings": {}})[
+                "timings"
+            ][stage] = {
+                "count": histogram.count,
+                "sum": round(histogram.sum, 6),
+                "buckets": {
+                    _bound_label(bound): count
+                    for bound, count in histogram.cumulative()
+                },
+            }
+        return media_types
+
+    def prometheus(self, gauges=None):
+        # Prometheus text exposition format. gauges is a list of
+        # (name, labels dict, value) for values sampled at request time
+        lines = []
+        names = sorted({name for _, name in self.counters})
+        for name in names:
+            metric = "datasette_media_{}_total".format(name)
+            lines.append("# TYPE {} counter".format(metric))
+            for (media_type, counter_name), value in sorted(self.counters.items()):
+                if counter_name == name:
+                    lines.append(
+                        "{}{} {}".format(metric, _labels(media_type=media_type), value)
+                    )
+        if self.timings:
+            metric = "datasette_media_stage_seconds"
+            lines.append("# TYPE {} histogram".format(metric))
+            for (media_type, stage), histogram in sorted(self.timings.items()):
+                for bound, count in histogram.cumulative():
+                    lines.append(
+                        "{}_bucket{} {}".format(
+                            metric,
+                            _labels(
+                                media_type=media_type,
+                                stage=stage,
+                                le=_bound_label(bound),
+                            ),
+                            count,
+                        )
+                    )
+                labels = _labels(media_type=media_type, stage=stage)
+                lines.append("{}_sum{} {}".format(metric, labels, histogram.sum))
+                lines.append("{}_count{} {}".format(metric, labels, histogram.count))
+        for name in sorted({name for name, _, _ in gauges or []}):
+            metric = "datasette_media_{}".format(name)
+            lines.append("# TYPE {} gauge".format(metric))
+            for gauge_name, labels, value in gauges:
+                if gauge_name == name:
+                    lines.append("{}{} {}".format(metric, _labels(**labels), value))
+        return "\n".join(lines) + "\n"
+
+
+def _bound_label(bound):
+    return "+Inf" if bound == float("inf") else str(bound)
+
+
+def _labels(**labels):
+    if not labels:
+        return ""
+    return "{{{}}}".format(
+        ",".join(
+            '{}="{}"'.format(
+                key,
+                str(value)
+                .replace("\\", "\\\\")
+                .replace('"', '\\"')
+                .replace("\n", "\\n"),
+            )
+            for key, value in labels.items()
+        )
+    )
@@ -0,0 +1,176 @@
+from markupsafe import Markup, escape
+from urllib.parse import quote, urlencode
+from . import utils
+from .blob import blob_fingerprint, blob_size, row_blob
+
+
+def srcset_candidates(config, renditions=None, widths=None):
+    """
+    (width, query arguments) for each candidate of a srcset, narrowest
+    first. Defaults to the media type's srcset settings, then to every
+    rendition that sets a width but not a height - so that each candidate
+    has the proportions of the source.
+    """
+    srcset_config = config.get("srcset") or {}
+    if renditions is None and widths is None:
+        renditions = srcset_config.get("renditions")
+        widths = srcset_config.get("widths")
+    configured = config.get("renditions") or {}
+    if renditions is None and widths is None:
+        renditions = [
+            name
+            for name, rendition in configured.items()
+            if rendition.get("width") and not rendition.get("height")
+        ]
+    candidates = []
+    for name in renditions or ():
+        if name not in configured:
+            raise ValueError("Unknown rendition: {}".format(name))
+        if configured[name].get("width"):
+            candidates.append((configured[name]["width"], {"rendition": name}))
+    for width in widths or ():
+        candidates.append((int(width), {"w": int(width)}))
+    return sorted(candidates, key=lambda candidate: candidate[0])
+
+
+async def key_version(datasette, config, key):
+    # The ?v= that serve_media() accepts as the current version of a key's
+    # source, or None if it cannot be versioned - such as content_url media
+    # without a version column. Without that column the source file is
+    # stat()ed, or content is hashed, for every call.
+    database = datasette.get_database(config.get("database"))
+    row = (await database.execute(config["sql"], {"key": key})).first()
+    if row is None:
+        return None
+    version = utils.row_version(row)
+    if version is not None:
+        return version
+    blob = row_blob(row)
+    if blob is not None:
+        size = await database.execute_fn(lambda conn: blob_size(conn, *blob))
+        fingerprint = blob_fingerprint(database.path, *blob, size)
+    else:
+        filepath, content, _ = utils.row_source(row) or (None, None, None)
+        fingerprint = None
+        if filepath or content:
+            try:
+                fingerprint = utils.source_fingerprint(filepath, content)
+            except OSError:
+                pass
+    return utils.source_version(fingerprint) if fingerprint else None
+
+
+def media_url_builder(datasette, media_type, key, version=None):
+    # Returns a function that takes query arguments and returns the URL of
+    # the item with those arguments
+    path = datasette.urls.path(
+        "/-/media/{}/{}".format(quote(media_type, safe=""), quote(str(key)))
+    )
+
+    def url(args):
+        args = dict(args)
+        if version:
+            args["v"] = version
+        return path + ("?" + urlencode(args) if args else "")
+
+    return url
+
+
+def img_tag(url, candidates, sizes=None, **attributes):
+    # The widest candidate is the src for browsers without srcset support
+    return Markup(
+        "<img{}>".format(
+            _attributes(
+                dict(
+                    src=url(candidates[-1][1] if candidates else {}),
+                    srcset=_srcset(url, candidates) if candidates else None,
+                    sizes=sizes if candidates else None,
+                    **attributes
+                )
+            )
+        )
+    )
+
+
+def picture_tag(url, candidates, formats, sizes=None, **attributes):
+    sources = [
+        "<source{}>".format(
+            _attributes(
+                {
+                    "type": "image/{}".format(format.lower()),
+                    "srcset": _srcset(url, candidates, {"format": format.lower()}),
+                    "sizes": sizes if candidates else None,
+                }
+            )
+        )
+        for format in formats
+        if utils.can_save(format)
+    ]
+    return Markup(
+        "<picture>{}{}</picture>".format(
+            "".join(sources), img_tag(url, candidates, sizes, **attributes)
+        )
+    )
+
+
+def _srcset(url, candidates, extra=None):
+    if not candidates:
+        return url(extra or {})
+    return ", ".join(
+        "{} {}w".format(url(dict(args, **(extra or {}))), width)
+        for width, args in candidates
+    )
+
+
+def _attributes(attributes):
+    # data_id="1" becomes data-id="1", and None values are left out
+    return "".join(
+        ' {}="{}"'.format(name.replace("_", "-"), escape(value))
+        for name, value in attributes.items()
+        if value is not None
+    )
+
+
+async def media_img(
+    datasette, media_type, key, renditions=None, widths=None, sizes=None, **attributes
+):
+    "An <img> with a srcset of the media type's renditions for key"
+    config = _config(datasette, media_type)
+    url = media_url_builder(
+        datasette, media_type, key, await key_version(datasette, config, key)
+    )
+    candidates = srcset_candidates(config, renditions, widths)
+    if sizes is None:
+        sizes = (config.get("srcset") or {}).get("sizes")
+    return img_tag(url, candidates, sizes, **attributes)
+
+
+async def media_picture(
+    datasette,
+    media_type,
+    key,
+    renditions=None,
+    widths=None,
+    formats=None,
+    sizes=None,
+    **attributes
+):
+    "A <picture> with a <source> of the renditions for key in each format"
+    config = _config(datasette, media_type)
+    url = media_url_builder(
+        datasette, media_type, key, await key_version(datasette, config, key)
+    )
+    candidates = srcset_candidates(config, renditions, widths)
+    srcset_config = config.get("srcset") or {}
+    if formats is None:
+        formats = srcset_config.get("formats") or config.get("negotiate_formats")
+    if sizes is None:
+        sizes = srcset_config.get("sizes")
+    return picture_tag(url, candidates, formats or (), sizes, **attributes)
+
+
+def _config(datasette, media_type):
+    config = (datasette.plugin_config("datasette-media") or {}).get(media_type)
+    if not isinstance(config, dict) or config.get("sql") is None:
+        raise ValueError("Invalid media type: {}".format(media_type))
+    return config
@@ -0,0 +1,76 @@
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import asyncio
+import multiprocessing
+
+DEFAULT_MAX_TASKS = 1000
+
+
+class PendingTasks:
+    "Tasks submitted to an executor that have not finished yet"
+
+    def __init__(self):
+        self._futures = set()
+
+    async def run(self, executor, fn, *args, **kwargs):
+        future = executor.submit(fn, *args, **kwargs)
+        self._futures.add(future)
+        future.add_done_callback(self._futures.discard)
+        return await asyncio.wrap_future(future)
+
+    @property
+    def queued(self):
+        "Tasks that are waiting for a worker to start them"
+        return sum(1 for future in list(self._futures) if not future.running())
+
+    @property
+    def running(self):
+        return sum(1 for future in list(self._futures) if future.running())
+
+
+class ProcessTransformPool:
+    """
+    Runs CPU-bound transforms in worker processes, outside of the GIL.
+
+    Workers are replaced after max_tasks tasks to bound memory growth, and a
+    crashed pool is discarded so the next task starts a fresh one.
+    """
+
+    def __init__(self, processes, max_tasks=None):
+        self.processes = processes
+        self.max_tasks = DEFAULT_MAX_TASKS if max_tasks is None else max_tasks
+        self._executor = None
+        self._tasks = 0
+        self.pending = PendingTasks()
+
+    def _get_executor(self):
+        if (
+            self._executor is not None
+            and self.max_tasks
+            and (self._tasks >= self.max_tasks)
+        ):
+            # Recycle: running tasks finish in the old workers
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.processes,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+            self._tasks = 0
+        self._tasks += 1
+        return self._executor
+
+    async def run(self, fn, *args, **kwargs):
+        executor = self._get_executor()
+        try:
+            return await self.pending.run(executor, fn, *args, **kwargs)
+        except BrokenProcessPool:
+            if self._executor is executor:
+                self._executor = None
+            raise
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
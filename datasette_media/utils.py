@@ -1,45 +1,202 @@
 from datasette.utils.asgi import Response
-import imghdr
+from email.utils import formatdate, parsedate_to_datetime
+import hashlib
+import inspect
 import io
-from PIL import Image, ExifTags
+import asyncio
+import functools
+import json
+import os
+import time
+import uuid
+from PIL import Image, ExifTags, ImageOps, UnidentifiedImageError
 
 try:
     import pyheif
 except ImportError:
     pyheif = None
 
-heic_magics = {b"ftypheic", b"ftypheix", b"ftyphevc", b"ftyphevx"}
+# Bytes read from the start of a file to identify its type
+IMAGE_HEADER_SIZE = 32
+# (leading bytes, image type) - checked in order
+IMAGE_SIGNATURES = (
+    (b"\xff\xd8\xff", "jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"GIF87a", "gif"),
+    (b"GIF89a", "gif"),
+    (b"RIFF", "webp"),
+    (b"II*\x00", "tiff"),
+    (b"MM\x00*", "tiff"),
+    (b"BM", "bmp"),
+)
+# Major brands of ISO base media files, found after "ftyp" at offset 4
+ISOBMFF_BRANDS = {
+    b"avif": "avif",
+    b"avis": "avif",
+    b"heic": "heic",
+    b"heix": "heic",
+    b"hevc": "heic",
+    b"hevx": "heic",
+}
+# Pillow format names for detected image types, passed to Image.open()
+PILLOW_FORMATS = {
+    "jpeg": "JPEG",
+    "png": "PNG",
+    "gif": "GIF",
+    "webp": "WEBP",
+    "avif": "AVIF",
+    "tiff": "TIFF",
+    "bmp": "BMP",
+}
+# Image.open() accepts formats= from Pillow 8.0
+OPEN_ACCEPTS_FORMATS = "formats" in inspect.signature(Image.open).parameters
 ORIENTATION_EXIF_TAG = dict((v, k) for k, v in ExifTags.TAGS.items())["Orientation"]
 
 # Sanity check maximum width/height for resized images
 DEFAULT_MAX_WIDTH_HEIGHT = 4000
+# Sources with more pixels than this are not decoded - a decoded RGB
+# image takes 3 bytes per pixel
+DEFAULT_MAX_SOURCE_PIXELS = 100 * 1000 * 1000
+# JPEG sources can be decoded at these reduced scales
+JPEG_DRAFT_SCALES = (1, 2, 4, 8)
+# How an image is fitted to a width and height when both are specified
+FIT_MODES = ("fill", "contain", "cover")
+# Requests for more ranges than this are served the full body instead
+MAX_RANGES = 50
+RANGE_CHUNK_SIZE = 64 * 1024
+# Downscales first reduce by an integer factor to within this multiple of
+# the target size, then finish with a high quality filter
+REDUCING_GAP = 3.0
 
 
 def image_type_for_bytes(b):
-    image_type = imghdr.what(None, b)
-    if image_type is not None:
-        return image_type
-    # Maybe it's an HEIC?
-    if len(b) < 12:
-        return None
-    if b[4:12] in heic_magics:
-        return "heic"
+    # Identifies an image from its first IMAGE_HEADER_SIZE bytes, or None
+    for signature, image_type in IMAGE_SIGNATURES:
+        if b.startswith(signature):
+            if image_type == "webp" and b[8:12] != b"WEBP":
+                continue
+            return image_type
+    if b[4:8] == b"ftyp":
+        # ISO base media files, identified by their major brand
+        return ISOBMFF_BRANDS.get(b[8:12])
+    return None
+
+
+def image_type_for_file(filepath):
+    with open(filepath, "rb") as fp:
+        return image_type_for_bytes(fp.read(IMAGE_HEADER_SIZE))
+
+
+def _pillow_open(source, image_type):
+    # Tells Pillow the format when it is already known, so it does not
+    # probe the file against each of its plugins
+    format = PILLOW_FORMATS.get(image_type)
+    if format is not None and OPEN_ACCEPTS_FORMATS:
+        try:
+            return Image.open(source, formats=[format])
+        except (UnidentifiedImageError, KeyError):
+            # KeyError: no plugin for the format is installed
+            pass
+    return Image.open(source)
+
+
+class SourceTooLarge(Exception):
+    "A source image has more pixels than its media type allows to be decoded"
+
+
+def source_limits(config):
+    # Keyword arguments for the transform functions, bounding the memory
+    # used to decode a media type's sources
+    return {
+        "max_pixels": config.get("max_source_pixels", DEFAULT_MAX_SOURCE_PIXELS),
+        "reduce_large": bool(config.get("reduce_large_sources")),
+    }
+
+
+class RowShape:
+    "Which of the columns that media rows can have are returned by a query"
+
+    def __init__(self, columns):
+        self.columns = frozenset(columns)
+        self.blob = all(
+            name in self.columns
+            for name in ("content_table", "content_column", "content_rowid")
+        )
+        # The first of these is the source of the media
+        self.source = next(
+            (
+                name
+                for name in ("content", "content_url", "filepath")
+                if name in self.columns
+            ),
+            None,
+        )
+        self.transform_columns = frozenset(
+            name
+            for name in ("resize_width", "resize_height", "output_format")
+            if name in self.columns
+        )
+
+
+@functools.lru_cache(maxsize=256)
+def row_shape(columns):
+    # Queries return the same columns for every key, so each shape is only
+    # worked out once rather than for every row
+    return RowShape(columns)
+
+
+def shape_of(row):
+    return row_shape(tuple(row.keys()))
+
+
+def row_source(row, shape=None):
+    # Returns (filepath, content, content_url) for a media row - only one of
+    # which will be set - or None if the row has none of those columns
+    source = (shape or shape_of(row)).source
+    if source == "content":
+        return None, row["content"], None
+    elif source == "content_url":
+        return None, None, row["content_url"]
+    elif source == "filepath":
+        return row["filepath"], None, None
     return None
 
 
-def should_transform(row, config, request):
+def should_transform(row, config, request, shape=None):
     # Decides if the provided row should be transformed, based on request AND config
     # Returns None if it should not be, or a dict of resize/etc options if it should
-    row_keys = row.keys()
+    transform = _requested_transform(row, config, request, shape or shape_of(row))
+    if transform and not transform.get("format"):
+        negotiated = negotiate_format(config, request)
+        if negotiated:
+            transform["format"] = negotiated
+    return transform
+
+
+def _requested_transform(row, config, request, shape):
+    columns = shape.transform_columns
     transform = {}
-    if any(
-        key in row_keys for key in ("resize_width", "resize_height", "output_format")
-    ):
+    if columns:
         transform = dict(
-            width=row["resize_width"] if "resize_width" in row_keys else None,
-            height=row["resize_height"] if "resize_height" in row_keys else None,
-            format=row["output_format"] if "output_format" in row_keys else None,
+            width=row["resize_width"] if "resize_width" in columns else None,
+            height=row["resize_height"] if "resize_height" in columns else None,
+            format=row["output_format"] if "output_format" in columns else None,
         )
+    renditions = config.get("renditions") or {}
+    if renditions and "rendition" in request.args:
+        name = request.args["rendition"]
+        if name not in renditions:
+            raise ValueError("Unknown rendition: {}".format(name))
+        transform = rendition_transform(renditions[name])
+        # Renditions without a format of their own can be requested in any
+        # format, for <picture> sources
+        if (
+            config.get("enable_transform")
+            and "format" in request.args
+            and not transform["format"]
+        ):
+            transform["format"] = request.args["format"]
+        return transform
     if config.get("enable_transform"):
         max_width_height = config.get("max_width_height") or DEFAULT_MAX_WIDTH_HEIGHT
         # URL arguments over-ride columns
@@ -49,59 +206,714 @@ def should_transform(row, config, request):
         if "w" in request.args or "h" in request.args:
             transform.pop("width", None)
             transform.pop("height", None)
-        for urlarg, key in {"w": "width", "h": "height"}.items():
-            if urlarg in request.args and int(request.args[urlarg]) < max_width_height:
-                transform[key] = int(request.args[urlarg])
+        try:
+            sizes = {
+                key: int(request.args[urlarg])
+                for urlarg, key in {"w": "width", "h": "height"}.items()
+                if urlarg in request.args
+            }
+        except ValueError:
+            raise ValueError("w and h must be integers")
+        arbitrary_sizes = config.get("arbitrary_sizes") or "allow"
+        if sizes and renditions and arbitrary_sizes == "reject":
+            raise ValueError("Only named renditions are available")
+        if sizes and renditions and arbitrary_sizes == "snap":
+            snapped = rendition_transform(nearest_rendition(renditions, **sizes))
+            if "format" in request.args:
+                snapped["format"] = request.args["format"]
+            return snapped
+        for key, value in sizes.items():
+            if value < max_width_height:
+                transform[key] = value
 
     return transform or None
 
 
-def transform_image(image_bytes, width=None, height=None, format=None):
-    image_type = image_type_for_bytes(image_bytes)
-    if image_type == "heic" and pyheif is not None:
-        heic = pyheif.read_heif(image_bytes)
-        image = Image.frombytes(mode=heic.mode, size=heic.size, data=heic.data)
+def can_save(format):
+    Image.init()
+    return format.upper() in Image.SAVE
+
+
+def negotiate_format(config, request):
+    # Picks the first of the negotiate_formats that the Accept header lists
+    formats = config.get("negotiate_formats")
+    if not formats or not config.get("enable_transform"):
+        return None
+    accepted = set()
+    for media_range in (request.headers.get("accept") or "").split(","):
+        media_type, *params = [part.strip() for part in media_range.split(";")]
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    pass
+        if quality > 0:
+            accepted.add(media_type.lower())
+    # Wildcards are ignored, since */* does not mean a client can decode AVIF
+    for format in formats:
+        if "image/{}".format(format.lower()) in accepted and can_save(format):
+            return format.lower()
+    return None
+
+
+def rendition_transform(rendition):
+    # Converts a configured rendition into should_transform() options
+    fit = rendition.get("fit")
+    if fit is not None and fit not in FIT_MODES:
+        raise ValueError("fit must be one of {}".format(", ".join(FIT_MODES)))
+    transform = dict(
+        width=rendition.get("width"),
+        height=rendition.get("height"),
+        format=rendition.get("format"),
+    )
+    # Only included when set, so other transforms keep the same cache keys
+    for key in ("quality", "fit"):
+        if rendition.get(key) is not None:
+            transform[key] = rendition[key]
+    return transform
+
+
+def nearest_rendition(renditions, width=None, height=None):
+    # The rendition closest in size to the requested width and/or height
+    def distance(rendition):
+        total = 0
+        for requested, configured in (
+            (width, rendition.get("width")),
+            (height, rendition.get("height")),
+        ):
+            if requested is not None:
+                total += abs(requested - (configured or 0))
+        return total
+
+    return min(renditions.values(), key=distance)
+
+
+def image_size(image_bytes=None, filepath=None):
+    # Reads just the image header to find (width, height), or None
+    try:
+        if image_bytes is None:
+            image_type = image_type_for_file(filepath)
+        else:
+            image_type = image_type_for_bytes(image_bytes[:IMAGE_HEADER_SIZE])
+        with _pillow_open(
+            filepath if image_bytes is None else io.BytesIO(image_bytes), image_type
+        ) as image:
+            return image.size
+    except (OSError, ValueError, SyntaxError):
+        return None
+
+
+def source_fingerprint(
+    filepath=None, content=None, content_url=None, version=None, stat=None
+):
+    # Identifies the current version of a source, for use in cache keys.
+    # Nothing else identifies a version of a content_url, so the row's
+    # version column is included for those. stat is the os.stat() of
+    # filepath, if the caller already has it.
+    if filepath is not None:
+        stat = stat or os.stat(filepath)
+        return "file:{}:{}:{}".format(filepath, stat.st_mtime_ns, stat.st_size)
+    if content is not None:
+        if isinstance(content, str):
+            content = content.encode("utf-8")
+        return "content:{}".format(hashlib.sha256(content).hexdigest())
+    if version is not None:
+        return "url:{}:{}".format(content_url, version)
+    return "url:{}".format(content_url)
+
+
+def url_fingerprint(content_url, headers, content=None, version=None):
+    # Identifies the current version of a content_url by the validators
+    # upstream sent with it, or by a hash of its body if there are none
+    validator = headers.get("etag") or headers.get("last-modified")
+    if validator is None and content is not None:
+        validator = hashlib.sha256(content).hexdigest()
+    return "{}:{}".format(
+        source_fingerprint(content_url=content_url, version=version), validator
+    )
+
+
+def database_version(path):
+    # Changes whenever a SQLite database file is written to, including
+    # writes that have not yet been checkpointed from its WAL file
+    stats = []
+    for filepath in (path, path + "-wal"):
+        try:
+            stat = os.stat(filepath)
+        except FileNotFoundError:
+            continue
+        stats.append("{}:{}".format(stat.st_mtime_ns, stat.st_size))
+    return ",".join(stats)
+
+
+def row_version(row, shape=None):
+    # The optional version column of a media row as a ?v= value, or None
+    if "version" in (shape or shape_of(row)).columns and row["version"] is not None:
+        return str(row["version"])
+    return None
+
+
+def source_version(fingerprint):
+    # Short identifier for a source fingerprint, used as ?v= in media URLs
+    return hashlib.sha256(fingerprint.encode("utf-8")).hexdigest()[:16]
+
+
+def etag_for(fingerprint, transform=None):
+    # Strong ETag for a source fingerprint plus any transform options
+    digest = hashlib.sha256(
+        json.dumps([fingerprint, transform], sort_keys=True, default=str).encode(
+            "utf-8"
+        )
+    ).hexdigest()
+    return '"{}"'.format(digest[:32])
+
+
+def http_date(timestamp):
+    return formatdate(timestamp, usegmt=True)
+
+
+def parse_http_date(value):
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def _strip_weak(etag):
+    return etag[2:] if etag.startswith("W/") else etag
+
+
+def is_not_modified(headers, etag=None, last_modified=None):
+    # Evaluates If-None-Match / If-Modified-Since for a GET request
+    if_none_match = headers.get("if-none-match")
+    if if_none_match is not None:
+        if etag is None:
+            return False
+        if if_none_match.strip() == "*":
+            return True
+        # If-None-Match uses the weak comparison function
+        candidates = [_strip_weak(tag.strip()) for tag in if_none_match.split(",")]
+        return _strip_weak(etag) in candidates
+    if_modified_since = headers.get("if-modified-since")
+    if if_modified_since is not None and last_modified is not None:
+        since = parse_http_date(if_modified_since)
+        if since is not None:
+            return int(last_modified) <= since
+    return False
+
+
+def parse_range(header, size):
+    # Returns a list of inclusive (start, end) byte ranges for a Range header,
+    # an empty list if none of them are satisfiable or None to ignore it
+    unit, _, specs = header.partition("=")
+    if unit.strip().lower() != "bytes" or not specs:
+        return None
+    ranges = []
+    for spec in specs.split(","):
+        start, sep, end = spec.strip().partition("-")
+        if not sep:
+            return None
+        try:
+            if not start:
+                # Suffix range: the last N bytes
+                length = int(end)
+                if length == 0 or size == 0:
+                    # Nothing in an empty body can be satisfied
+                    continue
+                ranges.append((max(size - length, 0), size - 1))
+                continue
+            start = int(start)
+            end = int(end) if end else None
+        except ValueError:
+            return None
+        if end is not None and start > end:
+            return None
+        # A range starting at or past the end of the body is unsatisfiable
+        if start < size:
+            ranges.append((start, size - 1 if end is None else min(end, size - 1)))
+    if len(ranges) > MAX_RANGES:
+        return None
+    return ranges
+
+
+def requested_ranges(headers, size, etag=None, last_modified=None):
+    # Applies Range and If-Range request headers to a body of the given size
+    range_header = headers.get("range")
+    if not range_header:
+        return None
+    if_range = headers.get("if-range")
+    if if_range is not None:
+        if if_range.startswith('"') or if_range.startswith("W/"):
+            # If-Range requires the strong comparison function
+            if etag is None or if_range != etag:
+                return None
+        elif last_modified is None or parse_http_date(if_range) != int(last_modified):
+            return None
+    return parse_range(range_header, size)
+
+
+def _byteranges(ranges, size, content_type):
+    # Part headers and total length for a multipart/byteranges body
+    boundary = uuid.uuid4().hex
+    parts = []
+    content_length = 0
+    for start, end in ranges:
+        part_header = (
+            "--{}\r\nContent-Type: {}\r\nContent-Range: bytes {}-{}/{}\r\n\r\n".format(
+                boundary, content_type, start, end, size
+            ).encode("utf-8")
+        )
+        parts.append((part_header, start, end))
+        content_length += len(part_header) + (end - start + 1) + 2
+    closing = "--{}--\r\n".format(boundary).encode("utf-8")
+    content_length += len(closing)
+    return boundary, parts, closing, content_length
+
+
+def _range_headers(ranges, size, content_type, headers):
+    # Any content-length describes the full body, not the ranges sent
+    headers = {
+        name: value
+        for name, value in (headers or {}).items()
+        if name.lower() != "content-length"
+    }
+    headers["accept-ranges"] = "bytes"
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        headers["content-range"] = "bytes {}-{}/{}".format(start, end, size)
+    return headers
+
+
+def range_not_satisfiable_response(size):
+    return Response(
+        "", status=416, headers={"content-range": "bytes */{}".format(size)}
+    )
+
+
+def bytes_range_response(body, ranges, content_type, headers=None):
+    # Builds a 206 (or 416) response for ranges of an in-memory body
+    size = len(body)
+    if not ranges:
+        return range_not_satisfiable_response(size)
+    headers = _range_headers(ranges, size, content_type, headers)
+    view = memoryview(body)
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        return Response(
+            bytes(view[start : end + 1]),
+            status=206,
+            headers=headers,
+            content_type=content_type,
+        )
+    boundary, parts, closing, _ = _byteranges(ranges, size, content_type)
+    chunks = []
+    for part_header, start, end in parts:
+        chunks.extend((part_header, view[start : end + 1], b"\r\n"))
+    chunks.append(closing)
+    return Response(
+        b"".join(chunks),
+        status=206,
+        headers=headers,
+        content_type="multipart/byteranges; boundary={}".format(boundary),
+    )
+
+
+async def send_ranges(send, read, ranges, size, content_type, headers=None):
+    # Streams a 206 (or 416) response for ranges of a source, using an async
+    # read(offset, length) function to read each chunk
+    if not ranges:
+        await range_not_satisfiable_response(size).asgi_send(send)
+        return
+    headers = _range_headers(ranges, size, content_type, headers)
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        parts = [(b"", start, end)]
+        closing = b""
+        headers["content-length"] = str(end - start + 1)
+        headers["content-type"] = content_type
+    else:
+        boundary, parts, closing, content_length = _byteranges(
+            ranges, size, content_type
+        )
+        headers["content-length"] = str(content_length)
+        headers["content-type"] = "multipart/byteranges; boundary={}".format(boundary)
+    await _send_start(send, 206, headers)
+    for part_header, start, end in parts:
+        if part_header:
+            await send(
+                {
+                    "type": "http.response.body",
+                    "body": part_header,
+                    "more_body": True,
+                }
+            )
+        await _send_chunks(send, read, start, end - start + 1, RANGE_CHUNK_SIZE)
+        if closing:
+            await send(
+                {"type": "http.response.body", "body": b"\r\n", "more_body": True}
+            )
+    await send({"type": "http.response.body", "body": closing})
+
+
+async def send_stream(
+    send, read, size, content_type, headers=None, chunk_size=RANGE_CHUNK_SIZE
+):
+    # Streams a 200 response of a known size in chunks, using an async
+    # read(offset, length) function
+    headers = dict(headers or {})
+    headers["content-type"] = content_type
+    headers["content-length"] = str(size)
+    await _send_start(send, 200, headers)
+    await _send_chunks(send, read, 0, size, chunk_size)
+    await send({"type": "http.response.body", "body": b""})
+
+
+async def _send_start(send, status, headers):
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [
+                (key.encode("utf-8"), value.encode("utf-8"))
+                for key, value in headers.items()
+            ],
+        }
+    )
+
+
+async def _send_chunks(send, read, offset, remaining, chunk_size):
+    while remaining > 0:
+        chunk = await read(offset, min(remaining, chunk_size))
+        if not chunk:
+            # The source shrank - stop, the client can tell from content-length
+            break
+        offset += len(chunk)
+        remaining -= len(chunk)
+        await send({"type": "http.response.body", "body": chunk, "more_body": True})
+
+
+async def send_file_ranges(send, filepath, ranges, size, content_type, headers=None):
+    # Streams a 206 (or 416) response for ranges of a file on disk
+    loop = asyncio.get_event_loop()
+    fp = await loop.run_in_executor(None, open, filepath, "rb")
+
+    def read_at(offset, length):
+        fp.seek(offset)
+        return fp.read(length)
+
+    async def read(offset, length):
+        return await loop.run_in_executor(None, read_at, offset, length)
+
+    try:
+        await send_ranges(send, read, ranges, size, content_type, headers)
+    finally:
+        fp.close()
+
+
+def open_image(image_bytes=None, filepath=None, max_pixels=None):
+    # Files are opened by path, so Pillow reads them lazily as it decodes
+    # rather than needing a complete copy in memory first. Sources with
+    # more than max_pixels raise SourceTooLarge before they are decoded.
+    if image_bytes is None:
+        image_type = image_type_for_file(filepath)
     else:
-        image = Image.open(io.BytesIO(image_bytes))
+        image_type = image_type_for_bytes(image_bytes[:IMAGE_HEADER_SIZE])
+    if image_type == "heic" and pyheif is not None:
+        source = image_bytes if image_bytes is not None else filepath
+        if hasattr(pyheif, "open"):
+            heic = pyheif.open(source)
+            check_pixels(heic.size, max_pixels)
+            heic = heic.load()
+        else:
+            # pyheif before 0.5 can only decode the whole image up front
+            heic = pyheif.read_heif(source)
+            check_pixels(heic.size, max_pixels)
+        return Image.frombytes(mode=heic.mode, size=heic.size, data=heic.data)
+    try:
+        if image_bytes is None:
+            image = _pillow_open(filepath, image_type)
+        else:
+            image = _pillow_open(io.BytesIO(image_bytes), image_type)
+    except Image.DecompressionBombError as ex:
+        # Pillow's own limit, checked when the header is read
+        raise SourceTooLarge(str(ex))
+    if image.format != "JPEG":
+        # Only JPEGs can be decoded at a reduced scale, which is checked
+        # once the scale is known. Other formats may be decoded just to
+        # read their EXIF data, so are checked now.
+        try:
+            check_pixels(image.size, max_pixels)
+        except SourceTooLarge:
+            image.close()
+            raise
+    return image
+
+
+def check_pixels(size, max_pixels=None):
+    if max_pixels and size[0] * size[1] > max_pixels:
+        raise SourceTooLarge(
+            "{}x{} image is larger than the {} pixel limit".format(
+                size[0], size[1], max_pixels
+            )
+        )
+
+
+def transform_image(
+    image_bytes=None,
+    width=None,
+    height=None,
+    format=None,
+    filepath=None,
+    fit=None,
+    timings=None,
+    max_pixels=None,
+    reduce_large=False,
+):
+    # timings, if provided, is a dict that gets the seconds spent opening
+    # the source, decoding and resizing. Sources over max_pixels raise SourceTooLarge before
+    # they are decoded - unless reduce_large allows a reduced scale decode.
+    start = time.perf_counter()
+    image = open_image(image_bytes, filepath, max_pixels)
+    opened = time.perf_counter()
     # Does EXIF tell us to rotate it?
+    orientation = _exif_orientation(image)
+    # Work out the target size up front, so JPEGs can be decoded at a
+    # reduced scale rather than at full resolution
+    size = _target_size(image.size, orientation, width, height, fit)
+    image = _orient_and_load(image, orientation, size, max_pixels, reduce_large)
+    decoded = time.perf_counter()
+    if size is not None:
+        image = _resize(image, size, fit)
+    if timings is not None:
+        timings["open"] = opened - start
+        timings["decode"] = decoded - opened
+        timings["resize"] = time.perf_counter() - decoded
+    return image
+
+
+def _exif_orientation(image):
     try:
-        exif = dict(image._getexif().items())
-        if exif[ORIENTATION_EXIF_TAG] == 3:
-            image = image.rotate(180, expand=True)
-        elif exif[ORIENTATION_EXIF_TAG] == 6:
-            image = image.rotate(270, expand=True)
-        elif exif[ORIENTATION_EXIF_TAG] == 8:
-            image = image.rotate(90, expand=True)
+        return dict(image._getexif().items())[ORIENTATION_EXIF_TAG]
     except (AttributeError, KeyError, IndexError):
-        pass
-
-    # Resize based on width and height, if set
-    image_width, image_height = image.size
-    if width is not None or height is not None:
-        if height is None:
-            # Set h based on w
-            height = int((float(image_height) / image_width) * width)
-        elif width is None:
-            # Set w based on h
-            width = int((float(image_width) / image_height) * height)
-        image = image.resize((width, height))
+        return None
 
-    return image
+
+def _target_size(image_size, orientation, width=None, height=None, fit=None):
+    # (width, height) of the output after orientation, or None to keep
+    # the original size
+    if width is None and height is None:
+        return None
+    image_width, image_height = image_size
+    if orientation in (6, 8):
+        image_width, image_height = image_height, image_width
+    if height is None:
+        # Set h based on w
+        height = int((float(image_height) / image_width) * width)
+    elif width is None:
+        # Set w based on h
+        width = int((float(image_width) / image_height) * height)
+    elif fit == "contain":
+        # Largest size that fits within width x height
+        scale = min(float(width) / image_width, float(height) / image_height)
+        width = max(int(image_width * scale), 1)
+        height = max(int(image_height * scale), 1)
+    return width, height
 
 
-class ImageResponse(Response):
-    def __init__(self, image, format=None):
-        self.image = image
-        output_image = io.BytesIO()
-        if format is None:
-            if image.format == "GIF":
-                format = "GIF"
-            elif image.mode == "RGBA":
-                format = "PNG"
+def _orient_and_load(
+    image, orientation, draft_size=None, max_pixels=None, reduce_large=False
+):
+    # draft_size is the largest output that will be created from the image
+    if image.format == "JPEG":
+        request = None
+        if draft_size is not None:
+            width, height = draft_size
+            request = (height, width) if orientation in (6, 8) else (width, height)
+        if reduce_large and max_pixels:
+            budget = _draft_budget(image.size, max_pixels)
+            if request is None:
+                request = budget
             else:
-                format = "JPEG"
-        image.save(output_image, format)
-        super().__init__(
-            body=output_image.getvalue(),
-            content_type="image/{}".format(format or "JPEG").lower(),
+                request = (min(request[0], budget[0]), min(request[1], budget[1]))
+        if request is not None:
+            image.draft(image.mode, request)
+    # draft() has set the size that will actually be decoded
+    try:
+        check_pixels(image.size, max_pixels)
+    except SourceTooLarge:
+        image.close()
+        raise
+    if orientation == 3:
+        image = image.rotate(180, expand=True)
+    elif orientation == 6:
+        image = image.rotate(270, expand=True)
+    elif orientation == 8:
+        image = image.rotate(90, expand=True)
+    # Decode now, while we are still in a worker thread or process
+    image.load()
+    return image
+
+
+def _draft_budget(size, max_pixels):
+    # The draft() size that decodes a JPEG at the smallest reduction that
+    # fits within max_pixels - or at the largest reduction available
+    width, height = size
+    for scale in JPEG_DRAFT_SCALES:
+        if -(-width // scale) * -(-height // scale) <= max_pixels:
+            break
+    # draft() picks the largest scale that is at least this size
+    return max(width // scale, 1), max(height // scale, 1)
+
+
+def _resize(image, size, fit=None):
+    width, height = size
+    if fit == "cover":
+        # Scale to cover width x height, then crop from the center
+        return ImageOps.fit(image, (width, height), Image.LANCZOS)
+    elif width < image.width or height < image.height:
+        # reducing_gap shrinks by an integer factor first, which is much
+        # faster than filtering the whole source with LANCZOS
+        return image.resize((width, height), Image.LANCZOS, reducing_gap=REDUCING_GAP)
+    return image.resize((width, height), Image.BICUBIC)
+
+
+def render_images(
+    image_bytes=None,
+    filepath=None,
+    format_options=None,
+    transforms=(),
+    max_pixels=None,
+    reduce_large=False,
+):
+    """
+    Renders several transforms of one source image, decoding and orienting
+    it only once. Outputs are created from the largest to the smallest, each
+    downscaled from the previous one where that has the same proportions.
+    Returns ([(body, content_type), ...] in the order of transforms, timings)
+    """
+    timings = {"open": 0.0, "decode": 0.0, "resize": 0.0, "encode": 0.0}
+    start = time.perf_counter()
+    image = open_image(image_bytes, filepath, max_pixels)
+    opened = time.perf_counter()
+    timings["open"] = opened - start
+    orientation = _exif_orientation(image)
+    sizes = [
+        _target_size(
+            image.size,
+            orientation,
+            transform.get("width"),
+            transform.get("height"),
+            transform.get("fit"),
         )
+        for transform in transforms
+    ]
+    draft_size = None
+    if sizes and None not in sizes:
+        draft_size = (max(w for w, _ in sizes), max(h for _, h in sizes))
+    image = _orient_and_load(image, orientation, draft_size, max_pixels, reduce_large)
+    timings["decode"] = time.perf_counter() - opened
+    outputs = [None] * len(transforms)
+    previous = image
+    # Full size outputs first, then by decreasing area
+    for index in sorted(
+        range(len(transforms)),
+        key=lambda i: -(sizes[i][0] * sizes[i][1]) if sizes[i] else -float("inf"),
+    ):
+        transform, size = transforms[index], sizes[index]
+        started = time.perf_counter()
+        if size is None:
+            output = image
+        else:
+            fit = transform.get("fit")
+            source = image
+            if (
+                fit != "cover"
+                and _same_proportions(previous.size, image.size)
+                and _same_proportions(size, image.size)
+                and previous.width >= size[0]
+                and previous.height >= size[1]
+            ):
+                source = previous
+            output = _resize(source, size, fit)
+            if fit != "cover":
+                previous = output
+        encoding = time.perf_counter()
+        timings["resize"] += encoding - started
+        outputs[index] = encode_image(
+            output, transform.get("format"), transform.get("quality"), format_options
+        )
+        timings["encode"] += time.perf_counter() - encoding
+    return outputs, timings
+
+
+def _same_proportions(size, other):
+    # Within the rounding of a single pixel
+    return abs(size[0] * other[1] - size[1] * other[0]) <= max(other)
+
+
+def encode_image(image, format=None, quality=None, format_options=None):
+    # Returns (encoded bytes, content_type) for a PIL image. format_options
+    # maps lowercase format names to extra Pillow save() options
+    output_image = io.BytesIO()
+    if format is None:
+        if image.format == "GIF":
+            format = "GIF"
+        elif image.mode == "RGBA":
+            format = "PNG"
+        else:
+            format = "JPEG"
+    save_options = dict((format_options or {}).get(format.lower()) or {})
+    if quality is not None:
+        save_options["quality"] = quality
+    image.save(output_image, format, **save_options)
+    # getvalue() hands over the BytesIO buffer without copying it, provided
+    # no views of the buffer are still held - so this never uses getbuffer()
+    return output_image.getvalue(), "image/{}".format(format or "JPEG").lower()
+
+
+def render_image(image_bytes=None, filepath=None, format_options=None, **transform):
+    # Transforms and encodes an image in one step, for use in worker processes.
+    # Passing a filepath avoids sending the source bytes to the worker.
+    body, content_type, _ = timed_render_image(
+        image_bytes, filepath, format_options, **transform
+    )
+    return body, content_type
+
+
+def timed_render_image(
+    image_bytes=None,
+    filepath=None,
+    format_options=None,
+    max_pixels=None,
+    reduce_large=False,
+    **transform
+):
+    # render_image() that also returns a dict of seconds spent in each stage,
+    # since worker processes cannot record metrics themselves
+    timings = {}
+    quality = transform.pop("quality", None)
+    image = transform_image(
+        image_bytes,
+        filepath=filepath,
+        timings=timings,
+        max_pixels=max_pixels,
+        reduce_large=reduce_large,
+        **transform
+    )
+    start = time.perf_counter()
+    body, content_type = encode_image(
+        image, transform.get("format"), quality, format_options
+    )
+    timings["encode"] = time.perf_counter() - start
+    return body, content_type, timings
+
+
+class ImageResponse(Response):
+    def __init__(self, image, format=None, quality=None, format_options=None):
+        # The decoded image is not kept on the response, so it can be freed
+        # as soon as it has been encoded
+        body, content_type = encode_image(image, format, quality, format_options)
+        super().__init__(body=body, content_type=content_type)
@@ -0,0 +1,152 @@
+from datasette.utils.asgi import Request
+from urllib.parse import urlencode
+import asyncio
+import itertools
+import os
+from . import utils
+from .blob import blob_fingerprint, blob_size, read_blob, row_blob
+from .cache import cache_key
+from .http_client import MediaHttpClient
+from .transform_pool import ProcessTransformPool
+
+
+async def fetch_keys(datasette, media_type, keys_sql=None, params=None):
+    config = (datasette.plugin_config("datasette-media") or {})[media_type]
+    keys_sql = keys_sql or (config.get("warm") or {}).get("keys_sql")
+    if not keys_sql:
+        raise ValueError("A keys SQL query is required for {}".format(media_type))
+    database = datasette.get_database(config.get("database"))
+    results = await database.execute(keys_sql, params)
+    return [str(row[0]) for row in results.rows]
+
+
+def warm_requests(media_type, key, widths=None, formats=None, renditions=None):
+    # The requests a client would make for each width and format or named
+    # rendition, so warmed variants use the same transform options as serve_media
+    path = "/-/media/{}/{}".format(media_type, key)
+    for rendition in renditions or []:
+        yield Request.fake(path + "?" + urlencode({"rendition": rendition}))
+    if renditions and not widths and not formats:
+        return
+    for width, format in itertools.product(widths or [None], formats or [None]):
+        args = {}
+        if width:
+            args["w"] = width
+        if format:
+            args["format"] = format
+        yield Request.fake(path + ("?" + urlencode(args) if args else ""))
+
+
+async def warm_transform_cache(
+    datasette,
+    media_type,
+    keys,
+    transform_cache,
+    widths=None,
+    formats=None,
+    renditions=None,
+    processes=None,
+    progress=None,
+):
+    """
+    Renders transformed variants of every key into transform_cache, using
+    worker processes. Variants that are already cached are skipped, so an
+    interrupted run can be resumed. Returns counts of what happened.
+    """
+    plugin_config = datasette.plugin_config("datasette-media") or {}
+    config = plugin_config[media_type]
+    warm_config = config.get("warm") or {}
+    widths = widths or warm_config.get("widths")
+    formats = formats or warm_config.get("formats")
+    renditions = renditions or warm_config.get("renditions")
+    if not (widths or formats or renditions):
+        # Default to every configured rendition
+        renditions = list(config.get("renditions") or [])
+    database = datasette.get_database(config.get("database"))
+    pool = ProcessTransformPool(processes or os.cpu_count() or 1, max_tasks=0)
+    http_client = MediaHttpClient(plugin_config.get("http_client"))
+    counts = {"rendered": 0, "skipped": 0, "failed": 0}
+    keys_iter = iter(keys)
+
+    async def warm_key(key):
+        row = (await database.execute(config["sql"], {"key": key})).first()
+        source = utils.row_source(row) if row is not None else None
+        blob = row_blob(row) if row is not None else None
+        fingerprint = None
+        # Size of a BLOB that is only read if something needs rendering
+        unread_size = None
+        if source is None and blob is not None:
+            size = await database.execute_fn(lambda conn: blob_size(conn, *blob))
+            if size is not None:
+                # The same fingerprint as serve_media uses for BLOBs
+                fingerprint = blob_fingerprint(
+                    database.path, *blob, size, utils.row_version(row)
+                )
+                source = (None, None, None)
+                unread_size = size
+                if fingerprint is None:
+                    # In-memory databases have no version, so it is hashed
+                    content = await database.execute_fn(
+                        lambda conn: read_blob(conn, *blob, 0, size)
+                    )
+                    source = (None, content, None)
+                    unread_size = None
+        if source is None:
+            counts["failed"] += 1
+            return
+        filepath, content, content_url = source
+        if content_url:
+            # Identified by its upstream validators, as serve_media does
+            response = await http_client.get(content_url)
+            content = response.content
+            fingerprint = utils.url_fingerprint(
+                content_url, response.headers, content, utils.row_version(row)
+            )
+        fingerprint = fingerprint or utils.source_fingerprint(filepath, content)
+        pending = {}
+        for request in warm_requests(media_type, key, widths, formats, renditions):
+            transform = utils.should_transform(row, config, request)
+            if transform:
+                pending[cache_key(media_type, key, fingerprint, transform)] = transform
+        for transform_key in list(pending):
+            if transform_cache.get(transform_key) is not None:
+                counts["skipped"] += 1
+                del pending[transform_key]
+        if not pending:
+            return
+        if unread_size is not None:
+            content = await database.execute_fn(
+                lambda conn: read_blob(conn, *blob, 0, unread_size)
+            )
+        try:
+            # Every variant is rendered from a single decode of the source
+            outputs, _ = await pool.run(
+                utils.render_images,
+                content or None,
+                filepath,
+                config.get("format_options"),
+                list(pending.values()),
+                **utils.source_limits(config)
+            )
+        except Exception:
+            counts["failed"] += len(pending)
+            return
+        for transform_key, (body, content_type) in zip(pending, outputs):
+            transform_cache.set(transform_key, body, content_type.split("/")[-1])
+            counts["rendered"] += 1
+
+    async def worker():
+        for key in keys_iter:
+            try:
+                await warm_key(key)
+            except Exception:
+                counts["failed"] += 1
+            if progress is not None:
+                progress(1)
+
+    try:
+        await asyncio.gather(*[worker() for _ in range(pool.processes * 2)])
+    finally:
+        pool.shutdown()
+        await http_client.aclose()
+    return counts
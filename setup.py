@@ -33,7 +33,7 @@ setup(
     version=VERSION,
     packages=["datasette_media"],
     entry_points={"datasette": ["media = datasette_media"]},
-    install_requires=["datasette>=0.44", "Pillow>=7.1.2", "httpx>=0.13.3"],
+    install_requires=["datasette>=0.60", "Pillow>=7.1.2", "httpx>=0.18"],
     extras_require={
         "test": [
             "asgiref",
@@ -43,6 +43,7 @@ setup(
             "pytest-httpx>=0.4.0",
         ],
         "heif": ["pyheif>=0.4"],
+        "http2": ["httpx[http2]"],
     },
     tests_require=["datasette-media[test]"],
 )
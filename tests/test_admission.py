@@ -0,0 +1,50 @@
+from datasette_media.admission import AdmissionController, Overloaded
+import asyncio
+import pytest
+
+
+async def hold(controller, pixels=0, seconds=0.02):
+    async with controller.admit(pixels):
+        await asyncio.sleep(seconds)
+
+
+@pytest.mark.asyncio
+async def test_max_in_flight_and_queue():
+    controller = AdmissionController(max_in_flight=1, max_queued=1)
+    results = await asyncio.gather(
+        hold(controller), hold(controller), hold(controller), return_exceptions=True
+    )
+    # One runs, one waits in the queue and the third is rejected
+    assert results[:2] == [None, None]
+    assert isinstance(results[2], Overloaded)
+    assert controller.rejected == 1
+    assert (controller.in_flight, controller.queued, controller.pixels) == (0, 0, 0)
+
+
+@pytest.mark.asyncio
+async def test_unbounded_queue_waits():
+    controller = AdmissionController(max_in_flight=2)
+    peak = []
+
+    async def track():
+        async with controller.admit():
+            peak.append(controller.in_flight)
+            await asyncio.sleep(0.01)
+
+    await asyncio.gather(*[track() for _ in range(6)])
+    assert max(peak) == 2
+
+
+@pytest.mark.asyncio
+async def test_pixel_budget():
+    controller = AdmissionController(max_pixels=100, max_queued=0)
+    task = asyncio.ensure_future(hold(controller, pixels=60))
+    await asyncio.sleep(0.005)
+    # 60 + 50 is over budget and the queue is disabled
+    with pytest.raises(Overloaded):
+        await hold(controller, pixels=50)
+    # 60 + 40 fits
+    await hold(controller, pixels=40, seconds=0)
+    await task
+    # An image over the whole budget can still run on its own
+    await hold(controller, pixels=1000, seconds=0)
@@ -0,0 +1,62 @@
+from datasette_media.blob import blob_fingerprint, blob_size, read_blob, row_blob
+import pytest
+import sqlite3
+
+
+class NoBlobOpen:
+    # Connections before Python 3.11 have no blobopen()
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, *args):
+        return self.conn.execute(*args)
+
+
+@pytest.fixture
+def conn():
+    conn = sqlite3.connect(":memory:")
+    conn.execute('create table "my table" (id integer primary key, "my data" blob)')
+    conn.execute('insert into "my table" values (1, ?)', [bytes(range(256)) * 10])
+    conn.execute('insert into "my table" values (2, null)')
+    return conn
+
+
+@pytest.mark.parametrize("wrap", (lambda conn: conn, NoBlobOpen))
+def test_read_blob(conn, wrap):
+    conn = wrap(conn)
+    assert blob_size(conn, "my table", "my data", 1) == 2560
+    assert blob_size(conn, "my table", "my data", 2) is None
+    assert blob_size(conn, "my table", "my data", 3) is None
+    assert read_blob(conn, "my table", "my data", 1, 250, 10) == bytes(
+        [250, 251, 252, 253, 254, 255, 0, 1, 2, 3]
+    )
+    assert read_blob(conn, "my table", "my data", 1, 2555, 10) == bytes(
+        [251, 252, 253, 254, 255]
+    )
+
+
+def test_row_blob():
+    assert row_blob({"content": b"x"}) is None
+    assert row_blob(
+        {"content_table": "t", "content_column": "c", "content_rowid": 3}
+    ) == ("t", "c", 3)
+
+
+def test_blob_fingerprint(tmpdir):
+    db_path = str(tmpdir / "data.db")
+    assert blob_fingerprint(None, "t", "c", 1, 10) is None
+    conn = sqlite3.connect(db_path)
+    conn.execute("create table t (c blob)")
+    conn.commit()
+    before = blob_fingerprint(db_path, "t", "c", 1, 10)
+    assert before == blob_fingerprint(db_path, "t", "c", 1, 10)
+    assert before != blob_fingerprint(db_path, "t", "c", 2, 10)
+    conn.execute("insert into t values (randomblob(10000))")
+    conn.commit()
+    assert before != blob_fingerprint(db_path, "t", "c", 1, 10)
+    # A version from the row is used instead of the database's
+    versioned = blob_fingerprint(db_path, "t", "c", 1, 10, "v1")
+    conn.execute("insert into t values (randomblob(10))")
+    conn.commit()
+    assert versioned == blob_fingerprint(db_path, "t", "c", 1, 10, "v1")
+    assert blob_fingerprint(None, "t", "c", 1, 10, "v1") is not None
@@ -0,0 +1,164 @@
+from datasette_media.cache import (
+    DiskCache,
+    MemoryCache,
+    RowCache,
+    UpstreamCache,
+    cache_key,
+    freshness_lifetime,
+)
+import pytest
+import time
+
+
+def test_cache_key_is_stable():
+    key1 = cache_key("photo", "1", "url:x", {"width": 100, "format": None})
+    key2 = cache_key("photo", "1", "url:x", {"format": None, "width": 100})
+    assert key1 == key2
+    assert key1 != cache_key("photo", "1", "url:y", {"width": 100, "format": None})
+
+
+def test_disk_cache_get_set(tmpdir):
+    cache = DiskCache(tmpdir)
+    assert cache.get("a") is None
+    filepath = cache.set("a", b"hello", "PNG")
+    assert cache.get("a") == (filepath, "png")
+    assert open(filepath, "rb").read() == b"hello"
+    # A new instance picks up existing entries
+    assert DiskCache(tmpdir).get("a") == (filepath, "png")
+
+
+def test_disk_cache_shared_directory(tmpdir):
+    # Entries written by another process are found on disk and counted
+    cache1 = DiskCache(tmpdir, max_size=10)
+    cache2 = DiskCache(tmpdir, max_size=10)
+    filepath = cache2.set("a", b"1234", "webp")
+    assert cache1.get("a") == (filepath, "webp")
+    assert cache1.get("b") is None
+    cache1.set("b", b"1234", "jpeg")
+    cache1.set("c", b"1234", "jpeg")
+    assert cache1.get("a") is None
+    assert not tmpdir.join("a.webp").exists()
+
+
+def test_disk_cache_evicts_least_recently_used(tmpdir):
+    cache = DiskCache(tmpdir, max_size=10)
+    cache.set("a", b"1234", "jpeg")
+    cache.set("b", b"1234", "jpeg")
+    # Reading "a" makes "b" the least recently used
+    assert cache.get("a") is not None
+    cache.set("c", b"1234", "jpeg")
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+    assert cache.get("c") is not None
+    assert sorted(p.basename for p in tmpdir.listdir()) == ["a.jpeg", "c.jpeg"]
+
+
+def test_memory_cache_byte_budget():
+    cache = MemoryCache(max_size=10, ttl=0)
+    assert cache.get("a") is None
+    cache.set("a", "A", 4)
+    cache.set("b", "B", 4)
+    assert cache.get("a") == "A"
+    cache.set("c", "C", 4)
+    # "b" was least recently used so it was evicted to stay under 10 bytes
+    assert cache.get("b") is None
+    assert cache.get("c") == "C"
+    # Items larger than max_item_size are not stored
+    assert not cache.set("d", "D", 11)
+    assert cache.stats() == {
+        "hits": 2,
+        "misses": 2,
+        "evictions": 1,
+        "items": 2,
+        "size": 8,
+        "max_size": 10,
+    }
+
+
+def test_memory_cache_ttl(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+    cache = MemoryCache(max_size=10, ttl=5)
+    cache.set("a", "A", 1)
+    assert cache.get("a") == "A"
+    now[0] += 6
+    assert cache.get("a") is None
+    assert cache.stats()["size"] == 0
+
+
+def test_row_cache_version_ttl_and_lru(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+    cache = RowCache(2, ttl=10)
+    cache.set(("photo", "1"), "v1", {"filepath": "1.jpg"})
+    assert cache.get(("photo", "1"), "v1") == {"filepath": "1.jpg"}
+    # A different database version means the row may have changed
+    assert cache.get(("photo", "1"), "v2") is None
+    assert cache.get(("photo", "1"), "v1") is None
+    cache.set(("photo", "1"), "v1", {"filepath": "1.jpg"})
+    cache.set(("photo", "2"), "v1", {"filepath": "2.jpg"})
+    cache.get(("photo", "1"), "v1")
+    cache.set(("photo", "3"), "v1", {"filepath": "3.jpg"})
+    assert cache.get(("photo", "2"), "v1") is None
+    assert cache.get(("photo", "1"), "v1") is not None
+    now[0] += 11
+    assert cache.get(("photo", "1"), "v1") is None
+
+
+@pytest.mark.parametrize(
+    "headers,expected",
+    [
+        ({}, 0),
+        ({"cache-control": "max-age=60"}, 60),
+        ({"cache-control": "public, max-age=60", "age": "10"}, 50),
+        ({"cache-control": "max-age=60, s-maxage=120"}, 120),
+        ({"cache-control": "no-cache, max-age=60"}, 0),
+        ({"cache-control": "no-store"}, None),
+        ({"cache-control": "private, max-age=60"}, None),
+        (
+            {
+                "date": "Sun, 18 Oct 2026 12:00:00 GMT",
+                "expires": "Sun, 18 Oct 2026 12:05:00 GMT",
+            },
+            300,
+        ),
+        ({"expires": "0"}, 0),
+    ],
+)
+def test_freshness_lifetime(headers, expected):
+    assert freshness_lifetime(headers) == expected
+
+
+def test_upstream_cache(tmpdir, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, "time", lambda: now[0])
+    cache = UpstreamCache(tmpdir, max_size=10)
+    assert cache.get("http://a/") is None
+    # Neither cacheable for any time nor revalidatable
+    assert cache.set("http://a/", {"content-type": "image/png"}, b"1234") is None
+    entry = cache.set(
+        "http://a/", {"cache-control": "max-age=60", "etag": '"a"'}, b"1234"
+    )
+    assert open(entry["filepath"], "rb").read() == b"1234"
+    assert cache.get("http://a/")["headers"] == {
+        "cache-control": "max-age=60",
+        "etag": '"a"',
+    }
+    assert cache.is_fresh(cache.get("http://a/"))
+    now[0] += 61
+    entry = cache.get("http://a/")
+    assert not cache.is_fresh(entry)
+    assert cache.revalidation_headers(entry) == {"if-none-match": '"a"'}
+    entry = cache.refresh("http://a/", entry, {"cache-control": "max-age=10"})
+    assert cache.is_fresh(entry)
+    # A new instance picks up existing entries
+    assert UpstreamCache(tmpdir).get("http://a/")["headers"]["cache-control"] == (
+        "max-age=10"
+    )
+    # Bodies larger than the cache are not stored
+    assert cache.set("http://b/", {"cache-control": "max-age=60"}, b"x" * 11) is None
+    cache.set("http://b/", {"cache-control": "max-age=60"}, b"1234")
+    assert cache.get("http://a/") is not None
+    cache.set("http://c/", {"cache-control": "max-age=60"}, b"1234")
+    assert cache.get("http://b/") is None
+    assert len([p for p in tmpdir.listdir() if p.ext == ".body"]) == 2
@@ -0,0 +1,26 @@
+from datasette_media.http_client import MediaHttpClient
+import asyncio
+import pytest
+
+
+@pytest.mark.asyncio
+async def test_max_connections_per_host(httpx_mock):
+    httpx_mock.add_response(content=b"ok")
+    client = MediaHttpClient({"max_connections_per_host": 2})
+    active = {"a.example": 0, "b.example": 0}
+    peak = {"a.example": 0, "b.example": 0}
+
+    async def hold_slot(host):
+        async with client._host_slot("http://{}/".format(host)):
+            active[host] += 1
+            peak[host] = max(peak[host], active[host])
+            await asyncio.sleep(0.01)
+            active[host] -= 1
+
+    await asyncio.gather(
+        *[hold_slot("a.example") for _ in range(5)], hold_slot("b.example")
+    )
+    assert peak == {"a.example": 2, "b.example": 1}
+    response = await client.get("http://a.example/")
+    assert response.content == b"ok"
+    await client.aclose()
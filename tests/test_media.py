@@ -1,10 +1,21 @@
 from asgiref.testing import ApplicationCommunicator
+from concurrent.futures.process import BrokenProcessPool
 from datasette.app import Datasette
+from datasette_media import http_clients, memory_caches, responsive, utils
+from datasette_media.transform_pool import ProcessTransformPool
+import datasette_media
 from sqlite_utils import Database
 from PIL import Image
+import asyncio
+import email
+import email.policy
 import io
+import os
 import pathlib
 import pytest
+import threading
+import time
+import zipfile
 import httpx
 
 
@@ -340,7 +351,7 @@ async def test_content_filename(path, expected_size, httpx_mock):
     assert "JPEG" == image.format
 
 
-async def request(app, path):
+async def request(app, path, headers=None):
     # Sometimes we can't use httpx.AsyncClient to execute the test, because
     # we've mocked it using httpx_mock - so we do it the harder way instead
     if "?" in path:
@@ -355,7 +366,9 @@ async def request(app, path):
         "path": path,
         "raw_path": path.encode("utf-8"),
         "query_string": query_string,
-        "headers": [],
+        "headers": [
+            (k.encode("utf-8"), v.encode("utf-8")) for k, v in (headers or {}).items()
+        ],
     }
     instance = ApplicationCommunicator(app, scope)
     await instance.send_input({"type": "http.request"})
@@ -375,3 +388,1478 @@ async def request(app, path):
         if not message.get("more_body"):
             break
     return status_code, headers, body
+
+
+@pytest.mark.asyncio
+async def test_transform_cache_dir(tmpdir):
+    jpeg = str(pathlib.Path(__file__).parent / "example.jpg")
+    cache_dir = tmpdir / "cache"
+    ds = Datasette(
+        [],
+        memory=True,
+        metadata={
+            "plugins": {
+                "datasette-media": {
+                    "photos": {
+                        "sql": "select '{}' as filepath".format(jpeg),
+                        "enable_transform": True,
+                    },
+                    "transform_cache_dir": str(cache_dir),
+                }
+            }
+        },
+    )
+    response = await ds.client.get("/-/media/photos/1?w=100")
+    assert response.status_code == 200
+    cached = cache_dir.listdir()
+    assert len(cached) == 1
+    assert cached[0].ext == ".jpeg"
+    # Second request should be served from the cached file
+    cached[0].write_binary(b"cached")
+    response2 = await ds.client.get("/-/media/photos/1?w=100")
+    assert response2.status_code == 200
+    assert response2.content == b"cached"
+    assert response2.headers["content-type"] == "image/jpeg"
+    # A different size is a different cache entry
+    response3 = await ds.client.get("/-/media/photos/1?w=50")
+    assert Image.open(io.BytesIO(response3.content)).size == (50, 37)
+    assert len(cache_dir.listdir()) == 2
+
+
+@pytest.mark.asyncio
+async def test_memory_cache(tmpdir):
+    db_path = str(tmpdir / "photos.db")
+    jpeg = pathlib.Path(__file__).parent / "example.jpg"
+    db = Database(db_path)
+    db["photos"].insert({"id": 1, "content": jpeg.read_bytes()}, pk="id")
+    ds = Datasette(
+        [db_path],
+        metadata={
+            "plugins": {
+                "datasette-media": {
+                    "photos": {
+                        "sql": "select content from photos where id=:key",
+                        "database": "photos",
+                        "enable_transform": True,
+                    },
+                    "memory_cache_max_size": 1000000,
+                }
+            }
+        },
+    )
+    response = await ds.client.get("/-/media/photos/1?w=100")
+    assert response.status_code == 200
+    # Deleting the row should not affect the cached response
+    db["photos"].delete(1)
+    response2 = await ds.client.get("/-/media/photos/1?w=100")
+    assert response2.status_code == 200
+    assert response2.content == response.content
+    assert response2.headers["content-type"] == "image/jpeg"
+    response3 = await ds.client.get("/-/media/photos/1?w=50")
+    assert response3.status_code == 404
+    assert memory_caches[ds].stats()["hits"] == 1
+
+
+@pytest.mark.asyncio
+async def test_memory_cache_content_url(httpx_mock):
+    jpeg = pathlib.Path(__file__).parent / "example.jpg"
+    httpx_mock.add_response(
+        content=jpeg.read_bytes(),
+        headers={
+            "Content-Type": "image/jpeg",
+            "Content-Length": str(len(jpeg.read_bytes())),
+        },
+    )
+    app = Datasette(
+        [],
+        memory=True,
+        metadata={
+            "plugins": {
+                "datasette-media": {
+                    "photos": {
+                        "sql": "select 'http://example/example.jpg' as content_url"
+                    },
+                    "memory_cache_max_size": 1000000,
+                }
+            }
+        },
+    ).app()
+    status_code, headers, body = await request(app, "/-/media/photos/1")
+    assert status_code == 200
+    status_code2, headers2, body2 = await request(app, "/-/media/photos/1")
+    assert status_code2 == 200
+    assert body2 == body == jpeg.read_bytes()
+    assert headers2["content-type"] == "image/jpeg"
+    assert len(httpx_mock.get_requests()) == 1
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("transform", [False, True])
+async def test_upstream_cache_content_url(httpx_mock, tmpdir, transform):
+    jpeg = (pathlib.Path(__file__).parent / "example.jpg").read_bytes()
+
+    def upstream(request):
+        if request.headers.get("if-none-match") == '"v1"':
+            return httpx.Response(304, headers={"cache-control": "no-cache"})
+        return httpx.Response(
+            200,
+            content=jpeg,
+            headers={
+                "content-type": "image/jpeg",
+                "etag": '"v1"',
+                "cache-control": "no-cache",
+            },
+        )
+
+    httpx_mock.add_callback(upstream)
+    ds = Datasette(
+        [],
+        memory=True,
+        metadata={
+            "plugins": {
+                "datasette-media": {
+                    "photos": {
+                        "sql": "select 'http://example/example.jpg' as content_url",
+                        "enable_transform": True,
+                    },
+                    "upstream_cache_dir": str(tmpdir),
+                }
+            }
+        },
+    )
+    path = "/-/media/photos/1" + ("?w=50" if transform else "")
+    response = await ds.client.get(path)
+    assert response.status_code == 200
+    # no-cache, so the stored copy is revalidated with If-None-Match
+    response2 = await ds.client.get(path)
+    assert response2.status_code == 200
+    assert response2.content == response.content
+    if not transform:
+        assert response.content == jpeg
+        assert response2.headers["etag"] == '"v1"'
+        response3 = await ds.client.get(path, headers={"if-none-match": '"v1"'})
+        assert response3.status_code == 304
+    requests = httpx_mock.get_requests()
+    assert "if-none-match" not in requests[0].headers
+    assert requests[1].headers["if-none-match"] == '"v1"'
+    counters = datasette_media.get_metrics(ds).as_dict()["photos"]["counters"]
+    assert counters["upstream_cache_misses"] == 1
+    assert counters["upstream_cache_revalidations"] == len(requests) - 1
+
+
+@pytest.mark.asyncio
+async def test_upstream_cache_fresh_range(httpx_mock, tmpdir):
+    httpx_mock.add_response(
+        content=b"Hello world",
+        headers={"content-type": "text/plain", "cache-control": "max-age=60"},
+    )
+    ds = Datasette(
+        [],
+        memory=True,
+        metadata={
+            "plugins": {
+                "datasette-media": {
+                    "text": {"sql": "select 'http://example/hello.txt' as content_url"},
+                    "upstream_cache_dir": str(tmpdir),
+                }
+            }
+        },
+    )
+    response = await ds.client.get("/-/media/text/1")
+    assert response.content == b"Hello world"
+    # Served from the cache, which can answer range requests itself
+    response2 = await ds.client.get("/-/media/text/1", headers={"range": "bytes=0-4"})
+    assert response2.status_code == 206
+    assert response2.content == b"Hello"
+    assert len(httpx_mock.get_requests()) == 1
+    counters = datasette_media.get_metrics(ds).as_dict()["text"]["counters"]
+    assert counters["upstream_cache_hits"] == 1
+
+
+@pytest.mark.asyncio
+async def test_max_source_pixels():
+    jpeg = pathlib.Path(__file__).parent / "example.jpg"
+    sql = "select '{}' as filepath".format(jpeg)
+    ds = Datasette(
+        [],
+        memory=True,
+        metadata={
+            "plugins": {
+                "datasette-media": {
+                    "photos": {
+                        "sql": sql,
+                        "enable_transform": True,
+                        "max_source_pixels": 10000,
+                    },
+                    "reduced": {
+                        "sql": sql,
+                        "enable_transform": True,
+                        "max_source_pixels": 10000,
+                        "reduce_large_sources": True,
+                    },
+                }
+            }
+        },
+    )
+    # example.jpg is 313x234
+    response = await ds.client.get("/-/media/photos/1?w=300")
+    assert response.status_code == 422
+    assert "313x234 image is larger than the 10000 pixel limit" in response.text
+    # Small outputs are decoded at a reduced scale anyway
+    response2 = await ds.client.get("/-/media/photos/1?w=30")
+    assert response2.status_code == 200
+    response3 = await ds.client.get("/-/media/reduced/1?w=300")
+    assert response3.status_code == 200
+    assert Image.open(io.BytesIO(response3.content)).size == (300, 224)
+    counters = datasette_media.get_metrics(ds).as_dict()
+    assert counters["photos"]["counters"]["source_too_large"] == 1
+    assert "source_too_large" not in counters["reduced"]["counters"]
+
+
+@pytest.mark.asyncio
+async def test_media_img_and_picture(tmpdir):
+    jpeg = pathlib.Path(__file__).parent / "example.jpg"
+    db_path = str(tmpdir / "photos.db")
+    Database(db_path)["photos"].insert(
+        {"id": 1, "key": "a/b", "filepath": str(jpeg)}, pk="id"
+    )
+    ds = Datasette(
+        [db_path],
+        metadata={
+            "plugins": {
+                "datasette-media": {
+                    "photo": {
+                        "sql": "select filepath from photos where key=:key",
+                        "database": "photos",
+                        "enable_transform": True,
+                        "renditions": {
+                            "large": {"width": 800},
+                            "small": {"width": 100},
+                            "square": {"width": 100, "height": 100, "fit": "cover"},
+                        },
+                        "srcset": {"sizes": "50vw", "formats": ["webp"]},
+                        "render_cell": {"table": "photos", "column": "key"},
+                    }
+                }
+            }
+        },
+    )
+    version = utils.source_version(utils.source_fingerprint(str(jpeg)))
+    url = "/-/media/photo/a/b?rendition={}&v=" + version
+    html = await responsive.media_img(ds, "photo", "a/b", alt="A & B")
+    assert html == (
+        '<img src="{large}" srcset="{small} 100w, {large} 800w" sizes="50vw"'
+        ' alt="A &amp; B">'
+    ).format(
+        large=url.format("large").replace("&", "&amp;"),
+        small=url.format("small").replace("&", "&amp;"),
+    )
+    picture = await responsive.media_picture(ds, "photo", "a/b", renditions=["small"])
+    assert picture.startswith(
+        '<picture><source type="image/webp" srcset="/-/media/photo/a/b?'
+        'rendition=small&amp;format=webp&amp;v={} 100w" sizes="50vw">'.format(version)
+    )
+    # The current version can be cached forever
+    response = await ds.client.get(
+        "/-/media/photo/a/b?rendition=small&format=webp&v=" + version
+    )
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "image/webp"
+    assert response.headers["cache-control"] == "public, max-age=31536000, immutable"
+    assert Image.open(io.BytesIO(response.content)).width == 100
+    stale = await ds.client.get("/-/media/photo/a/b?rendition=small&v=stale")
+    assert stale.status_code == 200
+    assert "cache-control" not in stale.headers
+    # render_cell shows the key column as images
+    table = await ds.client.get("/photos/photos")
+    assert 'loading="lazy"' in table.text
+    assert "rendition=large&amp;v={}".format(version) in table.text
+
+
+@pytest.mark.asyncio
+async def test_media_img_version_column(tmpdir, monkeypatch):
+    jpeg = pathlib.Path(__file__).parent / "example.jpg"
+    db_path = str(tmpdir / "photos.db")
+    Database(db_path)["photos"].insert(
+        {"id": 1, "key": "a", "filepath": str(jpeg), "sha": "abc123"}, pk="id"
+    )
+    ds = Datasette(
+        [db_path],
+        metadata={
+            "plugins": {
+                "datasette-media": {
+                    "photo": {
+                        "sql": "select filepath, sha as version from photos where key=:key",
+                        "database": "photos",
+                        "renditions": {"small": {"width": 100}},
+                    }
+                }
+            }
+        },
+    )
+
+    # The version column is used without looking at the source
+    def fail(*args, **kwargs):
+        assert False, "source_fingerprint should not be called"
+
+    monkeypatch.setattr(utils, "source_fingerprint", fail)
+    html = await responsive.media_img(ds, "photo", "a")
+    assert "rendition=small&amp;v=abc123" in html
+    monkeypatch.undo()
+    response = await ds.client.get("/-/media/photo/a?rendition=small&v=abc123")
+    assert response.status_code == 200
+    assert response.headers["cache-control"] == "public, max-age=31536000, immutable"
+    fingerprint = utils.source_fingerprint(str(jpeg))
+    response = await ds.client.get(
+        "/-/media/photo/a?rendition=small&v=" + utils.source_version(fingerprint)
+    )
+    assert "cache-control" not in response.headers
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("media_type", ["on_disk", "blob", "resized"])
+async def test_etag_conditional_get(media_type, monkeypatch):
+    jpeg = pathlib.Path(__file__).parent / "example.jpg"
+    ds = Datasette(
+        metadata={
+            "plugins": {
+                "datasette-media": {
+                    "on_disk": {
+                        "sql": "select '{}' as filepath".format(jpeg),
+                        "cache_control": "max-age=3600",
+                    },
+                    "blob": {
+                        "sql": "select X'{}' as content".format(
+                            jpeg.read_bytes().hex()
+                        ),
+                        "cache_control": "max-age=3600",
+                    },
+                    "resized": {
+                        "sql": "select '{}' as filepath, 50 as resize_width".format(
+                            jpeg
+                        ),
+                        "cache_control": "max-age=3600",
+                    },
+                }
+            }
+        }
+    )
+    response = await ds.client.get("/-/media/{}/1".format(media_type))
+    assert response.status_code == 200
+    etag = response.headers["etag"]
+    assert etag.startswith('"')
+    assert response.headers["cache-control"] == "max-age=3600"
+    if media_type != "blob":
+        assert "last-modified" in response.headers
+
+    # Matching If-None-Match should return a 304 without doing any transform work
+    def fail(*args, **kwargs):
+        assert False, "transform_image should not be called"
+
+    monkeypatch.setattr(utils, "transform_image", fail)
+    response2 = await ds.client.get(
+        "/-/media/{}/1".format(media_type), headers={"if-none-match": etag}
+    )
+    assert response2.status_code == 304
+    assert response2.content == b""
+    assert response2.headers["etag"] == etag
+    assert response2.headers["cache-control"] == "max-age=3600"
+    monkeypatch.undo()
+
+    response3 = await ds.client.get(
+        "/-/media/{}/1".format(media_type), headers={"if-none-match": '"other"'}
+    )
+    assert response3.status_code == 200
+
+    if media_type != "blob":
+        response4 = await ds.client.get(
+            "/-/media/{}/1".format(media_type),
+            headers={"if-modified-since": response.headers["last-modified"]},
+        )
+        assert response4.status_code == 304
+
+
+@pytest.mark.asyncio
+async def test_etag_varies_with_transform():
+    jpeg = pathlib.Path(__file__).parent / "example.jpg"
+    ds = Datasette(
+        metadata={
+            "plugins": {
+                "datasette-media": {
+                    "photos": {
+                        "sql": "select '{}' as filepath".format(jpeg),
+                        "enable_transform": True,
+                    },
+                }
+            }
+        }
+    )
+    etags = set()
+    for path in (
+        "/-/media/photos/1",
+        "/-/media/photos/1?w=50",
+        "/-/media/photos/1?w=60",
+    ):
+        etags.add((await ds.client.get(path)).headers["etag"])
+    assert len(etags) == 3
+
+
+@pytest.mark.asyncio
+async def test_etag_content_url_transform(httpx_mock):
+    jpeg = pathlib.Path(__file__).parent / "example.jpg"
+    httpx_mock.add_response(
+        content=jpeg.read_bytes(),
+        headers={"Content-Type": "image/jpeg", "ETag": '"upstream"'},
+    )
+    ds = Datasette(
+        metadata={
+            "plugins": {
+                "datasette-media": {
+                    "photos": {
+                        "sql": "select 'http://example/example.jpg' as content_url, 50 as resize_width"
+                    },
+                }
+            }
+        }
+    )
+    app = ds.app()
+    status_code, headers, body = await request(app, "/-/media/photos/1")
+    assert status_code == 200
+    etag = headers["etag"]
+    assert etag != '"upstream"'
+    status_code, headers, body = await request(
+        app, "/-/media/photos/1", headers={"if-none-match": etag}
+    )
+    assert status_code == 304
+    assert body == b""
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("upstream_cache", [False, True])
+async def test_etag_content_url_transform_cache(httpx_mock, tmpdir, upstream_cache):
+    upstream = {"etag": '"v1"', "color": "red"}
+
+    def image(request):
+        buffer = io.BytesIO()
+        Image.new("RGB", (100, 100), upstream["color"]).save(buffer, "PNG")
+        return httpx.Response(
+            200,
+            content=buffer.getvalue(),
+            headers={
+                "content-type": "image/png",
+                "etag": upstream["etag"],
+                "cache-control": "max-age=3600",
+            },
+        )
+
+    httpx_mock.add_callback(image)
+    plugin_config = {
+        "photos": {
+            "sql": "select 'http://example/1.png' as content_url, 50 as resize_width"
+        },
+        "transform_cache_dir": str(tmpdir / "transform"),
+    }
+    if upstream_cache:
+        plugin_config["upstream_cache_dir"] = str(tmpdir / "upstream")
+    ds = Datasette(metadata={"plugins": {"datasette-media": plugin_config}})
+    app = ds.app()
+    # The miss and every later hit send the same validator
+    etags = []
+    for _ in range(3):
+        status_code, headers, body = await request(app, "/-/media/photos/1")
+        assert status_code == 200
+        etags.append(headers["etag"])
+    assert len(set(etags)) == 1
+    status_code, headers, body = await request(
+        app, "/-/media/photos/1", headers={"if-none-match": etags[0]}
+    )
+    assert status_code == 304
+    counters = datasette_media.get_metrics(ds).as_dict()["photos"]["counters"]
+    assert counters["transforms"] == 1
+    if upstream_cache:
+        # Fresh copies are identified without asking upstream
+        assert len(httpx_mock.get_requests()) == 1
+        return
+    # Without an upstream cache, upstream is asked each time, so a changed
+    # file is transformed again and gets a new ETag
+    assert len(httpx_mock.get_requests()) == 4
+    upstream.update({"etag": '"v2"', "color": "blue"})
+    status_code, headers, body = await request(
+        app, "/-/media/photos/1", headers={"if-none-match": etags[0]}
+    )
+    assert status_code == 200
+    assert headers["etag"] != etags[0]
+    red, _, blue = Image.open(io.BytesIO(body)).getpixel((0, 0))
+    assert blue > 200 and red < 50
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("cache", ["transform_cache_dir", "upstream_cache_dir"])
+async def test_content_url_version_column(httpx_mock, tmpdir, cache):
+    # Changing the version column replaces cached copies of the content_url
+    upstream = {"color": "red"}
+
+    def image(request):
+        buffer = io.BytesIO()
+        Image.new("RGB", (100, 100), upstream["color"]).save(buffer, "PNG")
+        return httpx.Response(
+            200,
+            content=buffer.getvalue(),
+            headers={"content-type": "image/png", "cache-control": "max-age=3600"},
+        )
+
+    httpx_mock.add_callback(image)
+    db_path = str(tmpdir / "photos.db")
+    db = Database(db_path)
+    db["photos"].insert({"id": 1, "url": "http://example/1.png", "version": 1}, pk="id")
+    ds = Datasette(
+        [db_path],
+        metadata={
+            "plugins": {
+                "datasette-media": {
+                    "photo": {
+                        "sql": "select url as content_url, version from photos where id=:key",
+                        "database": "photos",
+                        "enable_transform": True,
+                    },
+                    cache: str(tmpdir / "cache"),
+                }
+            }
+        },
+    )
+
+    async def color(version):
+        response = await ds.client.get(
+            "/-/media/photo/1?w=50&format=png&v={}".format(version)
+        )
+        assert response.status_code == 200
+        assert (
+            response.headers["cache-control"] == "public, max-age=31536000, immutable"
+        )
+        return Image.open(io.BytesIO(response.content)).getpixel((0, 0))
+
+    assert await color(1) == (255, 0, 0)
+    upstream["color"] = "blue"
+    db["photos"].update(1, {"version": 2})
+    assert await color(2) == (0, 0, 255)
+
+
+@pytest.mark.asyncio
+async def test_content_url_forwards_conditional_headers(httpx_mock):
+    httpx_mock.add_response(
+        status_code=304, headers={"ETag": '"upstream"', "Content-Type": "image/jpeg"}
+    )
+    ds = Datasette(
+        metadata={
+            "plugins": {
+                "datasette-media": {
+                    "photos": {
+                        "sql": "select 'http://example/example.jpg' as content_url",
+                        "cache_control": "public, max-age=60",
+                    },
+                }
+            }
+        }
+    )
+    status_code, headers, body = await request(
+        ds.app(), "/-/media/photos/1", headers={"if-none-match": '"upstream"'}
+    )
+    assert status_code == 304
+    assert headers["etag"] == '"upstream"'
+    assert headers["cache-control"] == "public, max-age=60"
+    assert httpx_mock.get_requests()[0].headers["if-none-match"] == '"upstream"'
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("media_type", ["on_disk", "blob"])
+async def test_range_requests(tmpdir, media_type):
+    filepath = tmpdir / "hello.txt"
+    filepath.write_text("0123456789", "utf-8")
+    ds = Datasette(
+        metadata={
+            "plugins": {
+                "datasette-media": {
+                    "on_disk": {"sql": "select '{}' as filepath".format(filepath)},
+                    "blob": {
+                        "sql": "select '0123456789' as content, 'text/plain' as content_type"
+                    },
+                }
+            }
+        }
+    )
+    path = "/-/media/{}/1".format(media_type)
+    response = await ds.client.get(path)
+    assert response.status_code == 200
+    assert response.headers["accept-ranges"] == "bytes"
+    etag = response.headers["etag"]
+
+    response = await ds.client.get(path, headers={"range": "bytes=2-4"})
+    assert response.status_code == 206
+    assert response.content == b"234"
+    assert response.headers["content-range"] == "bytes 2-4/10"
+    assert response.headers["content-type"].startswith("text/plain")
+
+    response = await ds.client.get(path, headers={"range": "bytes=-2"})
+    assert response.status_code == 206
+    assert response.content == b"89"
+
+    # Multiple ranges return multipart/byteranges
+    response = await ds.client.get(path, headers={"range": "bytes=0-1,5-6"})
+    assert response.status_code == 206
+    content_type = response.headers["content-type"]
+    assert content_type.startswith("multipart/byteranges; boundary=")
+    boundary = content_type.split("boundary=")[1]
+    assert response.content == (
+        "--{b}\r\nContent-Type: text/plain\r\nContent-Range: bytes 0-1/10\r\n\r\n01\r\n"
+        "--{b}\r\nContent-Type: text/plain\r\nContent-Range: bytes 5-6/10\r\n\r\n56\r\n"
+        "--{b}--\r\n"
+    ).format(b=boundary).encode("utf-8")
+    if media_type == "on_disk":
+        assert int(response.headers["content-length"]) == len(response.content)
+
+    response = await ds.client.get(path, headers={"range": "bytes=20-30"})
+    assert response.status_code == 416
+    assert response.headers["content-range"] == "bytes */10"
+
+    # If-Range with a stale ETag returns the full body
+    response = await ds.client.get(
+        path, headers={"range": "bytes=2-4", "if-range": '"stale"'}
+    )
+    assert response.status_code == 200
+    assert response.content == b"0123456789"
+    response = await ds.client.get(
+        path, headers={"range": "bytes=2-4", "if-range": etag}
+    )
+    assert response.status_code == 206
+
+
+@pytest.mark.asyncio
+async def test_range_content_url(httpx_mock):
+    httpx_mock.add_response(
+        status_code=206,
+        content=b"234",
+        headers={"Content-Type": "text/plain", "Content-Range": "bytes 2-4/10"},
+    )
+    ds = Datasette(
+        metadata={
+            "plugins": {
+                "datasette-media": {
+                    "text": {"sql": "select 'http://example/hello.txt' as content_url"},
+                }
+            }
+        }
+    )
+    status_code, headers, body = await request(
+        ds.app(), "/-/media/text/1", headers={"range": "bytes=2-4"}
+    )
+    assert status_code == 206
+    assert body == b"234"
+    assert headers["content-range"] == "bytes 2-4/10"
+    assert httpx_mock.get_requests()[0].headers["range"] == "bytes=2-4"
+
+
+@pytest.mark.asyncio
+async def test_memory_cache_skips_upstream_errors(httpx_mock):
+    httpx_mock.add_response(
+        status_code=500,
+        content=b"oops",
+        headers={"Content-Type": "text/plain", "Content-Length": "4"},
+    )
+    httpx_mock.add_response(
+        content=b"fine",
+        headers={"Content-Type": "text/plain", "Content-Length": "4"},
+    )
+    ds = Datasette(
+        metadata={
+            "plugins": {
+                "datasette-media": {
+                    "text": {"sql": "select 'http://example/hello.txt' as content_url"},
+                    "memory_cache_max_size": 1000,
+                }
+            }
+        }
+    )
+    app = ds.app()
+    status_code, headers, body = await request(app, "/-/media/text/1")
+    assert body == b"oops"
+    status_code, headers, body = await request(app, "/-/media/text/1")
+    assert body == b"fine"
+    assert len(httpx_mock.get_requests()) == 2
+
+
+@pytest.mark.asyncio
+async def test_range_memory_cached_content_url(httpx_mock):
+    httpx_mock.add_response(
+        content=b"0123456789",
+        headers={"Content-Type": "text/plain", "Content-Length": "10"},
+    )
+    ds = Datasette(
+        metadata={
+            "plugins": {
+                "datasette-media": {
+                    "text": {"sql": "select 'http://example/hello.txt' as content_url"},
+                    "memory_cache_max_size": 1000,
+                }
+            }
+        }
+    )
+    app = ds.app()
+    status_code, headers, body = await request(app, "/-/media/text/1")
+    assert body == b"0123456789"
+    # Served from the memory cache, with headers describing the range
+    status_code, headers, body = await request(
+        app, "/-/media/text/1", headers={"range": "bytes=2-4"}
+    )
+    assert status_code == 206
+    assert body == b"234"
+    assert headers["content-range"] == "bytes 2-4/10"
+    assert headers.get("content-length") in (None, "3")
+    assert len(httpx_mock.get_requests()) == 1
+
+
+@pytest.mark.asyncio
+async def test_http_client_shared_and_closed_on_shutdown(httpx_mock):
+    jpeg = pathlib.Path(__file__).parent / "example.jpg"
+    httpx_mock.add_response(
+        content=jpeg.read_bytes(), headers={"Content-Type": "image/jpeg"}
+    )
+    ds = Datasette(
+        metadata={
+            "plugins": {
+                "datasette-media": {
+                    "photos": {
+                        "sql": "select 'http://example/example.jpg' as content_url"
+                    },
+                    "http_client": {"max_connections": 5, "timeout": 10},
+                }
+            }
+        }
+    )
+    app = ds.app()
+    await request(app, "/-/media/photos/1")
+    client = http_clients[ds]
+    await request(app, "/-/media/photos/1")
+    assert http_clients[ds] is client
+    assert client.client.timeout.read == 10
+    # Server shutdown closes the client
+    instance = ApplicationCommunicator(app, {"type": "lifespan"})
+    await instance.send_input({"type": "lifespan.startup"})
+    assert (await instance.receive_output(2))["type"] == "lifespan.startup.complete"
+    await instance.send_input({"type": "lifespan.shutdown"})
+    assert (await instance.receive_output(2))["type"] == "lifespan.shutdown.complete"
+    assert client.client.is_closed
+    assert ds not in http_clients
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("broken", [False, True])
+async def test_transform_processes(tmpdir, monkeypatch, broken):
+    jpeg = pathlib.Path(__file__).parent / "example.jpg"
+    monkeypatch.setattr(datasette_media, "transform_process_pool", None)
+    runs = []
+    if broken:
+
+        async def run(self, *args, **kwargs):
+            runs.append(args)
+            raise BrokenProcessPool()
+
+        monkeypatch.setattr(ProcessTransformPool, "run", run)
+    ds = Datasette(
+        metadata={
+            "plugins": {
+                "datasette-media": {
+                    "on_disk": {
+                        "sql": "select '{}' as filepath, 100 as resize_width".format(
+                            jpeg
+                        )
+                    },
+                    "blob": {
+                        "sql": "select X'{}' as content, 'png' as output_format".format(
+                            jpeg.read_bytes().hex()
+                        )
+                    },
+                    "transform_processes": 1,
+                }
+            }
+        }
+    )
+    try:
+        response = await ds.client.get("/-/media/on_disk/1")
+        if broken:
+            # Retried once in a fresh pool, never in this process
+            assert response.status_code == 500
+            assert len(runs) == 2
+            counters = datasette_media.get_metrics(ds).as_dict()["on_disk"]
+            assert counters["counters"]["transform_crashes"] == 1
+            return
+        assert response.status_code == 200
+        assert Image.open(io.BytesIO(response.content)).size == (100, 74)
+        response = await ds.client.get("/-/media/blob/1")
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "image/png"
+        assert Image.open(io.BytesIO(response.content)).format == "PNG"
+    finally:
+        datasette_media.transform_process_pool.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_concurrent_requests_are_coalesced(monkeypatch):
+    jpeg = pathlib.Path(__file__).parent / "example.jpg"
+    calls = []
+    original_transform_image = utils.transform_image
+
+    def transform_image(*args, **kwargs):
+        calls.append(kwargs)
+        time.sleep(0.05)
+        return original_transform_image(*args, **kwargs)
+
+    monkeypatch.setattr(utils, "transform_image", transform_image)
+    ds = Datasette(
+        metadata={
+            "plugins": {
+                "datasette-media": {
+                    "photos": {
+                        "sql": "select '{}' as filepath".format(jpeg),
+                        "enable_transform": True,
+                    }
+                }
+            }
+        }
+    )
+    responses = await asyncio.gather(
+        *[ds.client.get("/-/media/photos/1?w=100") for _ in range(5)],
+        ds.client.get("/-/media/photos/1?w=50"),
+    )
+    assert [r.status_code for r in responses] == [200] * 6
+    assert len({r.content for r in responses[:5]}) == 1
+    assert sorted(c["width"] for c in calls) == [50, 100]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("overload", [None, "original"])
+async def test_transform_admission_control(monkeypatch, overload):
+    jpeg = pathlib.Path(__file__).parent / "example.jpg"
+    original_transform_image = utils.transform_image
+
+    def slow_transform_image(*args, **kwargs):
+        time.sleep(0.05)
+        return original_transform_image(*args, **kwargs)
+
+    monkeypatch.setattr(utils, "transform_image", slow_transform_image)
+    config = {
+        "sql": "select '{}' as filepath".format(jpeg),
+        "enable_transform": True,
+        "max_transforms_in_flight": 1,
+        "max_transforms_queued": 0,
+        "retry_after": 5,
+    }
+    if overload:
+        config["overload"] = overload
+    ds = Datasette(metadata={"plugins": {"datasette-media": {"photos": config}}})
+    responses = await asyncio.gather(
+        ds.client.get("/-/media/photos/1?w=100"),
+        ds.client.get("/-/media/photos/1?w=50"),
+    )
+    assert responses[0].status_code == 200
+    assert Image.open(io.BytesIO(responses[0].content)).size == (100, 74)
+    if overload == "original":
+        assert responses[1].status_code == 200
+        assert responses[1].content == jpeg.read_bytes()
+        assert responses[1].headers["cache-control"] == "no-store"
+    else:
+        assert responses[1].status_code == 503
+        assert responses[1].headers["retry-after"] == "5"
+
+
+@pytest.mark.asyncio
+async def test_transform_reads_file_off_event_loop(monkeypatch):
+    jpeg = pathlib.Path(__file__).parent / "example.jpg"
+    threads = []
+    original_open_image = utils.open_image
+
+    def open_image(*args, **kwargs):
+        threads.append(threading.current_thread())
+        return original_open_image(*args, **kwargs)
+
+    monkeypatch.setattr(utils, "open_image", open_image)
+    ds = Datasette(
+        metadata={
+            "plugins": {
+                "datasette-media": {
+                    "photos": {
+                        "sql": "select '{}' as filepath, 100 as resize_width".format(
+                            jpeg
+                        )
+                    }
+                }
+            }
+        }
+    )
+    response = await ds.client.get("/-/media/photos/1")
+    assert response.status_code == 200
+    assert len(threads) == 1
+    assert threads[0] is not threading.main_thread()
+
+
+@pytest.mark.asyncio
+async def test_renditions():
+    jpeg = pathlib.Path(__file__).parent / "example.jpg"
+    ds = Datasette(
+        metadata={
+            "plugins": {
+                "datasette-media": {
+                    "photos": {
+                        "sql": "select '{}' as filepath".format(jpeg),
+                        "enable_transform": True,
+                        "arbitrary_sizes": "reject",
+                        "renditions": {
+                            "thumb": {
+                                "width": 50,
+                                "height": 50,
+                                "fit": "cover",
+                                "format": "png",
+                            },
+                            "small": {"width": 100, "quality": 50},
+                        },
+                    }
+                }
+            }
+        }
+    )
+    response = await ds.client.get("/-/media/photos/1?rendition=thumb")
+    assert response.status_code == 200
+    image = Image.open(io.BytesIO(response.content))
+    assert (image.size, image.format) == ((50, 50), "PNG")
+    response = await ds.client.get("/-/media/photos/1?rendition=small")
+    image = Image.open(io.BytesIO(response.content))
+    assert (image.size, image.format) == ((100, 74), "JPEG")
+    response = await ds.client.get("/-/media/photos/1?rendition=nope")
+    assert response.status_code == 400
+    assert "Unknown rendition: nope" in response.text
+    response = await ds.client.get("/-/media/photos/1?w=60")
+    assert response.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_format_negotiation():
+    jpeg = pathlib.Path(__file__).parent / "example.jpg"
+    ds = Datasette(
+        metadata={
+            "plugins": {
+                "datasette-media": {
+                    "photos": {
+                        "sql": "select '{}' as filepath".format(jpeg),
+                        "enable_transform": True,
+                        "negotiate_formats": ["webp"],
+                        "format_options": {"webp": {"quality": 70}},
+                    }
+                }
+            }
+        }
+    )
+    response = await ds.client.get(
+        "/-/media/photos/1?w=100", headers={"accept": "image/webp,*/*"}
+    )
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "image/webp"
+    assert response.headers["vary"].startswith("Accept")
+    assert Image.open(io.BytesIO(response.content)).format == "WEBP"
+    webp_etag = response.headers["etag"]
+    response = await ds.client.get("/-/media/photos/1?w=100", headers={"accept": "*/*"})
+    assert response.headers["content-type"] == "image/jpeg"
+    assert response.headers["vary"].startswith("Accept")
+    assert response.headers["etag"] != webp_etag
+    # An explicit format wins over negotiation
+    response = await ds.client.get(
+        "/-/media/photos/1?w=100&format=png", headers={"accept": "image/webp"}
+    )
+    assert response.headers["content-type"] == "image/png"
+
+
+@pytest.mark.asyncio
+async def test_transform_encodes_off_event_loop(monkeypatch):
+    encode_threads = []
+    encode_image = utils.encode_image
+
+    def spy(*args, **kwargs):
+        encode_threads.append(threading.current_thread())
+        return encode_image(*args, **kwargs)
+
+    monkeypatch.setattr(utils, "encode_image", spy)
+    jpeg = pathlib.Path(__file__).parent / "example.jpg"
+    ds = Datasette(
+        metadata={
+            "plugins": {
+                "datasette-media": {
+                    "photos": {
+                        "sql": "select '{}' as filepath".format(jpeg),
+                        "enable_transform": True,
+                    }
+                }
+            }
+        }
+    )
+    response = await ds.client.get("/-/media/photos/1?w=50&format=png")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "image/png"
+    assert Image.open(io.BytesIO(response.content)).size[0] == 50
+    assert encode_threads
+    assert threading.main_thread() not in encode_threads
+
+
+@pytest.mark.asyncio
+async def test_filepath_stat_off_event_loop(tmpdir, monkeypatch):
+    jpeg = str(pathlib.Path(__file__).parent / "example.jpg")
+    ds = Datasette(
+        metadata={
+            "plugins": {
+                "datasette-media": {
+                    "photo": {
+                        "sql": "select '{}' as filepath".format(jpeg),
+                        "enable_transform": True,
+                    },
+                    "transform_cache_dir": str(tmpdir / "cache"),
+                }
+            }
+        },
+    )
+    calls = []
+    original_stat, original_utime = os.stat, os.utime
+
+    def stat(path, *args, **kwargs):
+        if str(path) == jpeg:
+            calls.append(("stat", threading.current_thread()))
+        return original_stat(path, *args, **kwargs)
+
+    def utime(path, *args, **kwargs):
+        calls.append(("utime", threading.current_thread()))
+        return original_utime(path, *args, **kwargs)
+
+    monkeypatch.setattr(os, "stat", stat)
+    monkeypatch.setattr(os, "utime", utime)
+    for path in ("/-/media/photo/1", "/-/media/photo/1?w=50", "/-/media/photo/1?w=50"):
+        response = await ds.client.get(path)
+        assert response.status_code == 200
+        assert "last-modified" in response.headers
+    assert ("utime", threading.current_thread()) not in calls
+    assert ("stat", threading.current_thread()) not in calls
+    assert len(calls) >= 4
+
+
+@pytest.mark.asyncio
+async def test_media_blob_transform_reads_blob_only_on_miss(tmpdir, monkeypatch):
+    db_path = str(tmpdir / "attachments.db")
+    jpeg = (pathlib.Path(__file__).parent / "example.jpg").read_bytes()
+    Database(db_path)["attachments"].insert({"id": 1, "data": jpeg}, pk="id")
+    ds = Datasette(
+        [db_path],
+        metadata={
+            "plugins": {
+                "datasette-media": {
+                    "attachment": {
+                        "sql": (
+                            "select 'attachments' as content_table, "
+                            "'data' as content_column, rowid as content_rowid "
+                            "from attachments where id=:key"
+                        ),
+                        "enable_transform": True,
+                    },
+                    "transform_cache_dir": str(tmpdir / "cache"),
+                }
+            }
+        },
+    )
+    reads = []
+    original_read_blob = datasette_media.read_blob
+    monkeypatch.setattr(
+        datasette_media,
+        "read_blob",
+        lambda *args: reads.append(args) or original_read_blob(*args),
+    )
+    response = await ds.client.get("/-/media/attachment/1?w=50")
+    assert response.status_code == 200
+    assert len(reads) == 1
+    # Neither a 304 nor a transform cache hit reads the BLOB again
+    response2 = await ds.client.get(
+        "/-/media/attachment/1?w=50",
+        headers={"if-none-match": response.headers["etag"]},
+    )
+    assert response2.status_code == 304
+    response3 = await ds.client.get("/-/media/attachment/1?w=50")
+    assert response3.content == response.content
+    assert len(reads) == 1
+
+
+@pytest.mark.asyncio
+async def test_media_blob_streaming_version_column(tmpdir):
+    db_path = str(tmpdir / "attachments.db")
+    data = os.urandom(100000)
+    db = Database(db_path)
+    db["attachments"].insert({"id": 1, "data": data, "version": "a"}, pk="id")
+    ds = Datasette(
+        [db_path],
+        metadata={
+            "plugins": {
+                "datasette-media": {
+                    "attachment": {
+                        "sql": (
+                            "select 'attachments' as content_table, "
+                            "'data' as content_column, rowid as content_rowid, "
+                            "version from attachments where id=:key"
+                        ),
+                    }
+                }
+            }
+        },
+    )
+    response = await ds.client.get("/-/media/attachment/1")
+    etag = response.headers["etag"]
+    # Writes to other tables leave the ETag alone, so downloads can resume
+    db["other"].insert({"id": 1})
+    response = await ds.client.get(
+        "/-/media/attachment/1",
+        headers={"range": "bytes=100-199", "if-range": etag},
+    )
+    assert response.status_code == 206
+    assert response.content == data[100:200]
+    db["attachments"].update(1, {"data": data[::-1], "version": "b"})
+    response = await ds.client.get(
+        "/-/media/attachment/1",
+        headers={"range": "bytes=100-199", "if-range": etag},
+    )
+    assert response.status_code == 200
+    assert response.content == data[::-1]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("num_sql_threads", (0, 3))
+async def test_media_blob_streaming(tmpdir, num_sql_threads):
+    db_path = str(tmpdir / "attachments.db")
+    data = os.urandom(600 * 1024)
+    Database(db_path)["attachments"].insert(
+        {"id": 1, "name": "big.bin", "data": data}, pk="id"
+    )
+    jpeg = (pathlib.Path(__file__).parent / "example.jpg").read_bytes()
+    Database(db_path)["attachments"].insert(
+        {"id": 2, "name": "photo.jpg", "data": jpeg}, pk="id"
+    )
+    ds = Datasette(
+        [db_path],
+        settings={"num_sql_threads": num_sql_threads},
+        metadata={
+            "plugins": {
+                "datasette-media": {
+                    "attachment": {
+                        "sql": (
+                            "select 'attachments' as content_table, "
+                            "'data' as content_column, rowid as content_rowid, "
+                            "name as content_filename from attachments where id=:key"
+                        ),
+                        "enable_transform": True,
+                    }
+                }
+            }
+        },
+    )
+    response = await ds.client.get("/-/media/attachment/1")
+    assert response.status_code == 200
+    assert response.content == data
+    assert response.headers["content-length"] == str(len(data))
+    assert response.headers["content-type"] == "application/octet-stream"
+    assert response.headers["accept-ranges"] == "bytes"
+    assert response.headers["content-disposition"] == 'attachment; filename="big.bin"'
+    etag = response.headers["etag"]
+    # Conditional and range requests
+    response = await ds.client.get(
+        "/-/media/attachment/1", headers={"if-none-match": etag}
+    )
+    assert response.status_code == 304
+    response = await ds.client.get(
+        "/-/media/attachment/1", headers={"range": "bytes=300000-300009"}
+    )
+    assert response.status_code == 206
+    assert response.content == data[300000:300010]
+    assert response.headers["content-range"] == "bytes 300000-300009/{}".format(
+        len(data)
+    )
+    # Writing to the database changes the ETag
+    Database(db_path)["attachments"].update(1, {"data": data[::-1]})
+    response = await ds.client.get("/-/media/attachment/1")
+    assert response.content == data[::-1]
+    assert response.headers["etag"] != etag
+    # Images identified this way can still be transformed
+    response = await ds.client.get("/-/media/attachment/2?w=50")
+    assert response.status_code == 200
+    assert Image.open(io.BytesIO(response.content)).size[0] == 50
+    # Missing rowid
+    response = await ds.client.get("/-/media/attachment/3")
+    assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_row_cache(tmpdir, monkeypatch):
+    db_path = str(tmpdir / "files.db")
+    Database(db_path)["files"].insert(
+        {"id": 1, "content": b"one", "content_type": "text/plain"}, pk="id"
+    )
+    ds = Datasette(
+        [db_path],
+        metadata={
+            "plugins": {
+                "datasette-media": {
+                    "file": {
+                        "sql": "select content, content_type from files where id=:key"
+                    },
+                    "row_cache_size": 10,
+                }
+            }
+        },
+    )
+    await ds.invoke_startup()
+    database = ds.get_database("files")
+    queries = []
+    execute = database.execute
+
+    async def counting_execute(sql, *args, **kwargs):
+        queries.append(sql)
+        return await execute(sql, *args, **kwargs)
+
+    monkeypatch.setattr(database, "execute", counting_execute)
+    for _ in range(3):
+        response = await ds.client.get("/-/media/file/1")
+        assert response.content == b"one"
+        assert response.headers["content-type"] == "text/plain"
+    assert len(queries) == 1
+    # Writing to the database invalidates the cached row
+    time.sleep(0.01)
+    Database(db_path)["files"].update(1, {"content": b"two!"})
+    response = await ds.client.get("/-/media/file/1")
+    assert response.content == b"two!"
+    assert len(queries) == 2
+
+
+@pytest.mark.asyncio
+async def test_media_stats(tmpdir):
+    filepath = tmpdir / "hello.txt"
+    filepath.write_text("hello", "utf-8")
+    jpeg = pathlib.Path(__file__).parent / "example.jpg"
+    ds = Datasette(
+        metadata={
+            "plugins": {
+                "datasette-media": {
+                    "text": {"sql": "select '{}' as filepath".format(filepath)},
+                    "photo": {
+                        "sql": "select '{}' as filepath".format(jpeg),
+                        "enable_transform": True,
+                    },
+                    "memory_cache_max_size": 1000000,
+                }
+            }
+        }
+    )
+    assert (await ds.client.get("/-/media/text/1")).status_code == 200
+    assert (await ds.client.get("/-/media/photo/1?w=50")).status_code == 200
+    assert (await ds.client.get("/-/media/photo/1?w=50")).status_code == 200
+    assert (await ds.client.get("/-/media/photo/1?w=bad")).status_code == 400
+    # Unknown media types are not recorded
+    assert (await ds.client.get("/-/media/unknown/1")).status_code == 404
+    response = await ds.client.get("/-/media-stats")
+    assert response.status_code == 200
+    stats = response.json()
+    assert set(stats["media_types"]) == {"text", "photo"}
+    text = stats["media_types"]["text"]
+    assert text["counters"]["requests"] == 1
+    assert text["counters"]["bytes_sent"] == 5
+    assert set(text["timings"]) >= {"sql", "file", "total"}
+    photo = stats["media_types"]["photo"]
+    assert photo["counters"]["requests"] == 3
+    assert photo["counters"]["transforms"] == 1
+    assert photo["counters"]["memory_cache_hits"] == 1
+    assert photo["counters"]["client_errors"] == 1
+    assert set(photo["timings"]) >= {
+        "sql",
+        "admission",
+        "queue",
+        "open",
+        "decode",
+        "resize",
+        "encode",
+        "total",
+    }
+    assert photo["transforms"]["in_flight"] == 0
+    assert stats["memory_cache"]["hits"] == 1
+    assert stats["transform_executor"] == {"queued": 0, "running": 0}
+    response = await ds.client.get("/-/media-stats?format=prometheus")
+    assert response.headers["content-type"].startswith("text/plain")
+    assert 'datasette_media_requests_total{media_type="photo"} 3' in response.text
+    assert "datasette_media_memory_cache_hits 1" in response.text
+    assert "datasette_media_transform_executor_queued 0" in response.text
+
+
+@pytest.mark.asyncio
+async def test_batch_renditions(tmpdir, monkeypatch):
+    jpeg = str(pathlib.Path(__file__).parent / "example.jpg")
+    cache_dir = tmpdir / "cache"
+    ds = Datasette(
+        metadata={
+            "plugins": {
+                "datasette-media": {
+                    "photos": {
+                        "sql": "select '{}' as filepath".format(jpeg),
+                        "renditions": {
+                            "thumb": {"width": 50, "height": 50, "fit": "cover"},
+                            "small": {"width": 100},
+                            "medium": {"width": 200, "format": "png"},
+                        },
+                        "batch_renditions": True,
+                    },
+                    "transform_cache_dir": str(cache_dir),
+                }
+            }
+        }
+    )
+    renders = []
+    render_images = utils.render_images
+
+    def spy(*args, **kwargs):
+        renders.append(args)
+        return render_images(*args, **kwargs)
+
+    monkeypatch.setattr(utils, "render_images", spy)
+    response = await ds.client.get("/-/media/photos/1?rendition=small")
+    assert response.status_code == 200
+    assert Image.open(io.BytesIO(response.content)).size == (100, 74)
+    assert len(renders) == 1
+    # Every rendition was rendered from that one decode
+    assert len(cache_dir.listdir()) == 3
+    for rendition, size in (("thumb", (50, 50)), ("medium", (200, 149))):
+        response = await ds.client.get("/-/media/photos/1?rendition=" + rendition)
+        assert Image.open(io.BytesIO(response.content)).size == size
+    assert len(renders) == 1
+
+
+def _multipart_parts(response):
+    message = email.message_from_bytes(
+        "Content-Type: {}\r\n\r\n".format(response.headers["content-type"]).encode(
+            "utf-8"
+        )
+        + response.content,
+        policy=email.policy.HTTP,
+    )
+    return {
+        part["Content-Location"]: (part, part.get_payload(decode=True))
+        for part in message.iter_parts()
+    }
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("batch_sql", (False, True))
+async def test_media_batch(tmpdir, batch_sql):
+    db_path = str(tmpdir / "photos.db")
+    jpeg = (pathlib.Path(__file__).parent / "example.jpg").read_bytes()
+    Database(db_path)["photos"].insert_all(
+        [{"id": "a", "content": jpeg}, {"id": "b c", "content": jpeg}], pk="id"
+    )
+    config = {
+        "sql": "select content from photos where id=:key",
+        "enable_transform": True,
+        "max_batch_size": 3,
+    }
+    if batch_sql:
+        config["batch_sql"] = (
+            "select id as key, content from photos "
+            "where id in (select value from json_each(:keys))"
+        )
+    ds = Datasette(
+        [db_path], metadata={"plugins": {"datasette-media": {"photos": config}}}
+    )
+    response = await ds.client.get(
+        "/-/media-batch/photos?key=a&key=b+c&key=missing&w=50",
+        headers={"if-none-match": "*"},
+    )
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("multipart/mixed; boundary=")
+    parts = _multipart_parts(response)
+    assert set(parts) == {
+        "/-/media/photos/a?w=50",
+        "/-/media/photos/b%20c?w=50",
+        "/-/media/photos/missing?w=50",
+    }
+    for location in ("/-/media/photos/a?w=50", "/-/media/photos/b%20c?w=50"):
+        part, body = parts[location]
+        assert part["X-Media-Status"] == "200"
+        assert part["Content-Type"] == "image/jpeg"
+        assert part["ETag"]
+        assert int(part["Content-Length"]) == len(body)
+        assert Image.open(io.BytesIO(body)).size == (50, 37)
+    assert parts["/-/media/photos/missing?w=50"][0]["X-Media-Status"] == "404"
+    # Each item is recorded like a separate request
+    stats = (await ds.client.get("/-/media-stats")).json()
+    assert stats["media_types"]["photos"]["counters"]["requests"] == 2
+    # Too many keys
+    response = await ds.client.get("/-/media-batch/photos?key=a&key=b&key=c&key=d")
+    assert response.status_code == 400
+    response = await ds.client.get("/-/media-batch/photos")
+    assert response.status_code == 400
+    response = await ds.client.get("/-/media-batch/unknown?key=a")
+    assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_media_zip(tmpdir):
+    db_path = str(tmpdir / "album.db")
+    jpeg = pathlib.Path(__file__).parent / "example.jpg"
+    notes = tmpdir / "notes.txt"
+    notes.write_text("hello", "utf-8")
+    db = Database(db_path)
+    db["items"].insert_all(
+        [
+            {"id": 1, "album": "a", "filepath": str(jpeg), "name": "photo.jpg"},
+            {"id": 2, "album": "a", "filepath": str(jpeg), "name": "photo.jpg"},
+            {"id": 3, "album": "a", "filepath": str(notes), "name": None},
+            {"id": 4, "album": "a", "filepath": str(tmpdir / "gone"), "name": None},
+            {"id": 5, "album": "b", "filepath": str(notes), "name": None},
+        ],
+        pk="id",
+    )
+    ds = Datasette(
+        [db_path],
+        metadata={
+            "plugins": {
+                "datasette-media": {
+                    "item": {
+                        "sql": (
+                            "select filepath, name as content_filename "
+                            "from items where id=:key"
+                        ),
+                        "enable_transform": True,
+                        "zip": {
+                            "keys_sql": "select id from items where album = :album"
+                        },
+                    }
+                }
+            }
+        },
+    )
+    response = await ds.client.get("/-/media-zip/item?album=a")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/zip"
+    assert response.headers["content-disposition"] == 'attachment; filename="item.zip"'
+    archive = zipfile.ZipFile(io.BytesIO(response.content))
+    assert archive.namelist() == ["photo.jpg", "photo-2.jpg", "3.txt", "errors.txt"]
+    assert archive.read("photo.jpg") == jpeg.read_bytes()
+    assert archive.read("3.txt") == b"hello"
+    # The file is missing
+    assert archive.read("errors.txt") == b"4\t500\n"
+    assert archive.testzip() is None
+    # Transformed, for the keys listed in the URL
+    response = await ds.client.get(
+        "/-/media-zip/item?key=1&key=2&key=5&w=50&format=png"
+    )
+    archive = zipfile.ZipFile(io.BytesIO(response.content))
+    assert archive.namelist() == ["photo.png", "photo-2.png", "errors.txt"]
+    assert Image.open(io.BytesIO(archive.read("photo.png"))).size == (50, 37)
+    # A text file cannot be transformed
+    assert archive.read("errors.txt") == b"5\t500\n"
+    response = await ds.client.get("/-/media-zip/item")
+    assert response.status_code == 400
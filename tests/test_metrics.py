@@ -0,0 +1,47 @@
+from datasette_media.metrics import Metrics
+
+
+def test_metrics_counters_and_timings():
+    metrics = Metrics()
+    metrics.incr("photo", "requests")
+    metrics.incr("photo", "requests")
+    metrics.incr("photo", "bytes_sent", 100)
+    metrics.observe("photo", "sql", 0.002)
+    metrics.observe("photo", "sql", 0.3)
+    with metrics.timer("doc", "file"):
+        pass
+    stats = metrics.as_dict()
+    assert stats["photo"]["counters"] == {"bytes_sent": 100, "requests": 2}
+    sql = stats["photo"]["timings"]["sql"]
+    assert sql["count"] == 2
+    assert sql["sum"] == 0.302
+    assert sql["buckets"]["0.001"] == 0
+    assert sql["buckets"]["0.0025"] == 1
+    assert sql["buckets"]["0.25"] == 1
+    assert sql["buckets"]["0.5"] == 2
+    assert sql["buckets"]["+Inf"] == 2
+    assert stats["doc"]["timings"]["file"]["count"] == 1
+
+
+def test_metrics_prometheus():
+    metrics = Metrics()
+    metrics.incr("photo", "requests", 3)
+    metrics.observe("photo", "encode", 0.02)
+    output = metrics.prometheus([("transforms_queued", {"media_type": "photo"}, 2)])
+    lines = output.splitlines()
+    assert "# TYPE datasette_media_requests_total counter" in lines
+    assert 'datasette_media_requests_total{media_type="photo"} 3' in lines
+    assert "# TYPE datasette_media_stage_seconds histogram" in lines
+    assert (
+        'datasette_media_stage_seconds_bucket{media_type="photo",stage="encode",le="0.01"} 0'
+        in lines
+    )
+    assert (
+        'datasette_media_stage_seconds_bucket{media_type="photo",stage="encode",le="+Inf"} 1'
+        in lines
+    )
+    assert (
+        'datasette_media_stage_seconds_count{media_type="photo",stage="encode"} 1'
+        in lines
+    )
+    assert 'datasette_media_transforms_queued{media_type="photo"} 2' in lines
@@ -0,0 +1,50 @@
+from datasette_media.single_flight import SingleFlight
+import asyncio
+import pytest
+
+
+@pytest.mark.asyncio
+async def test_concurrent_calls_share_one_result():
+    flights = SingleFlight()
+    calls = []
+
+    async def work():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return len(calls)
+
+    results = await asyncio.gather(*[flights.run("a", work) for _ in range(5)])
+    assert results == [1, 1, 1, 1, 1]
+    assert len(flights) == 0
+    # Once finished, the next call runs the work again
+    assert await flights.run("a", work) == 2
+    assert await flights.run("b", work) == 3
+
+
+@pytest.mark.asyncio
+async def test_exceptions_are_shared():
+    flights = SingleFlight()
+
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise ValueError("bad")
+
+    results = await asyncio.gather(
+        flights.run("a", fail), flights.run("a", fail), return_exceptions=True
+    )
+    assert [str(r) for r in results] == ["bad", "bad"]
+
+
+@pytest.mark.asyncio
+async def test_cancelled_caller_does_not_cancel_work():
+    flights = SingleFlight()
+
+    async def work():
+        await asyncio.sleep(0.02)
+        return "done"
+
+    first = asyncio.ensure_future(flights.run("a", work))
+    second = asyncio.ensure_future(flights.run("a", work))
+    await asyncio.sleep(0.005)
+    first.cancel()
+    assert await second == "done"
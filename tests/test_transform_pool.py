@@ -0,0 +1,50 @@
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datasette_media.transform_pool import PendingTasks, ProcessTransformPool
+import asyncio
+import os
+import pytest
+import threading
+
+
+@pytest.mark.asyncio
+async def test_workers_are_recycled():
+    pool = ProcessTransformPool(1, max_tasks=2)
+    try:
+        pids = [await pool.run(os.getpid) for _ in range(4)]
+    finally:
+        pool.shutdown()
+    assert pids[0] == pids[1]
+    assert pids[2] == pids[3]
+    assert pids[1] != pids[2]
+    assert os.getpid() not in pids
+
+
+@pytest.mark.asyncio
+async def test_crashed_pool_is_replaced():
+    pool = ProcessTransformPool(1)
+    try:
+        with pytest.raises(BrokenProcessPool):
+            await pool.run(os._exit, 1)
+        assert await pool.run(sum, [1, 2]) == 3
+    finally:
+        pool.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_pending_tasks_queue_depth():
+    pending = PendingTasks()
+    release = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=1)
+    try:
+        tasks = [
+            asyncio.ensure_future(pending.run(executor, release.wait)) for _ in range(3)
+        ]
+        await asyncio.sleep(0.05)
+        assert (pending.queued, pending.running) == (2, 1)
+        release.set()
+        await asyncio.gather(*tasks)
+        assert (pending.queued, pending.running) == (0, 0)
+    finally:
+        release.set()
+        executor.shutdown()
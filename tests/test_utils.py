@@ -1,6 +1,24 @@
-from datasette_media.utils import image_type_for_bytes
+from datasette.utils.asgi import Request
+from datasette_media.utils import (
+    ORIENTATION_EXIF_TAG,
+    SourceTooLarge,
+    encode_image,
+    image_type_for_bytes,
+    image_type_for_file,
+    is_not_modified,
+    negotiate_format,
+    open_image,
+    parse_range,
+    render_images,
+    requested_ranges,
+    should_transform,
+    transform_image,
+)
+from datasette_media import utils
+from PIL import Image, JpegImagePlugin
+import io
 import pytest
-
+import types
 
 GIF_1x1 = b"GIF89a\x01\x00\x01\x00\x80\x00\x00\x00\x00\x00\xff\xff\xff!\xf9\x04\x01\x00\x00\x00\x00,\x00\x00\x00\x00\x01\x00\x01\x00\x00\x02\x01D\x00;"
 PNG_1x1 = b"\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00\x00\x01\x08\x00\x00\x00\x00:~\x9bU\x00\x00\x00\nIDATx\x9cc\xfa\x0f\x00\x01\x05\x01\x02\xcf\xa0.\xcd\x00\x00\x00\x00IEND\xaeB`\x82"
@@ -15,8 +33,439 @@ HEIC = b'\x00\x00\x00\x18ftypheic\x00\x00\x00\x00mif1heic\x00\x00\x01*meta\x00\x
         (PNG_1x1, "png"),
         (JPEG, "jpeg"),
         (HEIC, "heic"),
+        (b"RIFF\x1a\x00\x00\x00WEBPVP8 ", "webp"),
+        (b"RIFF\x1a\x00\x00\x00WAVEfmt ", None),
+        (b"\x00\x00\x00\x1cftypavif\x00\x00\x00\x00", "avif"),
+        (b"\x00\x00\x00\x1cftypisom\x00\x00\x00\x00", None),
+        (b"II*\x00\x08\x00\x00\x00", "tiff"),
+        (b"MM\x00*\x00\x00\x00\x08", "tiff"),
+        (b"BM6\x00\x00\x00", "bmp"),
         (b"hello", None),
+        (b"", None),
     ],
 )
 def test_image_type_for_bytes(img_bytes, expected_type):
     assert expected_type == image_type_for_bytes(img_bytes)
+
+
+def test_row_shape():
+    shape = utils.row_shape(("filepath", "resize_width", "content_filename"))
+    assert shape.source == "filepath"
+    assert not shape.blob
+    assert shape.transform_columns == {"resize_width"}
+    # Worked out once for each set of columns
+    assert (
+        utils.shape_of(
+            {"filepath": "a.jpg", "resize_width": 10, "content_filename": "a"}
+        )
+        is shape
+    )
+    blob_shape = utils.row_shape(("content_table", "content_column", "content_rowid"))
+    assert blob_shape.blob
+    assert blob_shape.source is None
+    assert utils.row_shape(("content", "content_url")).source == "content"
+
+
+@pytest.mark.parametrize("format", ["PNG", "GIF", "BMP", "TIFF", "WEBP"])
+def test_open_image_uses_detected_format(tmpdir, monkeypatch, format):
+    filepath = str(tmpdir / "image")
+    Image.new("RGB", (20, 10)).save(filepath, format)
+    assert image_type_for_file(filepath) == format.lower()
+    calls = []
+    open_ = Image.open
+
+    def spy(fp, *args, **kwargs):
+        calls.append(kwargs.get("formats"))
+        return open_(fp, *args, **kwargs)
+
+    monkeypatch.setattr(Image, "open", spy)
+    for image in (
+        open_image(filepath=filepath),
+        open_image(open(filepath, "rb").read()),
+    ):
+        assert image.format == format
+        assert image.size == (20, 10)
+    assert calls == [[format], [format]]
+
+
+@pytest.mark.parametrize("has_open", [True, False])
+def test_open_image_heic_pyheif_versions(monkeypatch, has_open):
+    # pyheif 0.5 added open(); older versions only have read_heif()
+    decoded = types.SimpleNamespace(mode="RGB", size=(4, 2), data=b"\x00" * 24)
+    fake = types.SimpleNamespace(read_heif=lambda source: decoded)
+    if has_open:
+        fake.open = lambda source: types.SimpleNamespace(
+            size=(4, 2), load=lambda: decoded
+        )
+    monkeypatch.setattr(utils, "pyheif", fake)
+    image = open_image(HEIC)
+    assert image.size == (4, 2)
+    with pytest.raises(utils.SourceTooLarge):
+        open_image(HEIC, max_pixels=4)
+
+
+@pytest.mark.parametrize(
+    "headers,expected",
+    [
+        ({}, False),
+        ({"if-none-match": '"abc"'}, True),
+        ({"if-none-match": 'W/"abc"'}, True),
+        ({"if-none-match": '"xyz", "abc"'}, True),
+        ({"if-none-match": "*"}, True),
+        ({"if-none-match": '"xyz"'}, False),
+        # If-None-Match takes precedence over If-Modified-Since
+        (
+            {
+                "if-none-match": '"xyz"',
+                "if-modified-since": "Sun, 06 Nov 1994 08:49:37 GMT",
+            },
+            False,
+        ),
+        ({"if-modified-since": "Sun, 06 Nov 1994 08:49:37 GMT"}, True),
+        ({"if-modified-since": "Sun, 06 Nov 1994 08:49:36 GMT"}, False),
+        ({"if-modified-since": "not a date"}, False),
+    ],
+)
+def test_is_not_modified(headers, expected):
+    last_modified = 784111777  # Sun, 06 Nov 1994 08:49:37 GMT
+    assert expected == is_not_modified(headers, '"abc"', last_modified)
+
+
+@pytest.mark.parametrize(
+    "header,expected",
+    [
+        ("bytes=0-4", [(0, 4)]),
+        ("bytes=5-", [(5, 9)]),
+        ("bytes=-3", [(7, 9)]),
+        ("bytes=-30", [(0, 9)]),
+        ("bytes=8-100", [(8, 9)]),
+        ("bytes=0-1, 4-5", [(0, 1), (4, 5)]),
+        ("bytes=10-20", []),
+        ("bytes=10-", []),
+        ("bytes=15-", []),
+        ("bytes=5-4", None),
+        ("bytes=a-b", None),
+        ("items=0-4", None),
+    ],
+)
+def test_parse_range(header, expected):
+    assert expected == parse_range(header, 10)
+
+
+@pytest.mark.parametrize("header", ["bytes=-3", "bytes=0-", "bytes=0-4"])
+def test_parse_range_empty_body(header):
+    assert parse_range(header, 0) == []
+
+
+@pytest.mark.parametrize(
+    "if_range,expected",
+    [
+        (None, [(0, 1)]),
+        ('"abc"', [(0, 1)]),
+        ('"xyz"', None),
+        ('W/"abc"', None),
+        ("Sun, 06 Nov 1994 08:49:37 GMT", [(0, 1)]),
+        ("Sun, 06 Nov 1994 08:49:38 GMT", None),
+    ],
+)
+def test_requested_ranges_if_range(if_range, expected):
+    headers = {"range": "bytes=0-1"}
+    if if_range:
+        headers["if-range"] = if_range
+    assert expected == requested_ranges(headers, 10, '"abc"', 784111777)
+
+
+def _jpeg(size, orientation=None):
+    image = Image.new("RGB", size, "red")
+    # Mark the top-left corner so orientation can be checked
+    image.paste("blue", (0, 0, size[0] // 4, size[1] // 4))
+    exif = Image.Exif()
+    if orientation:
+        exif[ORIENTATION_EXIF_TAG] = orientation
+    output = io.BytesIO()
+    image.save(output, "JPEG", exif=exif.tobytes())
+    return output.getvalue()
+
+
+@pytest.mark.parametrize(
+    "orientation,transform,expected_size",
+    [
+        (None, {"width": 200}, (200, 150)),
+        (None, {"height": 75}, (100, 75)),
+        (None, {"width": 150, "height": 150}, (150, 150)),
+        (None, {"width": 2000}, (2000, 1500)),
+        (6, {"width": 150}, (150, 200)),
+        (8, {"height": 100}, (75, 100)),
+        (3, {"width": 200}, (200, 150)),
+    ],
+)
+def test_transform_image_draft(orientation, transform, expected_size):
+    image_bytes = _jpeg((1600, 1200), orientation)
+    image = transform_image(image_bytes, **transform)
+    assert image.size == expected_size
+
+
+def test_transform_image_draft_decodes_at_reduced_scale(monkeypatch):
+    sizes = []
+    original_draft = JpegImagePlugin.JpegImageFile.draft
+
+    def draft(self, mode, size):
+        result = original_draft(self, mode, size)
+        sizes.append(self.size)
+        return result
+
+    monkeypatch.setattr(JpegImagePlugin.JpegImageFile, "draft", draft)
+    transform_image(_jpeg((1600, 1200)), width=200)
+    # 1/8 scale is the smallest that is still at least 200x150
+    assert sizes == [(200, 150)]
+
+
+@pytest.mark.parametrize(
+    "transform,reduce_large,expected_size",
+    [
+        # Full size decodes are over the limit
+        ({}, False, None),
+        ({"width": 1000}, False, None),
+        # Small outputs are drafted within it anyway
+        ({"width": 200}, False, (200, 150)),
+        ({"width": 300}, False, (300, 225)),
+        # Reduced to a 1/2 scale decode, 800x600
+        ({}, True, (800, 600)),
+        ({"width": 1000}, True, (1000, 750)),
+    ],
+)
+def test_transform_image_max_pixels(transform, reduce_large, expected_size):
+    image_bytes = _jpeg((1600, 1200))
+    if expected_size is None:
+        with pytest.raises(SourceTooLarge):
+            transform_image(
+                image_bytes, max_pixels=500000, reduce_large=reduce_large, **transform
+            )
+    else:
+        image = transform_image(
+            image_bytes, max_pixels=500000, reduce_large=reduce_large, **transform
+        )
+        assert image.size == expected_size
+
+
+def test_max_pixels_checked_before_decode(monkeypatch):
+    output = io.BytesIO()
+    Image.new("RGB", (1000, 1000)).save(output, "PNG")
+    loaded = []
+    monkeypatch.setattr(Image.Image, "load", lambda self: loaded.append(self))
+    with pytest.raises(SourceTooLarge):
+        render_images(output.getvalue(), transforms=[{"width": 10}], max_pixels=10000)
+    # PNGs cannot be decoded at a reduced scale
+    with pytest.raises(SourceTooLarge):
+        render_images(
+            output.getvalue(),
+            transforms=[{"width": 10}],
+            max_pixels=10000,
+            reduce_large=True,
+        )
+    assert loaded == []
+
+
+@pytest.mark.parametrize("orientation", [None, 6])
+def test_render_images_matches_transform_image(monkeypatch, orientation):
+    image_bytes = _jpeg((1600, 1200), orientation)
+    transforms = [
+        {"width": 200},
+        {"width": 800, "format": "png"},
+        {"width": 100, "height": 100, "fit": "cover"},
+        {"width": 300, "height": 300, "fit": "contain", "quality": 50},
+        {"width": 400},
+        {"height": 50, "format": "webp"},
+    ]
+    opened = []
+    monkeypatch.setattr(
+        utils, "open_image", lambda *args: opened.append(args) or open_image(*args)
+    )
+    outputs, timings = render_images(image_bytes, transforms=transforms)
+    # The source was decoded once for all six outputs
+    assert len(opened) == 1
+    assert set(timings) == {"open", "decode", "resize", "encode"}
+    for transform, (body, content_type) in zip(transforms, outputs):
+        image = Image.open(io.BytesIO(body)).convert("RGB")
+        options = {k: v for k, v in transform.items() if k != "quality"}
+        expected = transform_image(image_bytes, **options).convert("RGB")
+        assert image.size == expected.size
+        assert content_type == "image/{}".format(transform.get("format") or "jpeg")
+        # Orientation is applied the same way - check the marked corner
+        for xy in ((1, 1), (image.width - 2, 1)):
+            assert abs(image.getpixel(xy)[2] - expected.getpixel(xy)[2]) < 30
+
+
+def test_transform_image_from_filepath(tmpdir):
+    filepath = str(tmpdir / "photo.jpg")
+    with open(filepath, "wb") as fp:
+        fp.write(_jpeg((1600, 1200), orientation=6))
+    image = transform_image(filepath=filepath, width=150)
+    assert image.size == (150, 200)
+    # Image data has been decoded, so nothing else needs to read the file
+    assert image.im is not None
+
+
+RENDITIONS = {
+    "thumb": {"width": 100, "height": 100, "fit": "cover", "quality": 70},
+    "medium": {"width": 400, "format": "webp"},
+}
+
+
+@pytest.mark.parametrize(
+    "config,args,expected",
+    [
+        ({}, "rendition=thumb", None),
+        (
+            {"renditions": RENDITIONS},
+            "rendition=thumb",
+            {
+                "width": 100,
+                "height": 100,
+                "format": None,
+                "fit": "cover",
+                "quality": 70,
+            },
+        ),
+        (
+            {"renditions": RENDITIONS},
+            "rendition=medium",
+            {"width": 400, "height": None, "format": "webp"},
+        ),
+        (
+            {"renditions": RENDITIONS, "enable_transform": True},
+            "w=300",
+            {"width": 300},
+        ),
+        (
+            {
+                "renditions": RENDITIONS,
+                "enable_transform": True,
+                "arbitrary_sizes": "snap",
+            },
+            "w=300&format=png",
+            {"width": 400, "height": None, "format": "png"},
+        ),
+        (
+            {
+                "renditions": RENDITIONS,
+                "enable_transform": True,
+                "arbitrary_sizes": "snap",
+            },
+            "h=120",
+            {
+                "width": 100,
+                "height": 100,
+                "format": None,
+                "fit": "cover",
+                "quality": 70,
+            },
+        ),
+        (
+            {
+                "renditions": RENDITIONS,
+                "enable_transform": True,
+                "arbitrary_sizes": "reject",
+            },
+            "format=png",
+            {"format": "png"},
+        ),
+    ],
+)
+def test_should_transform_renditions(config, args, expected):
+    row = FakeRow({"filepath": "x.jpg"})
+    request = Request.fake("/-/media/photo/1?" + args)
+    assert expected == should_transform(row, config, request)
+
+
+@pytest.mark.parametrize(
+    "config,args,message",
+    [
+        ({"renditions": RENDITIONS}, "rendition=huge", "Unknown rendition: huge"),
+        (
+            {
+                "renditions": RENDITIONS,
+                "enable_transform": True,
+                "arbitrary_sizes": "reject",
+            },
+            "w=300",
+            "Only named renditions are available",
+        ),
+        ({"enable_transform": True}, "w=abc", "w and h must be integers"),
+        (
+            {"renditions": {"bad": {"width": 10, "fit": "squash"}}},
+            "rendition=bad",
+            "fit must be one of fill, contain, cover",
+        ),
+    ],
+)
+def test_should_transform_errors(config, args, message):
+    row = FakeRow({"filepath": "x.jpg"})
+    with pytest.raises(ValueError) as ex:
+        should_transform(row, config, Request.fake("/-/media/photo/1?" + args))
+    assert str(ex.value) == message
+
+
+@pytest.mark.parametrize(
+    "fit,expected_size",
+    [
+        (None, (100, 100)),
+        ("fill", (100, 100)),
+        ("contain", (100, 75)),
+        ("cover", (100, 100)),
+    ],
+)
+def test_transform_image_fit(fit, expected_size):
+    image = transform_image(_jpeg((1600, 1200)), width=100, height=100, fit=fit)
+    assert image.size == expected_size
+    # The blue top-left quarter is narrower once cover crops the sides
+    is_blue = image.getpixel((20, 5))[2] > 128
+    assert is_blue == (fit != "cover")
+
+
+def test_encode_image_quality():
+    image = Image.effect_noise((200, 200), 50).convert("RGB")
+    low, content_type = encode_image(image, "JPEG", quality=10)
+    high, _ = encode_image(image, "JPEG", quality=95)
+    assert content_type == "image/jpeg"
+    assert len(low) < len(high)
+
+
+class FakeRow(dict):
+    pass
+
+
+@pytest.mark.parametrize(
+    "accept,expected",
+    [
+        (None, None),
+        ("*/*", None),
+        ("image/webp,*/*", "webp"),
+        ("image/avif,image/webp,image/*,*/*;q=0.8", "avif"),
+        ("image/avif;q=0,image/webp", "webp"),
+        ("image/png", None),
+    ],
+)
+def test_negotiate_format(accept, expected):
+    config = {"enable_transform": True, "negotiate_formats": ["avif", "webp"]}
+    request = Request.fake("/")
+    if accept:
+        request.scope["headers"] = [(b"accept", accept.encode("utf-8"))]
+    assert expected == negotiate_format(config, request)
+    # Negotiation needs enable_transform
+    assert negotiate_format(dict(config, enable_transform=False), request) is None
+
+
+def test_encode_image_format_options():
+    image = Image.effect_noise((200, 200), 50).convert("RGB")
+    low, content_type = encode_image(
+        image, "WEBP", format_options={"webp": {"quality": 10, "method": 6}}
+    )
+    high, _ = encode_image(image, "WEBP", format_options={"webp": {"quality": 95}})
+    assert content_type == "image/webp"
+    assert len(low) < len(high)
+    # Rendition quality takes precedence over format_options
+    same, _ = encode_image(
+        image, "WEBP", quality=95, format_options={"webp": {"quality": 10}}
+    )
+    assert len(same) == len(high)
@@ -0,0 +1,130 @@
+from click.testing import CliRunner
+from datasette.app import Datasette
+from datasette.cli import cli
+from datasette_media.cache import DiskCache
+from sqlite_utils import Database
+import asyncio
+import datasette_media
+import json
+import pathlib
+import pytest
+import shutil
+
+
+@pytest.fixture
+def warm_setup(tmpdir):
+    jpeg = pathlib.Path(__file__).parent / "example.jpg"
+    db_path = str(tmpdir / "photos.db")
+    rows = []
+    for i in range(3):
+        filepath = str(tmpdir / "photo{}.jpg".format(i))
+        shutil.copy(str(jpeg), filepath)
+        rows.append({"id": i, "filepath": filepath})
+    Database(db_path)["photos"].insert_all(rows, pk="id")
+    cache_dir = tmpdir / "cache"
+    metadata = {
+        "plugins": {
+            "datasette-media": {
+                "photo": {
+                    "sql": "select filepath from photos where id=:key",
+                    "database": "photos",
+                    "enable_transform": True,
+                    "warm": {"keys_sql": "select id from photos", "widths": [100]},
+                },
+                "transform_cache_dir": str(cache_dir),
+            }
+        }
+    }
+    metadata_path = str(tmpdir / "metadata.json")
+    with open(metadata_path, "w") as fp:
+        json.dump(metadata, fp)
+    return db_path, metadata_path, metadata, cache_dir
+
+
+def test_media_warm(warm_setup):
+    db_path, metadata_path, _, cache_dir = warm_setup
+    runner = CliRunner()
+    result = runner.invoke(
+        cli,
+        [
+            "media-warm",
+            db_path,
+            "-m",
+            metadata_path,
+            "--media-type",
+            "photo",
+            "-w",
+            "50",
+            "-w",
+            "100",
+            "-f",
+            "png",
+            "--processes",
+            "1",
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    assert "Rendered 6, skipped 0 already cached, 0 failed" in result.output
+    assert len(cache_dir.listdir()) == 6
+    assert all(p.ext == ".png" for p in cache_dir.listdir())
+    # Running again skips everything
+    result = runner.invoke(
+        cli,
+        ["media-warm", db_path, "-m", metadata_path, "--media-type", "photo"]
+        + ["-w", "50", "-w", "100", "-f", "png", "--processes", "1"],
+    )
+    assert "Rendered 0, skipped 6 already cached, 0 failed" in result.output
+
+
+def test_media_warm_is_used_by_serve_media(warm_setup, monkeypatch):
+    db_path, metadata_path, metadata, cache_dir = warm_setup
+    # A server that is already running when the cache is warmed, with its
+    # own DiskCache - as it would be in a separate process
+    server_cache = DiskCache(cache_dir)
+    monkeypatch.setattr(datasette_media, "transform_caches", {})
+    result = CliRunner().invoke(
+        cli,
+        ["media-warm", db_path, "-m", metadata_path, "--media-type", "photo"]
+        + ["--keys-sql", "select id from photos where id = 1", "--processes", "1"],
+    )
+    assert "Rendered 1, skipped 0 already cached, 0 failed" in result.output
+    cached = cache_dir.listdir()
+    assert len(cached) == 1
+    cached[0].write_binary(b"warmed")
+    monkeypatch.setattr(
+        datasette_media, "transform_caches", {str(cache_dir): server_cache}
+    )
+    ds = Datasette([db_path], metadata=metadata)
+    response = asyncio.run(ds.client.get("/-/media/photo/1?w=100"))
+    assert response.content == b"warmed"
+
+
+def test_media_warm_errors(warm_setup):
+    db_path, metadata_path, _, _ = warm_setup
+    result = CliRunner().invoke(
+        cli, ["media-warm", db_path, "-m", metadata_path, "--media-type", "nope"]
+    )
+    assert result.exit_code == 1
+    assert "Invalid media type: nope" in result.output
+
+
+def test_media_warm_renditions(warm_setup):
+    db_path, metadata_path, metadata, cache_dir = warm_setup
+    photo = metadata["plugins"]["datasette-media"]["photo"]
+    photo["renditions"] = {"thumb": {"width": 20}, "medium": {"width": 60}}
+    del photo["warm"]["widths"]
+    with open(metadata_path, "w") as fp:
+        json.dump(metadata, fp)
+    result = CliRunner().invoke(
+        cli,
+        ["media-warm", db_path, "-m", metadata_path, "--media-type", "photo"]
+        + ["--processes", "1"],
+    )
+    # Every configured rendition is rendered by default
+    assert "Rendered 6, skipped 0 already cached, 0 failed" in result.output
+    result = CliRunner().invoke(
+        cli,
+        ["media-warm", db_path, "-m", metadata_path, "--media-type", "photo"]
+        + ["-r", "thumb", "--processes", "1"],
+    )
+    assert "Rendered 0, skipped 3 already cached, 0 failed" in result.output